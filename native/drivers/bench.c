@@ -0,0 +1,173 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <sys/resource.h>
+
+#include <pcap.h>
+#include <weaver.h>
+
+// replays a pcap file held in memory and prints one JSON object of results, so
+// that no disk I/O or copying is timed
+
+#define PKT_BURST 32
+
+typedef struct {
+    WV_ByteSlice *packets;
+    // RSS hash that NIC would give, taken at loading as NIC takes it for free
+    WV_U32 *hashes;
+    const WV_U32 **hash_refs;  // NULL for packet without hash
+    WV_U64 *times;
+    WV_U32 count;
+    WV_U64 byte_count;  // by original length on wire
+} Workload;
+
+// captured bytes of all packets go to one buffer, slices point into it once
+// loading is done and buffer stops moving
+WV_U8 load(const char *filename, Workload *workload) {
+    char errbuf[PCAP_ERRBUF_SIZE];
+    pcap_t *pcap = pcap_open_offline(filename, errbuf);
+    if (!pcap) {
+        fprintf(stderr, "pcap_open_offline: %s\n", errbuf);
+        return 1;
+    }
+    WV_U32 capacity = 1024;
+    size_t data_capacity = 1 << 20, data_length = 0;
+    WV_Byte *data = malloc(data_capacity);
+    size_t *offsets = malloc(sizeof(size_t) * capacity);
+    workload->packets = malloc(sizeof(WV_ByteSlice) * capacity);
+    workload->times = malloc(sizeof(WV_U64) * capacity);
+    workload->count = 0;
+    workload->byte_count = 0;
+    struct pcap_pkthdr *header;
+    const WV_Byte *packet;
+    while (pcap_next_ex(pcap, &header, &packet) == 1) {
+        if (workload->count == capacity) {
+            capacity *= 2;
+            offsets = realloc(offsets, sizeof(size_t) * capacity);
+            workload->packets = realloc(workload->packets, sizeof(WV_ByteSlice) * capacity);
+            workload->times = realloc(workload->times, sizeof(WV_U64) * capacity);
+        }
+        while (data_length + header->caplen > data_capacity) {
+            data_capacity *= 2;
+            data = realloc(data, data_capacity);
+        }
+        memcpy(data + data_length, packet, header->caplen);
+        offsets[workload->count] = data_length;
+        workload->packets[workload->count].length = header->caplen;
+        // runtime clock must not go backward
+        WV_U64 now = header->ts.tv_sec;
+        if (workload->count != 0 && now < workload->times[workload->count - 1]) {
+            now = workload->times[workload->count - 1];
+        }
+        workload->times[workload->count] = now;
+        workload->byte_count += header->len;
+        workload->count += 1;
+        data_length += header->caplen;
+    }
+    pcap_close(pcap);
+    workload->hashes = malloc(sizeof(WV_U32) * workload->count);
+    workload->hash_refs = malloc(sizeof(WV_U32 *) * workload->count);
+    for (WV_U32 i = 0; i < workload->count; i += 1) {
+        workload->packets[i].cursor = data + offsets[i];
+        WV_U8 hashed = WV_RSSFrameHash(workload->packets[i].cursor, workload->packets[i].length, &workload->hashes[i]);
+        workload->hash_refs[i] = hashed ? &workload->hashes[i] : NULL;
+    }
+    free(offsets);
+    return 0;
+}
+
+// every round starts an hour after last one, so that instances left by last
+// round are expired instead of being continued
+#define ROUND_GAP_SEC 3600
+
+WV_U8 replay(Workload *workload, WV_Runtime *runtime, WV_U64 round) {
+    WV_U8 status[PKT_BURST];
+    WV_U64 span = workload->times[workload->count - 1] - workload->times[0] + ROUND_GAP_SEC;
+    WV_U64 offset = round * span - workload->times[0];
+    for (WV_U32 i = 0; i < workload->count; i += PKT_BURST) {
+        WV_U16 count = workload->count - i < PKT_BURST ? workload->count - i : PKT_BURST;
+        WV_ProcessBurst(&workload->packets[i], count, status, &workload->hash_refs[i],
+            workload->times[i + count - 1] + offset, runtime);
+    }
+    return 0;
+}
+
+WV_F current_sec() {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+int main(int argc, char *argv[]) {
+    char *pcap_filename = NULL;
+    WV_U32 warmup_count = 1;
+    WV_F duration = 5;
+    for (int i = 1; i < argc; i += 1) {
+        if (strcmp(argv[i], "--duration") == 0 && i + 1 < argc) {
+            duration = atof(argv[++i]);
+        } else if (strcmp(argv[i], "--warmup") == 0 && i + 1 < argc) {
+            warmup_count = atoi(argv[++i]);
+        } else {
+            pcap_filename = argv[i];
+        }
+    }
+    if (pcap_filename == NULL) {
+        fprintf(stderr, "usage: %s [--duration <sec>] [--warmup <rounds>] <pcap>\n", argv[0]);
+        return 1;
+    }
+
+    Workload workload;
+    if (load(pcap_filename, &workload)) {
+        return 1;
+    }
+    if (workload.count == 0) {
+        fprintf(stderr, "no packet in %s\n", pcap_filename);
+        return 1;
+    }
+    WV_Runtime *runtime = WV_AllocRuntime();
+    if (!runtime) {
+        fprintf(stderr, "runtime initialization fail\n");
+        return 1;
+    }
+    WV_Setup();
+    WV_ProfileStart(WV_GetProfile(runtime));
+
+    // warm up pools, tables and caches, then replay whole rounds until duration
+    // is reached, clock is only read between rounds
+    WV_U64 round = 0;
+    for (; round < warmup_count; round += 1) {
+        replay(&workload, runtime, round);
+    }
+    WV_Profile *profile = WV_GetProfile(runtime);
+    memset(&profile->interval_latency, 0, sizeof(WV_Histogram));
+    WV_U64 round_count = 0;
+    WV_F start = current_sec(), elapsed;
+    WV_U64 start_cycle = WV_Rdtsc();
+    do {
+        replay(&workload, runtime, round + round_count);
+        round_count += 1;
+        elapsed = current_sec() - start;
+    } while (elapsed < duration);
+    WV_U64 cycles = WV_Rdtsc() - start_cycle;
+
+    WV_U64 packet_count = (WV_U64)workload.count * round_count;
+    WV_U64 byte_count = workload.byte_count * round_count;
+    struct rusage usage;
+    getrusage(RUSAGE_SELF, &usage);
+    const WV_Histogram *latency = &profile->interval_latency;
+    printf("{\"pcap\": \"%s\", \"packet_count\": %llu, \"byte_count\": %llu, \"round_count\": %llu, "
+           "\"seconds\": %.6f, \"mpps\": %.6f, \"gbps\": %.6f, \"cycles_per_packet\": %.2f, "
+           "\"latency_p50\": %llu, \"latency_p99\": %llu, \"latency_p999\": %llu, \"peak_rss_kb\": %ld}\n",
+        pcap_filename, (unsigned long long)packet_count, (unsigned long long)byte_count,
+        (unsigned long long)round_count, elapsed, packet_count / elapsed / 1e6, byte_count * 8 / elapsed / 1e9,
+        (WV_F)cycles / packet_count, (unsigned long long)WV_HistogramPercentile(latency, 0.5),
+        (unsigned long long)WV_HistogramPercentile(latency, 0.99),
+        (unsigned long long)WV_HistogramPercentile(latency, 0.999), usage.ru_maxrss);
+
+    if (WV_FreeRuntime(runtime)) {
+        fprintf(stderr, "runtime cleanup fail\n");
+        return 1;
+    }
+    return 0;
+}
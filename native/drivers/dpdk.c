@@ -63,14 +63,18 @@
 
 #define PARAM_PROC_ID "proc-id"
 #define PARAM_NUM_PROCS "num-procs"
+#define PARAM_RSS_HASH "rss-hash"
+#define PARAM_METRICS "metrics"
 
 // #define EVAL_PERF
 // #define FWD
 
-/* for each lcore, record the elements of the ports array to use */
+/* for each lcore, record the elements of the ports array to use, and the
+ * rx/tx queue of each port that belongs to this lcore only */
 struct lcore_ports{
   unsigned start_port;
   unsigned num_ports;
+  uint16_t queue;
 };
 
 /* structure to record the rx and tx packets. Put two per cache line as ports
@@ -83,6 +87,16 @@ struct port_stats{
 
 static int proc_id = -1;
 static unsigned num_procs = 0;
+/* pass RSS hash of mbuf to runtime, so layers with packet_hash set skip
+ * hashing their key, the RSS key is symmetric so both directions agree */
+static int use_rss_hash = 0;
+/* hash types each port computes, RSS hash of a packet is passed only if it
+ * covers the port pair */
+static uint64_t port_rss_hf[RTE_MAX_ETHPORTS];
+/* metrics of all lcores are written every second by the first lcore polling a
+ * port, and once more on exit */
+static const char *metrics_path = NULL;
+static unsigned metrics_lcore = 0;
 
 static uint16_t ports[RTE_MAX_ETHPORTS];
 static unsigned num_ports = 0;
@@ -90,6 +104,27 @@ static unsigned num_ports = 0;
 static struct lcore_ports lcore_ports[RTE_MAX_LCORE];
 static struct port_stats pstats[RTE_MAX_ETHPORTS];
 
+/* queues of each port owned by one process, one per lcore unless ports are
+ * partitioned between lcores */
+static uint16_t queues_per_proc = 1;
+
+#define PERF_AVG_NUM 5
+
+/* DPDKUser, one per lcore. The generated runtime is not thread-safe, so every
+ * lcore owns a runtime and relies on symmetric RSS to see both directions of
+ * its flows */
+typedef struct {
+    WV_Runtime *runtime;
+    unsigned port;
+    unsigned long pkt_id;
+    unsigned long long pkt_vol;
+    struct timeval milestone;
+    double throughputs[PERF_AVG_NUM];
+    double peak_throught;
+} __rte_cache_aligned DPDKUser;
+
+static DPDKUser dpdk_users[RTE_MAX_LCORE];
+
 /* prints the usage statement and quits with an error message */
 static void
 smp_usage(const char *prgname, const char *errmsg)
@@ -97,16 +132,39 @@ smp_usage(const char *prgname, const char *errmsg)
   printf("\nError: %s\n",errmsg);
   printf("\n%s [EAL options] -- -p <port mask> "
       "--"PARAM_NUM_PROCS" <n>"
-      " --"PARAM_PROC_ID" <id>\n"
+      " --"PARAM_PROC_ID" <id>"
+      " [--"PARAM_RSS_HASH"]"
+      " [--"PARAM_METRICS" <path>]\n"
       "-p         : a hex bitmask indicating what ports are to be used\n"
       "--num-procs: the number of processes which will be used\n"
       "--proc-id  : the id of the current process (id < num-procs)\n"
+      "--rss-hash : use RSS hash of NIC as flow hash of runtime\n"
+      "--metrics  : write metrics to the file every second, CSV if it ends\n"
+      "             with .csv otherwise JSON\n"
       "\n",
       prgname);
   exit(1);
 }
 
 
+/* runtimes of other lcores are read while they run, so the snapshot is
+ * approximate */
+static void
+write_metrics(void)
+{
+  unsigned i;
+  WV_Metrics total, metrics;
+  memset(&total, 0, sizeof(total));
+  RTE_LCORE_FOREACH(i) {
+    if (dpdk_users[i].runtime == NULL)
+      continue;
+    WV_GetMetrics(dpdk_users[i].runtime, &metrics);
+    WV_MetricsMerge(&total, &metrics);
+  }
+  if (WV_MetricsWrite(&total, metrics_path))
+    printf("metrics write fail: %s\n", metrics_path);
+}
+
 /* signal handler configured for SIGTERM and SIGINT to print stats on exit */
 static void
 print_stats(int signum)
@@ -118,6 +176,22 @@ print_stats(int signum)
     printf("Port %u: RX - %u, TX - %u, Drop - %u\n", (unsigned)p_num,
         pstats[p_num].rx, pstats[p_num].tx, pstats[p_num].drop);
   }
+#ifndef EVAL_PERF
+  WV_Profile total;
+  memset(&total, 0, sizeof(total));
+  RTE_LCORE_FOREACH(i) {
+    if (dpdk_users[i].runtime == NULL)
+      continue;
+    printf("Lcore %u: ", i);
+    WV_ProfileSummaryPrint(WV_GetProfile(dpdk_users[i].runtime));
+    WV_ProfileMerge(&total, WV_GetProfile(dpdk_users[i].runtime));
+    WV_StageProfilePrint(dpdk_users[i].runtime);
+  }
+  printf("All lcores: ");
+  WV_ProfileSummaryPrint(&total);
+#endif
+  if (metrics_path != NULL)
+    write_metrics();
   exit(0);
 }
 
@@ -133,6 +207,8 @@ smp_parse_args(int argc, char **argv)
   static struct option lgopts[] = {
       {PARAM_NUM_PROCS, 1, 0, 0},
       {PARAM_PROC_ID, 1, 0, 0},
+      {PARAM_RSS_HASH, 0, 0, 0},
+      {PARAM_METRICS, 1, 0, 0},
       {NULL, 0, 0, 0}
   };
 
@@ -151,6 +227,10 @@ smp_parse_args(int argc, char **argv)
         num_procs = atoi(optarg);
       else if (strncmp(lgopts[option_index].name, PARAM_PROC_ID, 7) == 0)
         proc_id = atoi(optarg);
+      else if (strcmp(lgopts[option_index].name, PARAM_RSS_HASH) == 0)
+        use_rss_hash = 1;
+      else if (strcmp(lgopts[option_index].name, PARAM_METRICS) == 0)
+        metrics_path = optarg;
       break;
 
     default:
@@ -179,7 +259,9 @@ smp_parse_args(int argc, char **argv)
   return ret;
 }
 
-static uint8_t seed[40] = {
+/* WV_RSS_KEY_WORD repeated, runtime hashes packets without RSS hash with the
+ * same key in software */
+static uint8_t seed[WV_RSS_KEY_LENGTH] = {
   0x6D, 0x5A, 0x6D, 0x5A, 0x6D, 0x5A, 0x6D, 0x5A,
   0x6D, 0x5A, 0x6D, 0x5A, 0x6D, 0x5A, 0x6D, 0x5A,
   0x6D, 0x5A, 0x6D, 0x5A, 0x6D, 0x5A, 0x6D, 0x5A,
@@ -370,6 +452,7 @@ assign_ports_to_cores(void)
   RTE_LCORE_FOREACH(i) {
     lcore_ports[i].start_port = ports_assigned;
     lcore_ports[i].num_ports = pairs_per_lcore * 2;
+    lcore_ports[i].queue = (uint16_t)proc_id;
     if (extra_pairs > 0) {
       lcore_ports[i].num_ports += 2;
       extra_pairs--;
@@ -377,50 +460,82 @@ assign_ports_to_cores(void)
     ports_assigned += lcore_ports[i].num_ports;
   }
 #else
+  unsigned index = 0;
   RTE_LCORE_FOREACH(i) {
     lcore_ports[i].start_port = 0;
     lcore_ports[i].num_ports = num_ports;
+    lcore_ports[i].queue = (uint16_t)(proc_id * lcores + index);
+    index++;
   }
 #endif
 }
 
 
-/* DPDKUser */
-typedef struct {
-    WV_Runtime *runtime;
-    unsigned port;
-} DPDKUser;
-
-DPDKUser* dpdk_user;
-
-unsigned long pkt_id = 0;
-unsigned long long pkt_vol = 0;
-struct timeval now;
-struct timeval milestone;
-#define PERF_AVG_NUM 5
-double throughputs[PERF_AVG_NUM];
-double peak_throught = -1;
-
 static void
-print_avg_throughput()
+print_avg_throughput(DPDKUser *user)
 {
+  double *throughputs = user->throughputs;
 	double total = 0.0;
 	int i;
 	int r = 0;
 	for (i=0; i<PERF_AVG_NUM; i++) {
 		if (throughputs[i] <= 0) {
-      peak_throught = -1;
+      user->peak_throught = -1;
       continue;
     }
 		r++;
 		total += throughputs[i];
-    if (throughputs[i] > peak_throught) {
-      peak_throught = throughputs[i];
+    if (throughputs[i] > user->peak_throught) {
+      user->peak_throught = throughputs[i];
     }
 	}
 	const unsigned id = rte_lcore_id();
 	printf("Lcore %d, Throughput: %lf Gbps (last %d avg.) Peak: %lf\n", 
-    id, (double)total/r, r, peak_throught);
+    id, (double)total/r, r, user->peak_throught);
+}
+
+/* RSS hash of mbuf if it is the one of runtime/rss.h, i.e. over address and
+ * port pair of an unfragmented IPv4 TCP/UDP/SCTP packet. Fragments are hashed
+ * over address pair only if at all, so NULL is returned for them and the
+ * runtime hashes the reassembled datagram itself */
+static inline const WV_U32 *
+rss_hash(const struct rte_mbuf *m, uint64_t rss_hf)
+{
+  const unsigned char *data = rte_pktmbuf_mtod(m, const unsigned char *);
+  const uint32_t length = rte_pktmbuf_data_len(m);
+  uint32_t offset = 14;
+  uint16_t ether_type;
+  uint64_t type;
+
+  if (!(m->ol_flags & PKT_RX_RSS_HASH) || length < offset + 20)
+    return NULL;
+  ether_type = data[12] << 8 | data[13];
+  if (ether_type == 0x8100) {
+    offset = 18;
+    if (length < offset + 20)
+      return NULL;
+    ether_type = data[16] << 8 | data[17];
+  }
+  if (ether_type != 0x0800)
+    return NULL;
+  const unsigned char *ip = data + offset;
+  /* more fragments flag or fragment offset */
+  if ((ip[6] & 0x3f) || ip[7])
+    return NULL;
+  switch (ip[9]) {
+  case IPPROTO_TCP:
+    type = ETH_RSS_NONFRAG_IPV4_TCP;
+    break;
+  case IPPROTO_UDP:
+    type = ETH_RSS_NONFRAG_IPV4_UDP;
+    break;
+  case IPPROTO_SCTP:
+    type = ETH_RSS_NONFRAG_IPV4_SCTP;
+    break;
+  default:
+    return NULL;
+  }
+  return (rss_hf & type) ? &m->hash.rss : NULL;
 }
 
 /* Main function used by the processing threads.
@@ -433,7 +548,8 @@ lcore_main(__attribute__((unused)) void *arg1)
   const unsigned id = rte_lcore_id();
   const unsigned start_port = lcore_ports[id].start_port;
   const unsigned end_port = start_port + lcore_ports[id].num_ports;
-  const uint16_t q_id = (uint16_t)proc_id;
+  const uint16_t q_id = lcore_ports[id].queue;
+  DPDKUser *user = &dpdk_users[id];
   unsigned p, i;
   char msgbuf[256];
   int msgbufpos = 0;
@@ -442,9 +558,24 @@ lcore_main(__attribute__((unused)) void *arg1)
     printf("Lcore %u has nothing to do\n", id);
     return 0;
   }
+
+  /* allocated from the lcore itself so that rte_malloc picks the local socket */
+  if (!(user->runtime = WV_AllocRuntime())) {
+    printf("Lcore %u runtime initialization fail\n", id);
+    return -1;
+  }
   
-  memset(throughputs, 0, sizeof(double)*PERF_AVG_NUM);
+  memset(user->throughputs, 0, sizeof(double)*PERF_AVG_NUM);
+  user->peak_throught = -1;
   int perf_index = 0;
+  struct timeval now;
+  const uint64_t tsc_hz = rte_get_tsc_hz();
+  uint64_t metrics_next_tsc = 0;
+#ifdef EVAL_PERF
+  gettimeofday(&user->milestone, NULL);
+#else
+  WV_ProfileStart(WV_GetProfile(user->runtime));
+#endif
 
   /* build up message in msgbuf before printing to decrease likelihood
    * of multi-core message interleaving.
@@ -477,36 +608,43 @@ lcore_main(__attribute__((unused)) void *arg1)
 
       /* handle each of the recieved packets */
       uint16_t j;
+      WV_ByteSlice packets[PKT_BURST];
+      WV_U8 status[PKT_BURST];
+      const WV_U32 *hashes[PKT_BURST];
       for (j = 0 ;j < rx_c; j++) {
           struct rte_mbuf* cur_buf = buf[j];
 #ifdef EVAL_PERF
-          pkt_vol += rte_pktmbuf_pkt_len(cur_buf);
-      	  if (pkt_id++ > 5000000) {
+          user->pkt_vol += rte_pktmbuf_pkt_len(cur_buf);
+      	  if (user->pkt_id++ > 5000000) {
       	    gettimeofday(&now, NULL);
-  					time_t s = now.tv_sec - milestone.tv_sec;
-  					suseconds_t u = s * 1000000 + now.tv_usec - milestone.tv_usec;
-  					double throughput = (double)8000000*pkt_vol/(u*1000*1000*1000);
+  					time_t s = now.tv_sec - user->milestone.tv_sec;
+  					suseconds_t u = s * 1000000 + now.tv_usec - user->milestone.tv_usec;
+  					double throughput = (double)8000000*user->pkt_vol/(u*1000*1000*1000);
   					// printf("time: %luus, pkt: %lu, vol: %lld, ", u, pkt_id, pkt_vol);
-  					throughputs[perf_index] = throughput;
-  					print_avg_throughput();
+  					user->throughputs[perf_index] = throughput;
+  					print_avg_throughput(user);
   					// printf("Lcore %d, Throughput: %lfGbps\n", id, throughput);
-  					milestone.tv_sec = now.tv_sec;
-  					milestone.tv_usec = now.tv_usec;
-  					pkt_id = 0;
-  					pkt_vol = 0;
+  					user->milestone.tv_sec = now.tv_sec;
+  					user->milestone.tv_usec = now.tv_usec;
+  					user->pkt_id = 0;
+  					user->pkt_vol = 0;
   					perf_index = (perf_index+1) % PERF_AVG_NUM;
   				}
 #endif
-          unsigned char* pkt_buf = rte_pktmbuf_mtod(cur_buf, unsigned char*);
-          unsigned pkt_len = rte_pktmbuf_pkt_len(cur_buf);
+          packets[j].cursor = rte_pktmbuf_mtod(cur_buf, unsigned char*);
+          packets[j].length = rte_pktmbuf_pkt_len(cur_buf);
+          hashes[j] = rss_hash(cur_buf, port_rss_hf[src]);
+      }
 
-          WV_Runtime *runtime = dpdk_user->runtime;
-          WV_ByteSlice packet = { .cursor = pkt_buf, .length = pkt_len };
-          WV_U8 status = WV_ProcessPacket(packet, runtime);
+      WV_Runtime *runtime = user->runtime;
+      /* one clock read for the whole burst, TSC is constant and monotonic */
+      WV_ProcessBurst(packets, rx_c, status, use_rss_hash ? hashes : NULL,
+          rte_rdtsc() / tsc_hz, runtime);
 #ifndef EVAL_PERF
-          WV_ProfileRecord(WV_GetProfile(runtime), pkt_len, status);
-#endif
+      for (j = 0 ;j < rx_c; j++) {
+          WV_ProfileRecord(WV_GetProfile(runtime), packets[j].length, status[j]);
       }
+#endif
 
 #ifdef FWD
       const uint16_t tx_c = rte_eth_tx_burst(dst, q_id, buf, rx_c);
@@ -522,6 +660,12 @@ lcore_main(__attribute__((unused)) void *arg1)
       }
 #endif
     }
+
+    if (metrics_path != NULL && id == metrics_lcore &&
+        rte_rdtsc() >= metrics_next_tsc) {
+      write_metrics();
+      metrics_next_tsc = rte_rdtsc() + tsc_hz;
+    }
   }
 }
 
@@ -622,39 +766,43 @@ main(int argc, char **argv)
 
   if (num_ports & 1)
     rte_exit(EXIT_FAILURE, "Application must use an even number of ports\n");
+#ifndef FWD
+  /* every lcore polls all ports, each from its own queue */
+  queues_per_proc = (uint16_t)rte_eal_get_configuration()->lcore_count;
+#endif
   for(i = 0; i < num_ports; i++){
     if(proc_type == RTE_PROC_PRIMARY)
-      if (smp_port_init(ports[i], mp, (uint16_t)num_procs) < 0)
+      if (smp_port_init(ports[i], mp, (uint16_t)(num_procs * queues_per_proc)) < 0)
         rte_exit(EXIT_FAILURE, "Error initialising ports\n");
   }
 
   if (proc_type == RTE_PROC_PRIMARY)
     check_all_ports_link_status((uint8_t)num_ports, (~0x0));
 
+  /* hash types may be narrowed by hardware support, read back what is set */
+  for (i = 0; i < num_ports && use_rss_hash; i++) {
+    struct rte_eth_rss_conf rss_conf = { .rss_key = NULL };
+    if (rte_eth_dev_rss_hash_conf_get(ports[i], &rss_conf) == 0)
+      port_rss_hf[ports[i]] = rss_conf.rss_hf;
+  }
+
   assign_ports_to_cores();
+  RTE_LCORE_FOREACH(i) {
+    if (lcore_ports[i].num_ports != 0) {
+      metrics_lcore = i;
+      break;
+    }
+  }
 
   RTE_LOG(INFO, APP, "Finished Process Init.\n");
 
-  /* initial Rubik runtime */
-  WV_Runtime *runtime;
-  if (!(runtime = WV_AllocRuntime())) {
-      fprintf(stderr, "runtime initialization fail\n");
-      return 1;
-  }
+  /* initial Rubik, runtimes are allocated by each lcore */
+  WV_Setup();
 
 // #ifdef STRING_FINDER
 //   init_pcre();
 // #endif
 
-  DPDKUser user = { .runtime = runtime, .port = 0 };
-  dpdk_user = &user;
-  
-#ifdef EVAL_PERF
-  gettimeofday(&milestone, NULL);
-#else
-  WV_ProfileStart(WV_GetProfile(runtime));
-#endif
-
 #ifdef FWD
   printf("Running with Forwarding\n");
 #else
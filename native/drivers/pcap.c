@@ -2,6 +2,9 @@
 #include <signal.h>
 #include <stdlib.h>
 #include <string.h>
+#include <pthread.h>
+#include <sched.h>
+#include <time.h>
 
 #include <pcap.h>
 #include <weaver.h>
@@ -17,27 +20,276 @@ void ctrl_c_handler(int sig) {
     ctrl_c = 1;
 }
 
+#define PKT_BURST 32
+
+#define PKT_MAX_WORKERS 64
+// slots of each worker's ring, must be a power of two, a ring has fewer slots
+// when its data would take more than PKT_RING_BYTES
+#define PKT_RING_SIZE 1024
+#define PKT_RING_BYTES (16 << 20)
+
+// data of every slot takes snapshot length of the capture, so that packets are
+// never truncated
+typedef struct {
+    WV_Byte *data;
+    WV_U32 caplen;
+    WV_U32 length;
+    WV_U64 now;
+    // RSS hash that NIC would give, taken by reader like a NIC does
+    WV_U32 hash;
+    WV_U8 hashed;
+} PcapSlot;
+
+// single-producer single-consumer ring, the reader thread pushes to head and
+// one worker consumes from tail
+typedef struct {
+    WV_U64 head __attribute__((aligned(64)));
+    WV_U64 tail __attribute__((aligned(64)));
+    WV_U64 mask;  // slot count - 1
+    WV_Byte *data;
+    PcapSlot slots[PKT_RING_SIZE];
+} PcapRing;
+
+typedef struct {
+    pthread_t thread;
+    WV_Runtime *runtime;
+    PcapRing *ring;
+} PcapWorker;
+
+// set by reader after its last push
+WV_U8 reader_done = 0;
+
+// metrics of all runtimes are written every second by the reader, and once more
+// at shut down
+char *metrics_path = NULL;
+
 typedef struct {
     WV_Runtime *runtime;
     pcap_t *pcap;
+    // dispatch to workers instead of processing when worker_count > 0
+    PcapWorker *workers;
+    WV_U32 worker_count;
+    // libpcap reuses its buffer between callbacks, so a burst is copied out,
+    // each packet takes snapshot length
+    WV_Byte *burst_data;
+    WV_U32 snaplen;
+    // captured longer than snapshot length, which a well-formed file never is
+    WV_U64 truncated_count;
+    WV_ByteSlice burst[PKT_BURST];
+    WV_U32 burst_length[PKT_BURST];
+    WV_U32 burst_hash[PKT_BURST];
+    const WV_U32 *burst_hash_ref[PKT_BURST];  // NULL for packet without hash
+    WV_U16 burst_count;
+    // runtime clock follows capture time, shifted forward whenever capture
+    // time goes backward, e.g. when the file is replayed again
+    WV_U64 now;
+    WV_U64 clock_offset;
+    WV_U64 packet_count;
+    time_t metrics_next_sec;
 } PcapUser;
 
-void proc(WV_Byte *user, const struct pcap_pkthdr *pcap_header, const WV_Byte *pcap_data) {
-    WV_Runtime *runtime = ((PcapUser *)user)->runtime;
-    WV_ByteSlice packet = { .cursor = pcap_data, .length = pcap_header->len };
-    WV_U8 status = WV_ProcessPacket(packet, runtime);
-    WV_ProfileRecord(WV_GetProfile(runtime), pcap_header->len, status);
+WV_U64 tick(PcapUser *user, const struct pcap_pkthdr *pcap_header) {
+    WV_U64 now = pcap_header->ts.tv_sec + user->clock_offset;
+    if (now < user->now) {
+        user->clock_offset += user->now - now;
+        now = user->now;
+    }
+    return user->now = now;
+}
+
+void flush(PcapUser *user) {
+    WV_U8 status[PKT_BURST];
+    WV_ProcessBurst(user->burst, user->burst_count, status, user->burst_hash_ref, user->now, user->runtime);
+    for (WV_U16 i = 0; i < user->burst_count; i += 1) {
+        WV_ProfileRecord(WV_GetProfile(user->runtime), user->burst_length[i], status[i]);
+    }
+    user->burst_count = 0;
+}
+
+// murmur3 finalizer
+WV_U32 mix32(WV_U32 hash) {
+    hash ^= hash >> 16;
+    hash *= 0x85ebca6b;
+    hash ^= hash >> 13;
+    hash *= 0xc2b2ae35;
+    hash ^= hash >> 16;
+    return hash;
+}
+
+// symmetric hash of IPv4 address pair, protocol and TCP/UDP/SCTP port pair, so
+// both directions of a flow go to the same worker. Non-IPv4 packets go to
+// worker 0. Fragments fall back to the address pair: fragments after the first
+// carry no ports, and IP reassembly is keyed by addresses, so all fragments of
+// a datagram must meet on one worker. A flow whose segments are fragmented only
+// sometimes is therefore split between two workers
+WV_U32 flow_hash(const WV_Byte *data, WV_U32 caplen) {
+    WV_U32 offset = 14;
+    if (caplen < offset + 20) {
+        return 0;
+    }
+    WV_U16 ether_type = data[12] << 8 | data[13];
+    if (ether_type == 0x8100) {
+        offset = 18;
+        if (caplen < offset + 20) {
+            return 0;
+        }
+        ether_type = data[16] << 8 | data[17];
+    }
+    if (ether_type != 0x0800) {
+        return 0;
+    }
+    const WV_Byte *ip = data + offset;
+    WV_U32 saddr, daddr;
+    memcpy(&saddr, ip + 12, 4);
+    memcpy(&daddr, ip + 16, 4);
+    // address and port pairs are mixed separately, otherwise their varying
+    // bytes overlap and cancel out
+    WV_U32 hash = mix32(saddr ^ daddr);
+    WV_U8 protocol = ip[9];
+    WV_U32 ihl = (ip[0] & 0xf) * 4;
+    WV_U8 fragmented = (ip[6] & 0x3f) || ip[7];
+    if ((protocol == 6 || protocol == 17 || protocol == 132) && !fragmented &&
+        caplen >= offset + ihl + 4) {
+        WV_U16 sport, dport;
+        memcpy(&sport, ip + ihl, 2);
+        memcpy(&dport, ip + ihl + 2, 2);
+        hash = mix32(hash ^ ((WV_U32)protocol << 16 | (WV_U16)(sport ^ dport)));
+    }
+    return hash;
+}
+
+WV_U32 clamp_caplen(PcapUser *user, const struct pcap_pkthdr *pcap_header) {
+    if (pcap_header->caplen > user->snaplen) {
+        user->truncated_count += 1;
+        return user->snaplen;
+    }
+    return pcap_header->caplen;
+}
+
+void dispatch(PcapUser *user, const struct pcap_pkthdr *pcap_header, const WV_Byte *pcap_data) {
+    PcapRing *ring = user->workers[flow_hash(pcap_data, pcap_header->caplen) % user->worker_count].ring;
+    WV_U64 head = ring->head;
+    // wait for the worker instead of dropping, replay is not real time
+    while (head - __atomic_load_n(&ring->tail, __ATOMIC_ACQUIRE) == ring->mask + 1) {
+        sched_yield();
+    }
+    PcapSlot *slot = &ring->slots[head & ring->mask];
+    slot->caplen = clamp_caplen(user, pcap_header);
+    slot->length = pcap_header->len;
+    slot->now = tick(user, pcap_header);
+    memcpy(slot->data, pcap_data, slot->caplen);
+    slot->hashed = WV_RSSFrameHash(slot->data, slot->caplen, &slot->hash);
+    __atomic_store_n(&ring->head, head + 1, __ATOMIC_RELEASE);
+}
+
+void *worker_main(void *worker_data) {
+    PcapWorker *worker = (PcapWorker *)worker_data;
+    PcapRing *ring = worker->ring;
+    WV_Profile *profile = WV_GetProfile(worker->runtime);
+    WV_ByteSlice burst[PKT_BURST];
+    const WV_U32 *hashes[PKT_BURST];
+    WV_U8 status[PKT_BURST];
+    WV_ProfileStart(profile);
+    for (;;) {
+        WV_U64 tail = ring->tail;
+        // load done flag before head, so that every push is seen once it is set
+        WV_U8 done = __atomic_load_n(&reader_done, __ATOMIC_ACQUIRE);
+        WV_U64 head = __atomic_load_n(&ring->head, __ATOMIC_ACQUIRE);
+        if (head == tail) {
+            if (done) {
+                break;
+            }
+            sched_yield();
+            continue;
+        }
+        // slots are processed in place and released after the whole burst
+        WV_U16 count = head - tail < PKT_BURST ? head - tail : PKT_BURST;
+        for (WV_U16 i = 0; i < count; i += 1) {
+            PcapSlot *slot = &ring->slots[(tail + i) & ring->mask];
+            burst[i] = (WV_ByteSlice){ .cursor = slot->data, .length = slot->caplen };
+            hashes[i] = slot->hashed ? &slot->hash : NULL;
+        }
+        WV_U64 now = ring->slots[(tail + count - 1) & ring->mask].now;
+        WV_ProcessBurst(burst, count, status, hashes, now, worker->runtime);
+        for (WV_U16 i = 0; i < count; i += 1) {
+            WV_ProfileRecord(profile, ring->slots[(tail + i) & ring->mask].length, status[i]);
+        }
+        __atomic_store_n(&ring->tail, tail + count, __ATOMIC_RELEASE);
+    }
+    return NULL;
+}
+
+// worker runtimes are read while they run, so the snapshot is approximate
+void write_metrics(PcapUser *user) {
+    WV_Metrics total, metrics;
+    memset(&total, 0, sizeof(total));
+    if (!user->worker_count) {
+        WV_GetMetrics(user->runtime, &total);
+    }
+    for (WV_U32 i = 0; i < user->worker_count; i += 1) {
+        WV_GetMetrics(user->workers[i].runtime, &metrics);
+        WV_MetricsMerge(&total, &metrics);
+    }
+    if (WV_MetricsWrite(&total, metrics_path)) {
+        fprintf(stderr, "metrics write fail: %s\n", metrics_path);
+    }
+}
+
+void tick_metrics(PcapUser *user) {
+    user->packet_count += 1;
+    if (metrics_path == NULL || user->packet_count % PKT_BURST != 0) {
+        return;
+    }
+    time_t sec = time(NULL);
+    if (sec >= user->metrics_next_sec) {
+        write_metrics(user);
+        user->metrics_next_sec = sec + 1;
+    }
+}
+
+void proc(WV_Byte *user_data, const struct pcap_pkthdr *pcap_header, const WV_Byte *pcap_data) {
+    PcapUser *user = (PcapUser *)user_data;
+    if (user->worker_count) {
+        dispatch(user, pcap_header, pcap_data);
+        tick_metrics(user);
+        if (ctrl_c) {
+            pcap_breakloop(user->pcap);
+        }
+        return;
+    }
+    tick(user, pcap_header);
+    WV_U32 caplen = clamp_caplen(user, pcap_header);
+    WV_Byte *data = user->burst_data + (size_t)user->burst_count * user->snaplen;
+    memcpy(data, pcap_data, caplen);
+    user->burst[user->burst_count] = (WV_ByteSlice){ .cursor = data, .length = caplen };
+    user->burst_length[user->burst_count] = pcap_header->len;
+    WV_U32 *hash = &user->burst_hash[user->burst_count];
+    user->burst_hash_ref[user->burst_count] = WV_RSSFrameHash(data, caplen, hash) ? hash : NULL;
+    user->burst_count += 1;
+    if (user->burst_count == PKT_BURST) {
+        flush(user);
+    }
+    tick_metrics(user);
     if (ctrl_c) {
-        pcap_breakloop(((PcapUser *)user)->pcap);
+        pcap_breakloop(user->pcap);
     }
 }
 
 int main(int argc, char *argv[]) {
     char *pcap_filename = NULL;
     WV_U8 no_loop = 0;
+    WV_U32 worker_count = 0;
     for (int i = 1; i < argc; i += 1) {
         if (strcmp(argv[i], "--noloop") == 0) {
             no_loop = 1;
+        } else if (strcmp(argv[i], "--workers") == 0 && i + 1 < argc) {
+            worker_count = atoi(argv[++i]);
+            if (worker_count > PKT_MAX_WORKERS) {
+                fprintf(stderr, "at most %d workers\n", PKT_MAX_WORKERS);
+                return 1;
+            }
+        } else if (strcmp(argv[i], "--metrics") == 0 && i + 1 < argc) {
+            metrics_path = argv[++i];
         } else {
             pcap_filename = argv[i];
         }
@@ -47,8 +299,10 @@ int main(int argc, char *argv[]) {
         return 0;
     }
 
-    WV_Runtime *runtime;
-    if (!(runtime = WV_AllocRuntime())) {
+    // every worker owns a runtime, the main thread only reads in that case
+    static PcapWorker workers[PKT_MAX_WORKERS];
+    WV_Runtime *runtime = NULL;
+    if (!worker_count && !(runtime = WV_AllocRuntime())) {
         fprintf(stderr, "runtime initialization fail\n");
         return 1;
     }
@@ -59,14 +313,59 @@ int main(int argc, char *argv[]) {
         fprintf(stderr, "pcap_open_offline: %s\n", errbuf);
         return 1;
     }
+    static PcapUser user;
+    user.snaplen = pcap_snapshot(pcap_packets) > 0 ? pcap_snapshot(pcap_packets) : 65535;
+    user.truncated_count = 0;
+    if (!worker_count && !(user.burst_data = malloc((size_t)PKT_BURST * user.snaplen))) {
+        fprintf(stderr, "burst allocation fail\n");
+        return 1;
+    }
 
-    PcapUser user = { .runtime = runtime, .pcap = pcap_packets };
+    WV_U64 slot_count = PKT_RING_SIZE;
+    while (slot_count > PKT_BURST && slot_count * user.snaplen > PKT_RING_BYTES) {
+        slot_count /= 2;
+    }
+    for (WV_U32 i = 0; i < worker_count; i += 1) {
+        if (!(workers[i].runtime = WV_AllocRuntime())) {
+            fprintf(stderr, "runtime initialization fail\n");
+            return 1;
+        }
+        PcapRing *ring = workers[i].ring = calloc(1, sizeof(PcapRing));
+        if (!ring || !(ring->data = malloc(slot_count * user.snaplen))) {
+            fprintf(stderr, "ring allocation fail\n");
+            return 1;
+        }
+        ring->mask = slot_count - 1;
+        for (WV_U64 j = 0; j < slot_count; j += 1) {
+            ring->slots[j].data = ring->data + j * user.snaplen;
+        }
+    }
+
+    user.runtime = runtime;
+    user.pcap = pcap_packets;
+    user.workers = workers;
+    user.worker_count = worker_count;
+    user.burst_count = 0;
+    user.now = user.clock_offset = 0;
+    user.packet_count = 0;
+    user.metrics_next_sec = 0;
 
     signal(SIGINT, ctrl_c_handler);
     WV_Setup();
-    WV_ProfileStart(WV_GetProfile(runtime));
+    if (!worker_count) {
+        WV_ProfileStart(WV_GetProfile(runtime));
+    }
+    for (WV_U32 i = 0; i < worker_count; i += 1) {
+        if (pthread_create(&workers[i].thread, NULL, worker_main, &workers[i])) {
+            fprintf(stderr, "worker creation fail\n");
+            return 1;
+        }
+    }
     for (;;) {
         pcap_loop(pcap_packets, -1, proc, (void *)&user);
+        if (!worker_count) {
+            flush(&user);
+        }
         pcap_close(pcap_packets);
         if (ctrl_c || no_loop) {
             break;
@@ -76,12 +375,51 @@ int main(int argc, char *argv[]) {
             fprintf(stderr, "pcap_open_offline: %s\n", errbuf);
             return 1;
         }
+        user.pcap = pcap_packets;
     }
 
-    WV_ProfileRecordPrint(WV_GetProfile(runtime));
-    if (WV_FreeRuntime(runtime)) {
-        fprintf(stderr, "runtime cleanup fail\n");
-        return 1;
+    if (!worker_count) {
+        WV_ProfileRecordPrint(WV_GetProfile(runtime));
+        WV_StageProfilePrint(runtime);
+        if (metrics_path != NULL) {
+            write_metrics(&user);
+        }
+        if (WV_FreeRuntime(runtime)) {
+            fprintf(stderr, "runtime cleanup fail\n");
+            return 1;
+        }
+    }
+
+    __atomic_store_n(&reader_done, 1, __ATOMIC_RELEASE);
+    WV_Profile total;
+    memset(&total, 0, sizeof(total));
+    for (WV_U32 i = 0; i < worker_count; i += 1) {
+        pthread_join(workers[i].thread, NULL);
+    }
+    if (worker_count && metrics_path != NULL) {
+        write_metrics(&user);
+    }
+    for (WV_U32 i = 0; i < worker_count; i += 1) {
+        printf("worker %u: ", i);
+        WV_ProfileSummaryPrint(WV_GetProfile(workers[i].runtime));
+        WV_ProfileMerge(&total, WV_GetProfile(workers[i].runtime));
+        WV_StageProfilePrint(workers[i].runtime);
+        if (WV_FreeRuntime(workers[i].runtime)) {
+            fprintf(stderr, "runtime cleanup fail\n");
+            return 1;
+        }
+        free(workers[i].ring->data);
+        free(workers[i].ring);
+    }
+    if (worker_count) {
+        printf("all workers: ");
+        WV_ProfileSummaryPrint(&total);
+    }
+
+    free(user.burst_data);
+    if (user.truncated_count) {
+        fprintf(stderr, "%llu packets truncated to snapshot length %u\n",
+            (unsigned long long)user.truncated_count, user.snaplen);
     }
 
     printf("shut down correctly\n");
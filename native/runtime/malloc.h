@@ -5,12 +5,15 @@
 #include <rte_malloc.h>
 #include <rte_memcpy.h>
 #define WV_Malloc(n) rte_malloc(NULL, n, 0)
+#define WV_MallocAligned(n) rte_malloc(NULL, n, 0)  // aligned to cache line already
 #define WV_Free rte_free
 #define WV_Memcpy rte_memcpy
 #else
 #include <stdlib.h>
 #include <string.h>
 #define WV_Malloc malloc
+// aligned to cache line, size must be multiple of 64
+#define WV_MallocAligned(n) aligned_alloc(64, n)
 #define WV_Free free
 #define WV_Memcpy memcpy
 #endif
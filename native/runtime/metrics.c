@@ -0,0 +1,122 @@
+#include "metrics.h"
+#include <stdio.h>
+#include <string.h>
+#include <time.h>
+
+WV_U8 WV_MetricsMerge(WV_Metrics* total, const WV_Metrics* metrics)
+{
+    total->packet_count += metrics->packet_count;
+    total->byte_count += metrics->byte_count;
+    if (total->layer_count < metrics->layer_count) {
+        for (WV_U32 i = total->layer_count; i < metrics->layer_count; i += 1) {
+            memset(&total->layers[i], 0, sizeof(WV_LayerMetrics));
+            memcpy(total->layers[i].name, metrics->layers[i].name, WV_METRICS_NAME_SIZE);
+        }
+        total->layer_count = metrics->layer_count;
+    }
+    for (WV_U32 i = 0; i < metrics->layer_count; i += 1) {
+        WV_LayerMetrics* layer = &total->layers[i];
+        const WV_LayerMetrics* other = &metrics->layers[i];
+        layer->instance_count += other->instance_count;
+        layer->inst.create_count += other->inst.create_count;
+        layer->inst.destroy_count += other->inst.destroy_count;
+        layer->inst.expire_count += other->inst.expire_count;
+        layer->inst.evict_count += other->inst.evict_count;
+        layer->inst.reject_count += other->inst.reject_count;
+        layer->seq.retex_count += other->seq.retex_count;
+        layer->seq.overlap_count += other->seq.overlap_count;
+        layer->seq.out_of_window_count += other->seq.out_of_window_count;
+        layer->seq.buffer_exceed_count += other->seq.buffer_exceed_count;
+        layer->seq.buffer_byte_count += other->seq.buffer_byte_count;
+    }
+    return 0;
+}
+
+#define LAYER_FIELD_COUNT 11
+
+static const char* layer_fields[LAYER_FIELD_COUNT] = {
+    "instance_count", "create_count", "destroy_count", "expire_count", "evict_count", "reject_count",
+    "retex_count", "overlap_count", "out_of_window_count", "buffer_exceed_count", "buffer_byte_count"
+};
+
+static void layer_values(const WV_LayerMetrics* layer, unsigned long long* values)
+{
+    const WV_U64 fields[LAYER_FIELD_COUNT] = {
+        layer->instance_count,
+        layer->inst.create_count,
+        layer->inst.destroy_count,
+        layer->inst.expire_count,
+        layer->inst.evict_count,
+        layer->inst.reject_count,
+        layer->seq.retex_count,
+        layer->seq.overlap_count,
+        layer->seq.out_of_window_count,
+        layer->seq.buffer_exceed_count,
+        layer->seq.buffer_byte_count,
+    };
+    for (WV_U32 j = 0; j < LAYER_FIELD_COUNT; j += 1) {
+        values[j] = fields[j];
+    }
+}
+
+static void write_json(const WV_Metrics* metrics, WV_F time, FILE* file)
+{
+    unsigned long long values[LAYER_FIELD_COUNT];
+    fprintf(file, "{\"time\": %.3f, \"packet_count\": %llu, \"byte_count\": %llu, \"layers\": [", time,
+        (unsigned long long)metrics->packet_count, (unsigned long long)metrics->byte_count);
+    for (WV_U32 i = 0; i < metrics->layer_count; i += 1) {
+        layer_values(&metrics->layers[i], values);
+        fprintf(file, "%s\n  {\"name\": \"%s\"", i ? "," : "", metrics->layers[i].name);
+        for (WV_U32 j = 0; j < LAYER_FIELD_COUNT; j += 1) {
+            fprintf(file, ", \"%s\": %llu", layer_fields[j], values[j]);
+        }
+        fprintf(file, "}");
+    }
+    fprintf(file, "\n]}\n");
+}
+
+// one row per layer, packet and byte counts are repeated on every row
+static void write_csv(const WV_Metrics* metrics, WV_F time, FILE* file)
+{
+    unsigned long long values[LAYER_FIELD_COUNT];
+    fprintf(file, "time,packet_count,byte_count,layer");
+    for (WV_U32 j = 0; j < LAYER_FIELD_COUNT; j += 1) {
+        fprintf(file, ",%s", layer_fields[j]);
+    }
+    fprintf(file, "\n");
+    for (WV_U32 i = 0; i < metrics->layer_count; i += 1) {
+        layer_values(&metrics->layers[i], values);
+        fprintf(file, "%.3f,%llu,%llu,%s", time, (unsigned long long)metrics->packet_count,
+            (unsigned long long)metrics->byte_count, metrics->layers[i].name);
+        for (WV_U32 j = 0; j < LAYER_FIELD_COUNT; j += 1) {
+            fprintf(file, ",%llu", values[j]);
+        }
+        fprintf(file, "\n");
+    }
+}
+
+WV_U8 WV_MetricsWrite(const WV_Metrics* metrics, const char* path)
+{
+    char temp_path[4096];
+    if (snprintf(temp_path, sizeof(temp_path), "%s.tmp", path) >= (int)sizeof(temp_path)) {
+        return 1;
+    }
+    FILE* file = fopen(temp_path, "w");
+    if (file == NULL) {
+        return 1;
+    }
+    struct timespec ts;
+    clock_gettime(CLOCK_REALTIME, &ts);
+    WV_F time = ts.tv_sec + ts.tv_nsec / 1e9;
+    size_t length = strlen(path);
+    if (length >= 4 && strcmp(path + length - 4, ".csv") == 0) {
+        write_csv(metrics, time, file);
+    } else {
+        write_json(metrics, time, file);
+    }
+    if (fclose(file) != 0) {
+        remove(temp_path);
+        return 1;
+    }
+    return rename(temp_path, path) != 0;
+}
@@ -0,0 +1,55 @@
+#ifndef WEAVER_RUNTIME_METRICS_H
+#define WEAVER_RUNTIME_METRICS_H
+
+#include "types.h"
+
+// counters are plain integers owned by the thread driving a runtime, readers
+// on other threads get approximate but never torn values on 64-bit targets
+
+// instance lifecycle of a layer, counted by blackbox
+typedef struct {
+    WV_U64 create_count;
+    WV_U64 destroy_count;  // including expired and evicted ones
+    WV_U64 expire_count;
+    WV_U64 evict_count;
+    WV_U64 reject_count;  // not created because layer is full
+} WV_InstanceCounter;
+
+// events of every sequence sharing a pool, counted before the handler is
+// called, and bytes of reassembly buffers currently held
+typedef struct {
+    WV_U64 retex_count;
+    WV_U64 overlap_count;
+    WV_U64 out_of_window_count;
+    WV_U64 buffer_exceed_count;
+    WV_U64 buffer_byte_count;
+} WV_SeqCounter;
+
+#define WV_METRICS_MAX_LAYER 32
+#define WV_METRICS_NAME_SIZE 32
+
+typedef struct {
+    char name[WV_METRICS_NAME_SIZE];
+    WV_U64 instance_count;
+    WV_InstanceCounter inst;
+    WV_SeqCounter seq;
+} WV_LayerMetrics;
+
+// snapshot of a runtime, filled by WV_GetMetrics, only layers that keep
+// instances are listed
+typedef struct {
+    WV_U64 packet_count;
+    WV_U64 byte_count;
+    WV_U32 layer_count;
+    WV_LayerMetrics layers[WV_METRICS_MAX_LAYER];
+} WV_Metrics;
+
+// accumulate the snapshot of one runtime into another, layers are matched by
+// position since every runtime is generated from the same stack
+WV_U8 WV_MetricsMerge(WV_Metrics *, const WV_Metrics *);
+
+// write snapshot to path, as CSV if it ends with ".csv" otherwise JSON. File is
+// replaced by renaming, so a reader polling it never sees partial content
+WV_U8 WV_MetricsWrite(const WV_Metrics *, const char *);
+
+#endif
@@ -0,0 +1,96 @@
+#ifndef WEAVER_RUNTIME_POOL_H
+#define WEAVER_RUNTIME_POOL_H
+
+#include "types.h"
+#include "malloc.h"
+
+// objects are carved from cache line aligned chunks (hugepages on DPDK)
+// freed objects are kept in a free list for reuse, and chunks are only
+// returned to system when the pool is cleaned
+#ifndef WV_CONFIG_PoolChunkCount
+#define WV_CONFIG_PoolChunkCount 1024
+#endif
+
+// chunk is aligned and object size is rounded up to cache line, so no object
+// spans extra lines
+#define WV_POOL_ALIGN 64
+
+typedef struct _WV_PoolChunk {
+    struct _WV_PoolChunk *next;
+} WV_PoolChunk;
+
+typedef struct _WV_PoolObject {
+    struct _WV_PoolObject *next;
+} WV_PoolObject;
+
+typedef struct {
+    WV_PoolObject *free_list;
+    WV_PoolChunk *chunks;
+    WV_U32 object_size;
+    WV_U32 chunk_count;  // objects allocated by each growth
+} WV_Pool;
+
+static inline WV_U8 _PoolGrow(WV_Pool *pool, WV_U32 count)
+{
+    WV_PoolChunk *chunk = WV_MallocAligned(WV_POOL_ALIGN + (size_t)pool->object_size * count);
+    if (chunk == NULL) {
+        return 1;
+    }
+    chunk->next = pool->chunks;
+    pool->chunks = chunk;
+    WV_Byte *objects = (WV_Byte *)chunk + WV_POOL_ALIGN;
+    // link backward so that objects are handed out in address order
+    for (WV_U32 i = count; i > 0; i -= 1) {
+        WV_PoolObject *object = (WV_PoolObject *)(objects + (size_t)pool->object_size * (i - 1));
+        object->next = pool->free_list;
+        pool->free_list = object;
+    }
+    return 0;
+}
+
+static inline WV_U8 WV_InitPool(WV_Pool *pool, WV_U32 object_size, WV_U32 prealloc_count)
+{
+    pool->free_list = NULL;
+    pool->chunks = NULL;
+    if (object_size < sizeof(WV_PoolObject)) {
+        object_size = sizeof(WV_PoolObject);
+    }
+    pool->object_size = (object_size + WV_POOL_ALIGN - 1) / WV_POOL_ALIGN * WV_POOL_ALIGN;
+    pool->chunk_count = WV_CONFIG_PoolChunkCount;
+    if (prealloc_count > 0) {
+        return _PoolGrow(pool, prealloc_count);
+    }
+    return 0;
+}
+
+// content of returned object is undefined, NULL if out of memory
+static inline WV_Any WV_PoolAlloc(WV_Pool *pool)
+{
+    if (pool->free_list == NULL && _PoolGrow(pool, pool->chunk_count)) {
+        return NULL;
+    }
+    WV_PoolObject *object = pool->free_list;
+    pool->free_list = object->next;
+    return object;
+}
+
+static inline WV_U8 WV_PoolFree(WV_Pool *pool, WV_Any object)
+{
+    ((WV_PoolObject *)object)->next = pool->free_list;
+    pool->free_list = object;
+    return 0;
+}
+
+// release every chunk, including objects that are not freed yet
+static inline WV_U8 WV_CleanPool(WV_Pool *pool)
+{
+    while (pool->chunks != NULL) {
+        WV_PoolChunk *chunk = pool->chunks;
+        pool->chunks = chunk->next;
+        WV_Free(chunk);
+    }
+    pool->free_list = NULL;
+    return 0;
+}
+
+#endif
@@ -3,29 +3,89 @@
 #include <string.h>
 #include <time.h>
 
+// wall clock instead of clock(), which is CPU time of the whole process and
+// counts every core when runtimes are driven by multiple threads
+static WV_F current_sec()
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+WV_U8 WV_HistogramMerge(WV_Histogram* total, const WV_Histogram* histogram)
+{
+    for (WV_U32 i = 0; i < WV_HISTOGRAM_BUCKET_COUNT; i += 1) {
+        total->counts[i] += histogram->counts[i];
+    }
+    total->total_count += histogram->total_count;
+    if (histogram->max > total->max) {
+        total->max = histogram->max;
+    }
+    return 0;
+}
+
+WV_U64 WV_HistogramPercentile(const WV_Histogram* histogram, WV_F quantile)
+{
+    if (histogram->total_count == 0) {
+        return 0;
+    }
+    WV_U64 rank = quantile * histogram->total_count;
+    if (rank < quantile * histogram->total_count || rank == 0) {
+        rank += 1;
+    }
+    WV_U64 count = 0;
+    for (WV_U32 i = 0; i < WV_HISTOGRAM_BUCKET_COUNT; i += 1) {
+        count += histogram->counts[i];
+        if (count < rank) {
+            continue;
+        }
+        if (i < WV_HISTOGRAM_SUB_COUNT) {
+            return i;
+        }
+        WV_U32 shift = i / WV_HISTOGRAM_SUB_COUNT - 1;
+        WV_U64 lowest = (WV_U64)(i % WV_HISTOGRAM_SUB_COUNT + WV_HISTOGRAM_SUB_COUNT) << shift;
+        WV_U64 highest = lowest + ((WV_U64)1 << shift) - 1;
+        return highest < histogram->max ? highest : histogram->max;
+    }
+    return histogram->max;
+}
+
+static void print_percentiles(const WV_Histogram* histogram)
+{
+    printf("latency p50/p99/p99.9: %llu/%llu/%llu cycles (max %llu)",
+        (unsigned long long)WV_HistogramPercentile(histogram, 0.5),
+        (unsigned long long)WV_HistogramPercentile(histogram, 0.99),
+        (unsigned long long)WV_HistogramPercentile(histogram, 0.999), (unsigned long long)histogram->max);
+}
+
 WV_U8 WV_ProfileStart(WV_Profile* profile)
 {
     memset(profile, 0, sizeof(WV_Profile));
-    WV_F current = clock() / CLOCKS_PER_SEC;
+    WV_F current = current_sec();
     profile->last_record_sec = current;
     profile->next_checkpoint_sec = (WV_U32)current + 1;
+    return 0;
 }
 
 WV_U8 WV_ProfileRecord(WV_Profile* profile, WV_U32 byte_length, WV_U8 status)
 {
     // TODO: use status
+    profile->total_byte_count += byte_length;
+    profile->total_packet_count += 1;
     profile->interval_byte_count += byte_length;
     profile->interval_packet_count += 1;
     if (profile->interval_packet_count % 1000000 != 0) {
         return 0;
     }
-    WV_F current = (WV_F)clock() / CLOCKS_PER_SEC;
+    WV_F current = current_sec();
     if (current < profile->next_checkpoint_sec) {
         return 0;
     }
 
     WV_ProfileRecordPrint(profile);
 
+    WV_HistogramMerge(&profile->latency, &profile->interval_latency);
+    memset(&profile->interval_latency, 0, sizeof(WV_Histogram));
     profile->interval_byte_count = 0;
     profile->interval_packet_count = 0;
     profile->next_checkpoint_sec = (WV_U32)current + 2;
@@ -35,7 +95,7 @@ WV_U8 WV_ProfileRecord(WV_Profile* profile, WV_U32 byte_length, WV_U8 status)
 
 WV_U8 WV_ProfileRecordPrint(WV_Profile* profile)
 {
-    WV_F current = (WV_F)clock() / CLOCKS_PER_SEC;
+    WV_F current = current_sec();
     WV_F interval = current - profile->last_record_sec;
     WV_F throughput = profile->interval_byte_count / interval / 1e9 * 8;
 
@@ -51,6 +111,92 @@ WV_U8 WV_ProfileRecordPrint(WV_Profile* profile)
     }
     throughput_avg /= count;
 
-    printf("checkpoint: %f ms, throughput: %f(%f) Gbps (last %d avg.)\n", current * 1000, throughput, throughput_avg, count);
+    printf("checkpoint: %f ms, throughput: %f(%f) Gbps (last %d avg.)", current * 1000, throughput, throughput_avg, count);
+    if (profile->interval_latency.total_count != 0) {
+        printf(", ");
+        print_percentiles(&profile->interval_latency);
+    }
+    printf("\n");
+    return 0;
+}
+
+WV_U8 WV_ProfileMerge(WV_Profile* total, const WV_Profile* profile)
+{
+    total->total_byte_count += profile->total_byte_count;
+    total->total_packet_count += profile->total_packet_count;
+    total->interval_byte_count += profile->interval_byte_count;
+    total->interval_packet_count += profile->interval_packet_count;
+    // checkpoints of different runtimes are not aligned, but every runtime
+    // records once per 2 seconds, so summing by slot approximates the total
+    for (WV_U8 i = 0; i < 10; i += 1) {
+        total->last_10_throughput[i] += profile->last_10_throughput[i];
+    }
+    if (profile->record_count > total->record_count) {
+        total->record_count = profile->record_count;
+    }
+    WV_HistogramMerge(&total->latency, &profile->latency);
+    WV_HistogramMerge(&total->interval_latency, &profile->interval_latency);
+    return 0;
+}
+
+WV_U8 WV_ProfileSummaryPrint(const WV_Profile* profile)
+{
+    WV_U8 count = 10;
+    if (count > profile->record_count) {
+        count = profile->record_count;
+    }
+    WV_F throughput_avg = 0;
+    for (WV_U8 i = 0; i < count; i += 1) {
+        throughput_avg += profile->last_10_throughput[i];
+    }
+    if (count != 0) {
+        throughput_avg /= count;
+    }
+
+    printf("total: %llu packets, %llu bytes, throughput: %f Gbps (last %d avg.)\n",
+        (unsigned long long)profile->total_packet_count, (unsigned long long)profile->total_byte_count,
+        throughput_avg, count);
+    // packets since last checkpoint are not folded yet
+    WV_Histogram latency = profile->latency;
+    WV_HistogramMerge(&latency, &profile->interval_latency);
+    if (latency.total_count != 0) {
+        print_percentiles(&latency);
+        printf("\n");
+    }
+    return 0;
+}
+
+WV_U8 WV_StagePrint(const WV_StageClock* clock, const WV_U64 (*cycles)[WV_STAGE_COUNT],
+    const WV_Histogram* latencies, WV_U32 layer_count, const char* const* layer_names)
+{
+    static const char* stage_names[WV_STAGE_COUNT] = { "parse", "instance", "sequence", "psm", "event", "other", "timer" };
+    WV_F packet_count = clock->packet_count ? clock->packet_count : 1;
+    WV_U64 stage_total[WV_STAGE_COUNT] = { 0 };
+    WV_U64 total = 0;
+
+    printf("stage cycles per packet (%llu packets)\n%-16s", (unsigned long long)clock->packet_count, "layer");
+    for (WV_U32 j = 0; j < WV_STAGE_COUNT; j += 1) {
+        printf("%10s", stage_names[j]);
+    }
+    printf("%10s%10s%10s%10s\n", "total", "p50", "p99", "p99.9");
+    for (WV_U32 i = 0; i < layer_count; i += 1) {
+        WV_U64 layer_total = 0;
+        printf("%-16s", layer_names[i]);
+        for (WV_U32 j = 0; j < WV_STAGE_COUNT; j += 1) {
+            printf("%10.1f", cycles[i][j] / packet_count);
+            layer_total += cycles[i][j];
+            stage_total[j] += cycles[i][j];
+        }
+        printf("%10.1f%10llu%10llu%10llu\n", layer_total / packet_count,
+            (unsigned long long)WV_HistogramPercentile(&latencies[i], 0.5),
+            (unsigned long long)WV_HistogramPercentile(&latencies[i], 0.99),
+            (unsigned long long)WV_HistogramPercentile(&latencies[i], 0.999));
+        total += layer_total;
+    }
+    printf("%-16s", "total");
+    for (WV_U32 j = 0; j < WV_STAGE_COUNT; j += 1) {
+        printf("%10.1f", stage_total[j] / packet_count);
+    }
+    printf("%10.1f\n", total / packet_count);
     return 0;
-}
\ No newline at end of file
+}
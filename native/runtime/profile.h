@@ -3,13 +3,58 @@
 
 #include "types.h"
 
+// log-bucketed histogram in the way of HdrHistogram, values below sub count are
+// exact, and each power-of-two range above is split into sub count buckets, so
+// a reported value is at most 1/16 larger than the recorded one
+#define WV_HISTOGRAM_SUB_BITS 4
+#define WV_HISTOGRAM_SUB_COUNT (1 << WV_HISTOGRAM_SUB_BITS)
+#define WV_HISTOGRAM_BUCKET_COUNT ((64 - WV_HISTOGRAM_SUB_BITS + 1) * WV_HISTOGRAM_SUB_COUNT)
+
+typedef struct {
+    WV_U64 counts[WV_HISTOGRAM_BUCKET_COUNT];
+    WV_U64 total_count;
+    WV_U64 max;
+} WV_Histogram;
+
+static inline void WV_HistogramRecord(WV_Histogram *histogram, WV_U64 value)
+{
+    WV_U32 index = value;
+    if (value >= WV_HISTOGRAM_SUB_COUNT) {
+        WV_U32 shift = 63 - __builtin_clzll(value) - WV_HISTOGRAM_SUB_BITS;
+        index = shift * WV_HISTOGRAM_SUB_COUNT + (WV_U32)(value >> shift);
+    }
+    histogram->counts[index] += 1;
+    histogram->total_count += 1;
+    if (value > histogram->max) {
+        histogram->max = value;
+    }
+}
+
+WV_U8 WV_HistogramMerge(WV_Histogram *, const WV_Histogram *);
+
+// highest value equivalent to the bucket that the quantile (0 to 1) falls in, 0
+// if histogram is empty
+WV_U64 WV_HistogramPercentile(const WV_Histogram *, WV_F);
+
+// blackbox records cycles of every packet, which costs one cycle counter read
+// per packet, define to 0 to leave it out
+#ifndef WV_CONFIG_LatencyProfile
+#define WV_CONFIG_LatencyProfile 1
+#endif
+
 typedef struct _WV_Profile {
+    WV_U64 total_byte_count;
+    WV_U64 total_packet_count;
     WV_U64 interval_byte_count;
     WV_U32 interval_packet_count;
     WV_U32 next_checkpoint_sec;
     WV_F last_record_sec;
     WV_F last_10_throughput[10];
     WV_U8 record_count;
+    // packets are recorded to interval histogram, which is reported and folded
+    // into latency at each checkpoint
+    WV_Histogram latency;
+    WV_Histogram interval_latency;
 } WV_Profile;
 
 WV_U8 WV_ProfileStart(WV_Profile *);
@@ -18,4 +63,95 @@ WV_U8 WV_ProfileRecord(WV_Profile *, WV_U32, WV_U8);
 
 WV_U8 WV_ProfileRecordPrint(WV_Profile *);
 
+// accumulate the counters of one runtime's profile into another, e.g. to report
+// the whole process when every core owns its own runtime
+WV_U8 WV_ProfileMerge(WV_Profile *, const WV_Profile *);
+
+WV_U8 WV_ProfileSummaryPrint(const WV_Profile *);
+
+// cycle counter for stage profiling, falls back to nanoseconds
+#if defined(__x86_64__) || defined(__i386__)
+#include <x86intrin.h>
+static inline WV_U64 WV_Rdtsc()
+{
+    return __rdtsc();
+}
+#else
+#include <time.h>
+static inline WV_U64 WV_Rdtsc()
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (WV_U64)ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+#endif
+
+static inline WV_U64 WV_LatencyStart()
+{
+    return WV_CONFIG_LatencyProfile ? WV_Rdtsc() : 0;
+}
+
+// record cycles since start as latency of a packet, and return current cycle
+// as start of next packet
+static inline WV_U64 WV_ProfileLatency(WV_Profile *profile, WV_U64 start)
+{
+    if (!WV_CONFIG_LatencyProfile) {
+        return 0;
+    }
+    WV_U64 now = WV_Rdtsc();
+    WV_HistogramRecord(&profile->interval_latency, now - start);
+    return now;
+}
+
+// stages of a layer that cycles are attributed to, when blackbox is generated
+// with `--stage-profile`
+typedef enum {
+    WV_STAGE_Parse,
+    WV_STAGE_Instance,
+    WV_STAGE_Sequence,
+    WV_STAGE_PSM,
+    WV_STAGE_Event,
+    WV_STAGE_Other,  // dispatching to next layer and destroying instance
+    WV_STAGE_Timer,  // destroying expired instances
+    WV_STAGE_COUNT,
+} WV_Stage;
+
+// cycles since last mark go to the counter of current stage
+typedef struct {
+    WV_U64 last;
+    WV_U64 *current;
+    WV_U64 idle;  // counter for time outside of packet processing
+    WV_U64 packet_count;
+} WV_StageClock;
+
+static inline void WV_StageMark(WV_StageClock *clock, WV_U64 *counter)
+{
+    WV_U64 now = WV_Rdtsc();
+    *clock->current += now - clock->last;
+    clock->last = now;
+    clock->current = counter;
+}
+
+// record cycles that each layer takes in the packet just finished, last holds
+// the cycles of each layer by previous packet, layers not reached are skipped
+static inline void WV_StageLatency(const WV_U64 (*cycles)[WV_STAGE_COUNT], WV_U64 *last, WV_Histogram *histograms,
+    WV_U32 layer_count)
+{
+    for (WV_U32 i = 0; i < layer_count; i += 1) {
+        WV_U64 total = 0;
+        for (WV_U32 j = 0; j < WV_STAGE_COUNT; j += 1) {
+            total += cycles[i][j];
+        }
+        if (total != last[i]) {
+            WV_HistogramRecord(&histograms[i], total - last[i]);
+            last[i] = total;
+        }
+    }
+}
+
+// print average cycles per packet of each layer and stage, and percentiles of
+// cycles of each layer per packet reaching it
+WV_U8 WV_StagePrint(const WV_StageClock *, const WV_U64 (*)[WV_STAGE_COUNT], const WV_Histogram *, WV_U32,
+    const char *const *);
+
 #endif
\ No newline at end of file
@@ -0,0 +1,83 @@
+#ifndef WEAVER_RUNTIME_RSS_H
+#define WEAVER_RUNTIME_RSS_H
+
+#include "types.h"
+#include <string.h>
+
+// Toeplitz hash of NIC RSS in software, for packets that come without driver
+// hash (e.g. fragments, or datagrams reassembled from them), so that they hash
+// the same as the rest of their flows, and for drivers without NIC
+//
+// the key is 0x6d5a repeated, which makes the hash symmetric, i.e. both
+// directions of a flow hash the same. DPDK driver programs the same key into
+// NIC, any 32-bit window of it is the word below rotated
+#define WV_RSS_KEY_WORD 0x6d5a6d5a
+#define WV_RSS_KEY_LENGTH 40
+
+// the key repeats every 16 bits, so every 16-bit word of input meets the same
+// windows, and as the hash is linear, input is folded into one word first
+static inline WV_U32 WV_RSSHash(const WV_Byte *input, WV_U32 length)
+{
+    WV_U32 word = 0;
+    for (WV_U32 i = 0; i < length; i += 1) {
+        word ^= (WV_U32)input[i] << (i & 1 ? 0 : 8);
+    }
+    WV_U32 hash = 0;
+    WV_U32 window = WV_RSS_KEY_WORD;
+    for (WV_I32 bit = 15; bit >= 0; bit -= 1) {
+        hash ^= window & -(word >> bit & 1);
+        window = window << 1 | window >> 31;
+    }
+    return hash;
+}
+
+// input tuple of RSS for TCP/UDP/SCTP over IPv4, fields are in network order
+// as they are in header
+static inline WV_U32 WV_RSSHashTuple(WV_U32 saddr, WV_U32 daddr, WV_U16 sport, WV_U16 dport)
+{
+    WV_Byte input[12];
+    memcpy(input, &saddr, 4);
+    memcpy(input + 4, &daddr, 4);
+    memcpy(input + 8, &sport, 2);
+    memcpy(input + 10, &dport, 2);
+    return WV_RSSHash(input, sizeof(input));
+}
+
+// hash that NIC would give with Ethernet frame, for drivers that replay
+// captures. Only unfragmented IPv4 TCP/UDP/SCTP packets get one, as DPDK driver
+// passes no other, returns 0 for the rest
+static inline WV_U8 WV_RSSFrameHash(const WV_Byte *frame, WV_U32 length, WV_U32 *hash)
+{
+    WV_U32 offset = 14;
+    if (length < offset + 20) {
+        return 0;
+    }
+    WV_U16 ether_type = frame[12] << 8 | frame[13];
+    if (ether_type == 0x8100) {
+        offset = 18;
+        if (length < offset + 20) {
+            return 0;
+        }
+        ether_type = frame[16] << 8 | frame[17];
+    }
+    if (ether_type != 0x0800) {
+        return 0;
+    }
+    const WV_Byte *ip = frame + offset;
+    WV_U32 ihl = (ip[0] & 0xf) * 4;
+    // more fragments flag or fragment offset
+    if ((ip[6] & 0x3f) || ip[7] || (ip[9] != 6 && ip[9] != 17 && ip[9] != 132) ||
+        length < offset + ihl + 4) {
+        return 0;
+    }
+    WV_U32 saddr, daddr;
+    WV_U16 sport, dport;
+    memcpy(&saddr, ip + 12, 4);
+    memcpy(&daddr, ip + 16, 4);
+    memcpy(&sport, ip + ihl, 2);
+    memcpy(&dport, ip + ihl + 2, 2);
+    *hash = WV_RSSHashTuple(saddr, daddr, sport, dport);
+    return 1;
+}
+
+#endif
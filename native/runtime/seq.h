@@ -3,12 +3,98 @@
 
 #include "types.h"
 #include "malloc.h"
+#include "metrics.h"
+#include "pool.h"
 #include <assert.h>
 #include <stdlib.h>
 #include <string.h>
 
+// defaults of the per-layer limits, which are set when initializing the pool
+// out of order segments buffered at most, when a new segment needs one more
+// the segment furthest from window is dropped and on_buffer_exceed is called
+#ifndef WV_CONFIG_SeqNodeCount
 #define WV_CONFIG_SeqNodeCount 32
+#endif
+#ifndef WV_CONFIG_SeqBufferSize
 #define WV_CONFIG_SeqBufferSize (8 * (1 << 10))
+#endif
+// larger segments are dropped and on_buffer_exceed is called
+#ifndef WV_CONFIG_SeqMaxSegment
+#define WV_CONFIG_SeqMaxSegment 3000
+#endif
+// buffers are pooled in power-of-two size classes from this size up to buffer
+// size, and grow to next class when data goes further
+#ifndef WV_CONFIG_SeqBufferMinSize
+#define WV_CONFIG_SeqBufferMinSize 512
+#endif
+#if WV_CONFIG_SeqBufferMinSize & (WV_CONFIG_SeqBufferMinSize - 1)
+#error "WV_CONFIG_SeqBufferMinSize must be power of two"
+#endif
+// bytes of buffers allocated by each growth of a size class
+#ifndef WV_CONFIG_SeqPoolChunkSize
+#define WV_CONFIG_SeqPoolChunkSize (256 * (1 << 10))
+#endif
+#define WV_SEQ_MAX_CLASS 16
+
+typedef struct {
+    WV_U32 buffer_size;
+    WV_U32 max_segment;
+    WV_U8 node_count;
+    WV_Pool classes[WV_SEQ_MAX_CLASS];
+    WV_U8 class_count;
+    // assembled data that wraps around a ring is copied here, and stays valid
+    // until next assembling of the layer
+    WV_Byte* scratch;
+    WV_SeqCounter counter;
+} WV_SeqPool;
+
+// buffer is a ring indexed by sequence offset modulo its size, so buffer_size
+// must be power of two
+static inline WV_U8 WV_InitSeqPool(WV_SeqPool* pool, WV_U32 buffer_size, WV_U8 node_count, WV_U32 max_segment)
+{
+    assert(buffer_size != 0 && (buffer_size & (buffer_size - 1)) == 0);
+    assert(node_count != 0);
+    pool->buffer_size = buffer_size;
+    pool->node_count = node_count;
+    pool->max_segment = max_segment;
+    pool->class_count = 0;
+    pool->scratch = NULL;
+    memset(&pool->counter, 0, sizeof(WV_SeqCounter));
+    for (WV_U32 size = WV_CONFIG_SeqBufferMinSize;; size *= 2) {
+        assert(pool->class_count < WV_SEQ_MAX_CLASS);
+        if (size > buffer_size) {
+            size = buffer_size;
+        }
+        WV_Pool* class = &pool->classes[pool->class_count];
+        WV_InitPool(class, size, 0);
+        class->chunk_count = WV_CONFIG_SeqPoolChunkSize / size > 0 ? WV_CONFIG_SeqPoolChunkSize / size : 1;
+        pool->class_count += 1;
+        if (size == buffer_size) {
+            return 0;
+        }
+    }
+}
+
+static inline WV_U8 WV_CleanSeqPool(WV_SeqPool* pool)
+{
+    for (WV_U8 i = 0; i < pool->class_count; i += 1) {
+        WV_CleanPool(&pool->classes[i]);
+    }
+    if (pool->scratch != NULL) {
+        WV_Free(pool->scratch);
+        pool->scratch = NULL;
+    }
+    return 0;
+}
+
+static inline WV_U8 _SeqPoolClass(WV_SeqPool* pool, WV_U32 length)
+{
+    WV_U8 i = 0;
+    while (i + 1 < pool->class_count && pool->classes[i].object_size < length) {
+        i += 1;
+    }
+    return i;
+}
 
 typedef struct {
     WV_U32 left;
@@ -26,10 +112,12 @@ static WV_U8 default_handler(struct WV_Seq *_seq, WV_ByteSlice _payload) {
 }
 
 struct WV_Seq {
-    WV_Byte* buffer;
+    WV_Byte* buffer; // NULL until some data is buffered
+    WV_SeqPool* pool;
+    WV_U8 buffer_class;
     WV_U32 offset;
     WV_U8 set_offset;
-    WV_SeqMeta nodes[WV_CONFIG_SeqNodeCount], postfix;
+    WV_SeqMeta *nodes, postfix;
     WV_U8 used_count;
     WV_U8 pre_done, post_start;
     WV_SeqEventHandler on_buffer_exceed, on_overlap, on_retex, on_out_of_window;
@@ -37,13 +125,12 @@ struct WV_Seq {
 
 typedef struct WV_Seq WV_Seq;
 
-static inline WV_U8 WV_InitSeq(WV_Seq* seq, WV_U8 use_data, WV_U32 zero_base)
+// nodes has pool->node_count elements, and usually follows seq in instance
+static inline WV_U8 WV_InitSeq(WV_Seq* seq, WV_SeqMeta* nodes, WV_SeqPool* pool, WV_U8 use_data, WV_U32 zero_base)
 {
-    if (use_data) {
-        seq->buffer = WV_Malloc(sizeof(WV_Byte) * WV_CONFIG_SeqBufferSize);
-    } else {
-        seq->buffer = NULL;
-    }
+    seq->buffer = NULL;
+    seq->pool = pool;
+    seq->nodes = nodes;
     seq->offset = 0;
     seq->set_offset = !zero_base;
     seq->used_count = 0;
@@ -53,10 +140,87 @@ static inline WV_U8 WV_InitSeq(WV_Seq* seq, WV_U8 use_data, WV_U32 zero_base)
     return 0;
 }
 
+// events are counted in pool before calling the handler of sequence
+static inline WV_U8 _SeqOnRetex(WV_Seq* seq, WV_ByteSlice payload)
+{
+    seq->pool->counter.retex_count += 1;
+    return seq->on_retex(seq, payload);
+}
+
+static inline WV_U8 _SeqOnOverlap(WV_Seq* seq, WV_ByteSlice payload)
+{
+    seq->pool->counter.overlap_count += 1;
+    return seq->on_overlap(seq, payload);
+}
+
+static inline WV_U8 _SeqOnOutOfWindow(WV_Seq* seq, WV_ByteSlice payload)
+{
+    seq->pool->counter.out_of_window_count += 1;
+    return seq->on_out_of_window(seq, payload);
+}
+
+static inline WV_U8 _SeqOnBufferExceed(WV_Seq* seq, WV_ByteSlice payload)
+{
+    seq->pool->counter.buffer_exceed_count += 1;
+    return seq->on_buffer_exceed(seq, payload);
+}
+
+static inline WV_U8 _SeqRelease(WV_Seq* seq)
+{
+    if (seq->buffer != NULL) {
+        seq->pool->counter.buffer_byte_count -= seq->pool->classes[seq->buffer_class].object_size;
+        WV_PoolFree(&seq->pool->classes[seq->buffer_class], seq->buffer);
+        seq->buffer = NULL;
+    }
+    return 0;
+}
+
+static inline WV_U32 _SeqCapacity(WV_Seq* seq)
+{
+    return seq->pool->classes[seq->buffer_class].object_size;
+}
+
+// copy data to ring positions of [offset, offset + data.length)
+static inline WV_U8 _SeqWrite(WV_Byte* ring, WV_U32 capacity, WV_U32 offset, WV_ByteSlice data)
+{
+    WV_U32 pos = offset & (capacity - 1);
+    WV_U32 first = data.length < capacity - pos ? data.length : capacity - pos;
+    WV_Memcpy(&ring[pos], data.cursor, first);
+    if (first < data.length) {
+        WV_Memcpy(ring, data.cursor + first, data.length - first);
+    }
+    return 0;
+}
+
+// make buffer hold at least length bytes from offset, keep buffered data
+static inline WV_U8 _SeqReserve(WV_Seq* seq, WV_U32 length)
+{
+    if (seq->buffer != NULL && _SeqCapacity(seq) >= length) {
+        return 0;
+    }
+    WV_U8 class = _SeqPoolClass(seq->pool, length);
+    WV_Byte* buffer = WV_PoolAlloc(&seq->pool->classes[class]);
+    assert(buffer != NULL);
+    if (seq->buffer != NULL) {
+        // old ring holds [offset, offset + capacity) starting from pos
+        WV_U32 capacity = _SeqCapacity(seq), pos = seq->offset & (capacity - 1);
+        WV_U32 capacity_new = seq->pool->classes[class].object_size;
+        _SeqWrite(buffer, capacity_new, seq->offset,
+            (WV_ByteSlice){ .cursor = &seq->buffer[pos], .length = capacity - pos });
+        _SeqWrite(buffer, capacity_new, seq->offset + capacity - pos,
+            (WV_ByteSlice){ .cursor = seq->buffer, .length = pos });
+        _SeqRelease(seq);
+    }
+    seq->buffer = buffer;
+    seq->buffer_class = class;
+    seq->pool->counter.buffer_byte_count += seq->pool->classes[class].object_size;
+    return 0;
+}
+
 static inline WV_U8 WV_CleanSeq(WV_Seq* seq, WV_U8 use_data)
 {
     if (use_data) {
-        WV_Free(seq->buffer);
+        _SeqRelease(seq);
     }
     return 0;
 }
@@ -73,7 +237,7 @@ static inline WV_U8 _AssertNodes(WV_Seq* seq)
     for (WV_U8 i = 0; i < seq->used_count; i += 1) {
         assert(seq->nodes[i].left < seq->nodes[i].right);
         assert(seq->nodes[i].left >= seq->offset);
-        assert(seq->nodes[i].right - seq->offset <= WV_CONFIG_SeqBufferSize);
+        assert(seq->nodes[i].right - seq->offset <= seq->pool->buffer_size);
     }
     for (WV_U8 i = 1; i < seq->used_count; i += 1) {
         assert(seq->nodes[i - 1].right < seq->nodes[i].left);
@@ -91,10 +255,9 @@ static inline WV_U8 _AssertNodes(WV_Seq* seq)
 
 static inline WV_U8 _InsertNode(WV_Seq* seq, WV_U8 index)
 {
-    assert(seq->used_count < WV_CONFIG_SeqNodeCount - 1);
-    for (WV_U8 i = seq->used_count; i > index; i -= 1) {
-        seq->nodes[i] = seq->nodes[i - 1];
-    }
+    assert(seq->used_count < seq->pool->node_count);
+    memmove(&seq->nodes[index + 1], &seq->nodes[index],
+        sizeof(WV_SeqMeta) * (seq->used_count - index));
     seq->used_count += 1;
     return 0;
 }
@@ -102,13 +265,27 @@ static inline WV_U8 _InsertNode(WV_Seq* seq, WV_U8 index)
 static inline WV_U8 _RemoveNode(WV_Seq* seq, WV_U8 index)
 {
     assert(seq->used_count > index);
-    for (WV_U8 i = index; i < seq->used_count; i += 1) {
-        seq->nodes[i] = seq->nodes[i + 1];
-    }
+    memmove(&seq->nodes[index], &seq->nodes[index + 1],
+        sizeof(WV_SeqMeta) * (seq->used_count - index - 1));
     seq->used_count -= 1;
     return 0;
 }
 
+// index of first node not left to offset
+static inline WV_U8 _SearchNode(WV_Seq* seq, WV_U32 offset)
+{
+    WV_U8 low = 0, high = seq->used_count;
+    while (low < high) {
+        WV_U8 mid = (low + high) / 2;
+        if (seq->nodes[mid].left < offset) {
+            low = mid + 1;
+        } else {
+            high = mid;
+        }
+    }
+    return low;
+}
+
 static inline WV_U8 WV_Insert(
     WV_Seq* seq,
     WV_U32 offset, // offset position of data
@@ -124,6 +301,10 @@ static inline WV_U8 WV_Insert(
         seq->offset = offset;
         seq->set_offset = 0;
     }
+    // nothing buffered, and the slice assembled by last packet is consumed
+    if (seq->used_count == 0) {
+        _SeqRelease(seq);
+    }
 
     if (takeup_length == 0) {
         takeup_length = data.length;
@@ -158,30 +339,20 @@ static inline WV_U8 WV_Insert(
             }
         }
         if (seq->offset < left) {
-            // left expected data out of window
-            seq->on_out_of_window(seq, use_data ? ((WV_ByteSlice){ .cursor = seq->buffer, .length = left - seq->offset}) : WV_EMPTY);
-            if (use_data) {
-                for (WV_U8 i = 0; i < seq->used_count; i += 1) {
-                    assert(seq->nodes[i].left >= left);
-                    assert(seq->nodes[i].right - seq->offset <= WV_CONFIG_SeqBufferSize);
-                    memmove(
-                        &seq->buffer[seq->nodes[i].left - left],
-                        &seq->buffer[seq->nodes[i].left - seq->offset],
-                        seq->nodes[i].right - seq->nodes[i].left);
-                }
-                // printf("%u %u\n", seq->offset, left);
-            }
+            // left expected data out of window, which is never fully buffered
+            // buffered data keeps its ring position when window moves
+            _SeqOnOutOfWindow(seq, WV_EMPTY);
             seq->offset = left;
         }
 
         if (offset >= right || offset + takeup_length < left) {
             // full out of window
-            seq->on_retex(seq, data);
+            _SeqOnRetex(seq, data);
             takeup_length = data.length = 0;
         } else {
             if (offset < left) {
                 // left out of window
-                seq->on_overlap(seq, WV_SliceBefore(data, left - offset));
+                _SeqOnOverlap(seq, WV_SliceBefore(data, left - offset));
                 takeup_length -= left - offset;
                 data = WV_SliceAfter(data, left - offset);
                 offset = left;
@@ -189,7 +360,7 @@ static inline WV_U8 WV_Insert(
             if (offset + takeup_length > right) {
                 // right out of window
                 // this is safe even data.length < takeup_length
-                seq->on_out_of_window(seq, WV_SliceAfter(data, offset + takeup_length - right));
+                _SeqOnOutOfWindow(seq, WV_SliceAfter(data, offset + takeup_length - right));
                 takeup_length = right - offset;
                 if (offset + data.length > right) {
                     data = WV_SliceBefore(data, right - offset);
@@ -198,34 +369,47 @@ static inline WV_U8 WV_Insert(
         }
     }
     // printf("used_count: %u\n", seq->used_count);
-    assert(takeup_length < 3000);
+    if (takeup_length > seq->pool->max_segment) {
+        // oversized segment
+        _SeqOnBufferExceed(seq, data);
+        takeup_length = data.length = 0;
+    }
     _AssertNodes(seq);
 
-    WV_U8 pos;
-    for (pos = 0; pos < seq->used_count && seq->nodes[pos].left < offset; pos += 1)
-        ;
+    WV_U8 pos = _SearchNode(seq, offset);
+    // a new node is required, i.e. not continuing previous one, but none left
+    WV_U8 node_full = seq->used_count == seq->pool->node_count && !(pos != 0 && offset <= seq->nodes[pos - 1].right);
     // printf("%u %u %u\n", seq->used_count, seq->post_start, seq->postfix.left);
     if (takeup_length != 0) {
         if (offset < seq->offset) {
             // hard out of order
-            seq->on_retex(seq, data);
+            _SeqOnRetex(seq, data);
             data = WV_EMPTY;
         } else if (seq->post_start && offset + data.length > seq->postfix.left) {
             // hard out of window
-            seq->on_out_of_window(seq, data);
+            _SeqOnOutOfWindow(seq, data);
+            data = WV_EMPTY;
+        } else if (data.length != 0 && node_full && pos == seq->used_count) {
+            // furthest from window, drop itself
+            _SeqOnBufferExceed(seq, data);
             data = WV_EMPTY;
         } else if (data.length != 0) {
             // assert(offset >= seq->offset);
+            if (node_full) {
+                // make room by dropping the furthest node
+                _SeqOnBufferExceed(seq, WV_EMPTY);
+                seq->used_count -= 1;
+            }
             if (pos != 0 && offset <= seq->nodes[pos - 1].right) {
                 // possible overlap/retrx
                 assert(offset >= seq->nodes[pos - 1].left);
                 if (offset + data.length > seq->nodes[pos - 1].right) {
                     if (offset < seq->nodes[pos - 1].right) {
-                        seq->on_overlap(seq, WV_SliceBefore(data, seq->nodes[pos - 1].right - offset));
+                        _SeqOnOverlap(seq, WV_SliceBefore(data, seq->nodes[pos - 1].right - offset));
                     }
                     seq->nodes[pos - 1].right = offset + data.length;
                 } else {
-                    seq->on_retex(seq, data);
+                    _SeqOnRetex(seq, data);
                 }
                 pos = pos - 1;
             } else {
@@ -237,12 +421,12 @@ static inline WV_U8 WV_Insert(
                 // possible overlap/retrx
                 if (seq->nodes[pos].right < seq->nodes[pos + 1].right) {
                     if (seq->nodes[pos].right > seq->nodes[pos + 1].left) {
-                        seq->on_overlap(seq, WV_SliceBefore(
+                        _SeqOnOverlap(seq, WV_SliceBefore(
                             WV_SliceAfter(data, seq->nodes[pos + 1].left - offset), seq->nodes[pos].right - seq->nodes[pos + 1].left));
                     }
                     seq->nodes[pos].right = seq->nodes[pos + 1].right;
                 } else {
-                    seq->on_retex(seq, WV_SliceBefore(
+                    _SeqOnRetex(seq, WV_SliceBefore(
                             WV_SliceAfter(data, seq->nodes[pos + 1].left - offset), seq->nodes[pos + 1].right - seq->nodes[pos + 1].left));
                 }
                 _RemoveNode(seq, pos + 1);
@@ -263,7 +447,7 @@ static inline WV_U8 WV_Insert(
                     seq->postfix.right = offset + takeup_length;
                 } else {
                     // postfix out of window
-                    seq->on_out_of_window(seq, data);
+                    _SeqOnOutOfWindow(seq, data);
                 }
             } else if (!seq->pre_done) {
                 // assert(offset == seq->offset);
@@ -271,7 +455,7 @@ static inline WV_U8 WV_Insert(
                     seq->offset = offset + takeup_length;
                 } else {
                     // prefix out of window
-                    seq->on_out_of_window(seq, data);
+                    _SeqOnOutOfWindow(seq, data);
                 }
             } else {
                 if (seq->used_count == 0 || offset >= seq->nodes[seq->used_count - 1].right) {
@@ -280,17 +464,18 @@ static inline WV_U8 WV_Insert(
                     seq->postfix = (WV_SeqMeta){ .left = offset, .right = offset + takeup_length };
                 } else {
                     // postfix out of window, ignore
-                    seq->on_out_of_window(seq, data);
+                    _SeqOnOutOfWindow(seq, data);
                 }
             }
         }
     }
-    if (seq->used_count > 0 && seq->nodes[seq->used_count - 1].right - seq->offset > WV_CONFIG_SeqBufferSize) {
-        seq->on_buffer_exceed(seq, data);
-        if (seq->nodes[seq->used_count - 1].left - seq->offset < WV_CONFIG_SeqBufferSize) {
+    WV_U32 buffer_size = seq->pool->buffer_size;
+    if (seq->used_count > 0 && seq->nodes[seq->used_count - 1].right - seq->offset > buffer_size) {
+        _SeqOnBufferExceed(seq, data);
+        if (seq->nodes[seq->used_count - 1].left - seq->offset < buffer_size) {
             // right out of memory
-            seq->nodes[seq->used_count - 1].right = seq->offset + WV_CONFIG_SeqBufferSize;
-            data = WV_SliceBefore(data, seq->offset + WV_CONFIG_SeqBufferSize - offset);
+            seq->nodes[seq->used_count - 1].right = seq->offset + buffer_size;
+            data = WV_SliceBefore(data, seq->offset + buffer_size - offset);
         } else {
             // full out of memory
             seq->used_count -= 1;
@@ -301,9 +486,10 @@ static inline WV_U8 WV_Insert(
 
     if (use_data && data.length != 0) {
         assert(offset >= seq->offset);
-        assert(offset - seq->offset + data.length <= WV_CONFIG_SeqBufferSize);
+        assert(offset - seq->offset + data.length <= buffer_size);
+        _SeqReserve(seq, offset - seq->offset + data.length);
         // printf("memcpy (insert)\n");
-        WV_Memcpy(&seq->buffer[offset - seq->offset], data.cursor, data.length);
+        _SeqWrite(seq->buffer, _SeqCapacity(seq), offset, data);
     }
     return _AssertNodes(seq);
 }
@@ -327,34 +513,33 @@ static inline WV_U8 WV_SeqReady(WV_Seq* seq)
     }
 }
 
-static inline WV_ByteSlice WV_SeqAssemble(WV_Seq* seq, WV_Byte** need_free, WV_U8 use_data)
+// returned slice points into the ring, or into scratch of pool if it wraps
+// around, and is valid until next inserting into the sequence or assembling
+// in the same pool
+static inline WV_ByteSlice WV_SeqAssemble(WV_Seq* seq, WV_U8 use_data)
 {
     // printf("%u %u\n", seq->used_count, seq->offset);
     if (seq->used_count == 0 || seq->nodes[0].left != seq->offset) {
-        *need_free = NULL;
         return WV_EMPTY;
     }
     WV_U32 ready_length = seq->nodes[0].right - seq->nodes[0].left;
-    if (seq->used_count == 1) {
-        *need_free = NULL;
-        seq->offset = seq->nodes[0].right;
-        seq->used_count = 0;
-        return (WV_ByteSlice){ .cursor = seq->buffer, .length = ready_length };
-    }
-
+    WV_U32 ready_offset = seq->offset;
     seq->offset = seq->nodes[0].right;
     _RemoveNode(seq, 0);
-    if (use_data) {
-        WV_Byte* ready_buffer = WV_Malloc(sizeof(WV_Byte) * ready_length);
-        // printf("memcpy\n");
-        WV_Memcpy(ready_buffer, &seq->buffer[seq->nodes[0].left - seq->offset],
-            ready_length);
-        *need_free = ready_buffer;
-        return (WV_ByteSlice){ .cursor = ready_buffer, .length = ready_length };
-    } else {
-        *need_free = NULL;
-        return WV_EMPTY;
+    if (!use_data) {
+        return (WV_ByteSlice){ .cursor = NULL, .length = ready_length };
+    }
+    WV_U32 capacity = _SeqCapacity(seq), pos = ready_offset & (capacity - 1);
+    if (pos + ready_length <= capacity) {
+        return (WV_ByteSlice){ .cursor = &seq->buffer[pos], .length = ready_length };
+    }
+    if (seq->pool->scratch == NULL) {
+        seq->pool->scratch = WV_Malloc(sizeof(WV_Byte) * seq->pool->buffer_size);
     }
+    // printf("memcpy\n");
+    WV_Memcpy(seq->pool->scratch, &seq->buffer[pos], capacity - pos);
+    WV_Memcpy(&seq->pool->scratch[capacity - pos], seq->buffer, ready_length - (capacity - pos));
+    return (WV_ByteSlice){ .cursor = seq->pool->scratch, .length = ready_length };
 }
 
 #endif
\ No newline at end of file
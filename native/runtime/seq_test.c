@@ -3,60 +3,163 @@
 #include <stdlib.h>
 #include <string.h>
 
+WV_SeqPool pool;
+
 void test_create() {
   WV_Seq seq;
-  WV_InitSeq(&seq, 1, 0);
+  WV_SeqMeta nodes[WV_CONFIG_SeqNodeCount];
+  WV_InitSeq(&seq, nodes, &pool, 1, 0);
   WV_CleanSeq(&seq, 1);
 }
 
 void test_insert_in_order() {
   WV_Seq seq;
-  WV_InitSeq(&seq, 1, 0);
+  WV_SeqMeta nodes[WV_CONFIG_SeqNodeCount];
+  WV_InitSeq(&seq, nodes, &pool, 1, 0);
   WV_Byte buf[100];
   for (int i = 0; i < 100; i += 1) {
     memset(buf, i, sizeof(buf));
     WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
     WV_Insert(&seq, i * sizeof(buf), payload, sizeof(buf), 1, 0, 65536);
-    WV_Byte *free_ptr;
-    WV_ByteSlice assembled = WV_SeqAssemble(&seq, &free_ptr, 1);
+    WV_ByteSlice assembled = WV_SeqAssemble(&seq, 1);
     assert(assembled.length == payload.length);
     assert(
       memcmp(assembled.cursor, payload.cursor, sizeof(assembled.length)) == 0);
-    if (free_ptr != NULL) {
-      free(free_ptr);
-    }
   }
   WV_CleanSeq(&seq, 1);
 }
 
 void test_insert_out_of_order() {
   WV_Seq seq;
-  WV_InitSeq(&seq, 1, 1);
+  WV_SeqMeta nodes[WV_CONFIG_SeqNodeCount];
+  WV_InitSeq(&seq, nodes, &pool, 1, 1);
   WV_Byte buf[100];
   memset(buf, 0xCC, sizeof(buf));
   WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
   WV_Insert(&seq, sizeof(buf), payload, sizeof(buf), 1, 0, 65536);
-  WV_Byte *free_ptr;
-  assert(WV_SeqAssemble(&seq, &free_ptr, 1).length == 0);
+  assert(WV_SeqAssemble(&seq, 1).length == 0);
   memset(buf, 0xCD, sizeof(buf));
   WV_Insert(&seq, 0, payload, sizeof(buf), 1, 0, 65536);
-  WV_ByteSlice assembled = WV_SeqAssemble(&seq, &free_ptr, 1);
+  WV_ByteSlice assembled = WV_SeqAssemble(&seq, 1);
   assert(assembled.length == 2 * sizeof(buf));
   for (int i = 0; i < 2 * sizeof(buf); i += 1) {
     assert(assembled.cursor[i] == (i < sizeof(buf) ? 0xCD : 0xCC));
   }
-  if (free_ptr != NULL) {
-    free(free_ptr);
+  WV_CleanSeq(&seq, 1);
+}
+
+void test_lazy_buffer() {
+  WV_Seq seq;
+  WV_SeqMeta nodes[WV_CONFIG_SeqNodeCount];
+  WV_InitSeq(&seq, nodes, &pool, 1, 1);
+  assert(seq.buffer == NULL);
+  WV_Byte buf[1000];
+  memset(buf, 0xCC, sizeof(buf));
+  WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
+  WV_Insert(&seq, sizeof(buf), payload, sizeof(buf), 1, 0, 65536);
+  assert(seq.buffer != NULL);
+  assert(WV_SeqAssemble(&seq, 1).length == 0);
+  // grow to larger class and keep buffered data
+  memset(buf, 0xCD, sizeof(buf));
+  WV_Insert(&seq, 3 * sizeof(buf), payload, sizeof(buf), 1, 0, 65536);
+  memset(buf, 0xCE, sizeof(buf));
+  WV_Insert(&seq, 0, payload, sizeof(buf), 1, 0, 65536);
+  WV_ByteSlice assembled = WV_SeqAssemble(&seq, 1);
+  assert(assembled.length == 2 * sizeof(buf));
+  for (int i = 0; i < 2 * sizeof(buf); i += 1) {
+    assert(assembled.cursor[i] == (i < sizeof(buf) ? 0xCE : 0xCC));
+  }
+  // still buffered
+  WV_Insert(&seq, 2 * sizeof(buf), payload, sizeof(buf), 1, 0, 65536);
+  assembled = WV_SeqAssemble(&seq, 1);
+  assert(assembled.length == 2 * sizeof(buf));
+  assert(assembled.cursor[sizeof(buf)] == 0xCD);
+  // released once all data is assembled
+  WV_Insert(&seq, 4 * sizeof(buf), WV_EMPTY, sizeof(buf), 1, 0, 65536);
+  assert(seq.buffer == NULL);
+  WV_CleanSeq(&seq, 1);
+}
+
+void test_assemble_wrap() {
+  WV_Seq seq;
+  WV_SeqMeta nodes[WV_CONFIG_SeqNodeCount];
+  WV_InitSeq(&seq, nodes, &pool, 1, 1);
+  WV_Byte buf[300];
+  WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
+  // keep the segment after the assembled ones buffered, so the ring is never
+  // released and assembled ranges move around it
+  memset(buf, 1, sizeof(buf));
+  WV_Insert(&seq, sizeof(buf), payload, sizeof(buf), 1, 0, 65536);
+  for (int k = 0; k < 20; k += 2) {
+    memset(buf, k + 3, sizeof(buf));
+    WV_Insert(&seq, (k + 3) * sizeof(buf), payload, sizeof(buf), 1, 0, 65536);
+    memset(buf, k, sizeof(buf));
+    WV_Insert(&seq, k * sizeof(buf), payload, sizeof(buf), 1, 0, 65536);
+    WV_ByteSlice assembled = WV_SeqAssemble(&seq, 1);
+    assert(assembled.length == 2 * sizeof(buf));
+    for (int j = 0; j < 2 * sizeof(buf); j += 1) {
+      assert(assembled.cursor[j] == k + j / sizeof(buf));
+    }
+  }
+  // some of them are copied out
+  assert(pool.scratch != NULL);
+  WV_CleanSeq(&seq, 1);
+}
+
+void test_node_overflow() {
+  WV_Seq seq;
+  WV_SeqMeta nodes[WV_CONFIG_SeqNodeCount];
+  WV_InitSeq(&seq, nodes, &pool, 1, 1);
+  WV_Byte buf[10];
+  memset(buf, 0xCC, sizeof(buf));
+  WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
+  for (int i = 1; i <= WV_CONFIG_SeqNodeCount + 1; i += 1) {
+    WV_Insert(&seq, i * 2 * sizeof(buf), payload, sizeof(buf), 1, 0, 65536);
+  }
+  // the furthest segment is dropped
+  assert(seq.used_count == WV_CONFIG_SeqNodeCount);
+  assert(seq.nodes[seq.used_count - 1].left == WV_CONFIG_SeqNodeCount * 2 * sizeof(buf));
+  WV_Insert(&seq, 0, payload, sizeof(buf), 1, 0, 65536);
+  // room is made for the nearer one
+  assert(seq.used_count == WV_CONFIG_SeqNodeCount);
+  assert(seq.nodes[seq.used_count - 1].left == (WV_CONFIG_SeqNodeCount - 1) * 2 * sizeof(buf));
+  assert(WV_SeqAssemble(&seq, 1).length == sizeof(buf));
+  WV_CleanSeq(&seq, 1);
+}
+
+void test_max_segment() {
+  WV_SeqPool small_pool;
+  WV_InitSeqPool(&small_pool, 1024, 4, 100);
+  WV_Seq seq;
+  WV_SeqMeta nodes[4];
+  WV_InitSeq(&seq, nodes, &small_pool, 1, 1);
+  WV_Byte buf[200];
+  memset(buf, 0xCC, sizeof(buf));
+  WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
+  // oversized segment is dropped
+  WV_Insert(&seq, 100, payload, sizeof(buf), 1, 0, 65536);
+  assert(seq.used_count == 0);
+  payload.length = 100;
+  for (int i = 1; i <= 5; i += 1) {
+    WV_Insert(&seq, i * 200, payload, 100, 1, 0, 65536);
   }
+  assert(seq.used_count == 4);
   WV_CleanSeq(&seq, 1);
+  WV_CleanSeqPool(&small_pool);
 }
 
 void (*TESTCASES[])() = {
-  test_create, test_insert_in_order, test_insert_out_of_order, NULL};
+  test_create, test_insert_in_order, test_insert_out_of_order,
+  test_lazy_buffer, test_assemble_wrap, test_node_overflow, test_max_segment,
+  NULL};
 
 int main() {
+  WV_InitSeqPool(
+    &pool, WV_CONFIG_SeqBufferSize, WV_CONFIG_SeqNodeCount,
+    WV_CONFIG_SeqMaxSegment);
   for (int i = 0; TESTCASES[i] != NULL; i += 1) {
     TESTCASES[i]();
   }
+  WV_CleanSeqPool(&pool);
   return 0;
 }
\ No newline at end of file
@@ -0,0 +1,445 @@
+#ifndef WEAVER_RUNTIME_TABLE_H
+#define WEAVER_RUNTIME_TABLE_H
+
+#include "types.h"
+#include "malloc.h"
+#include <string.h>
+#ifdef __SSE2__
+#include <emmintrin.h>
+#endif
+
+// flow tables alternative to tommy_hashlin, with the same contract:
+// an object is stored by pointer, its key is the first `key_size` bytes it
+// points to, searching returns the stored object or NULL, and removing takes
+// the stored object pointer itself
+//
+// WV_OpenTable: linear probing, key prefix and hash are stored inline in the
+// slot, so a lookup usually touches no memory other than the slot array
+// WV_CuckooTable: 2-choice cuckoo with 8-slot buckets, a bucket is probed by
+// comparing 8 one-byte tags at once, and object is dereferenced only on a hit
+
+// tables grow by rehashing all at once, size them for expected number of
+// objects to avoid that in steady state
+#ifndef WV_CONFIG_TableInitSize
+#define WV_CONFIG_TableInitSize 1024
+#endif
+
+// bytes of key stored inline in open table slots, compared with one SSE2
+// instruction, longer keys compare rest of them through object
+#define WV_TABLE_INLINE_KEY 16
+// cuckoo insertion gives up and grows the table after this many displacements
+#define WV_TABLE_MAX_KICK 128
+
+static inline WV_U32 _TableRoundUp(WV_U32 size)
+{
+    WV_U32 n = 1;
+    while (n < size) {
+        n <<= 1;
+    }
+    return n;
+}
+
+typedef struct {
+    WV_Byte key[WV_TABLE_INLINE_KEY];
+    WV_Any object;  // NULL for empty slot
+    WV_U32 hash;
+} __attribute__((aligned(32))) WV_OpenSlot;
+
+typedef struct {
+    WV_OpenSlot *slots;
+    WV_U32 mask;
+    WV_U32 count;
+    WV_U32 key_size;
+} WV_OpenTable;
+
+static inline WV_U8 _OpenKeyEqual(const WV_Byte *a, const WV_Byte *b)
+{
+#ifdef __SSE2__
+    __m128i x = _mm_load_si128((const __m128i *)a);
+    __m128i y = _mm_load_si128((const __m128i *)b);
+    return _mm_movemask_epi8(_mm_cmpeq_epi8(x, y)) == 0xffff;
+#else
+    return memcmp(a, b, WV_TABLE_INLINE_KEY) == 0;
+#endif
+}
+
+static inline void _OpenInlineKey(const WV_OpenTable *table, WV_Byte *inline_key, const void *key)
+{
+    memset(inline_key, 0, WV_TABLE_INLINE_KEY);
+    memcpy(inline_key, key, table->key_size < WV_TABLE_INLINE_KEY ? table->key_size : WV_TABLE_INLINE_KEY);
+}
+
+static inline WV_U8 _OpenAllocSlots(WV_OpenTable *table, WV_U32 slot_count)
+{
+    table->slots = WV_Malloc(sizeof(WV_OpenSlot) * slot_count);
+    if (table->slots == NULL) {
+        return 1;
+    }
+    memset(table->slots, 0, sizeof(WV_OpenSlot) * slot_count);
+    table->mask = slot_count - 1;
+    return 0;
+}
+
+// caller makes sure there is an empty slot
+static inline void _OpenPlace(WV_OpenTable *table, const WV_OpenSlot *slot)
+{
+    WV_U32 i = slot->hash & table->mask;
+    while (table->slots[i].object != NULL) {
+        i = (i + 1) & table->mask;
+    }
+    table->slots[i] = *slot;
+}
+
+static inline WV_U8 _OpenGrow(WV_OpenTable *table)
+{
+    WV_OpenSlot *slots = table->slots;
+    WV_U32 slot_count = table->mask + 1;
+    if (_OpenAllocSlots(table, slot_count * 2)) {
+        table->slots = slots;
+        return 1;
+    }
+    for (WV_U32 i = 0; i < slot_count; i += 1) {
+        if (slots[i].object != NULL) {
+            _OpenPlace(table, &slots[i]);
+        }
+    }
+    WV_Free(slots);
+    return 0;
+}
+
+static inline WV_U8 WV_InitOpenTable(WV_OpenTable *table, WV_U32 key_size, WV_U32 size)
+{
+    table->count = 0;
+    table->key_size = key_size;
+    if (size < WV_CONFIG_TableInitSize) {
+        size = WV_CONFIG_TableInitSize;
+    }
+    // keep load factor under 3/4
+    return _OpenAllocSlots(table, _TableRoundUp(size + size / 3));
+}
+
+static inline WV_U8 WV_OpenTableInsert(WV_OpenTable *table, WV_Any object, WV_U32 hash)
+{
+    if ((table->count + 1) * 4 > (table->mask + 1) * 3 && _OpenGrow(table)) {
+        return 1;
+    }
+    WV_OpenSlot slot = { .object = object, .hash = hash };
+    _OpenInlineKey(table, slot.key, object);
+    _OpenPlace(table, &slot);
+    table->count += 1;
+    return 0;
+}
+
+static inline WV_Any WV_OpenTableSearch(WV_OpenTable *table, const void *key, WV_U32 hash)
+{
+    WV_OpenSlot probe;
+    _OpenInlineKey(table, probe.key, key);
+    for (WV_U32 i = hash & table->mask;; i = (i + 1) & table->mask) {
+        WV_OpenSlot *slot = &table->slots[i];
+        if (slot->object == NULL) {
+            return NULL;
+        }
+        if (slot->hash == hash && _OpenKeyEqual(slot->key, probe.key) &&
+            (table->key_size <= WV_TABLE_INLINE_KEY ||
+                memcmp((WV_Byte *)slot->object + WV_TABLE_INLINE_KEY, (const WV_Byte *)key + WV_TABLE_INLINE_KEY,
+                    table->key_size - WV_TABLE_INLINE_KEY) == 0)) {
+            return slot->object;
+        }
+    }
+}
+
+// request the slot that searching `hash` probes first, for batched lookups
+static inline void WV_OpenTablePrefetch(const WV_OpenTable *table, WV_U32 hash)
+{
+    WV_Prefetch(&table->slots[hash & table->mask]);
+}
+
+// backward shift deletion, so no tombstone is left to lengthen probes
+static inline WV_Any WV_OpenTableRemove(WV_OpenTable *table, WV_Any object, WV_U32 hash)
+{
+    WV_U32 i = hash & table->mask;
+    while (table->slots[i].object != object) {
+        if (table->slots[i].object == NULL) {
+            return NULL;
+        }
+        i = (i + 1) & table->mask;
+    }
+    for (WV_U32 j = (i + 1) & table->mask; table->slots[j].object != NULL; j = (j + 1) & table->mask) {
+        WV_U32 home = table->slots[j].hash & table->mask;
+        // slot j may fill the hole at i only if its home is not in (i, j]
+        if (((j - home) & table->mask) >= ((j - i) & table->mask)) {
+            table->slots[i] = table->slots[j];
+            i = j;
+        }
+    }
+    table->slots[i].object = NULL;
+    table->count -= 1;
+    return object;
+}
+
+static inline WV_U8 WV_CleanOpenTable(WV_OpenTable *table)
+{
+    WV_Free(table->slots);
+    table->slots = NULL;
+    table->count = 0;
+    return 0;
+}
+
+#define WV_CUCKOO_SLOTS 8
+
+typedef struct {
+    WV_Any objects[WV_CUCKOO_SLOTS];
+} __attribute__((aligned(64))) WV_CuckooBucket;
+
+typedef struct {
+    WV_U64 *tags;  // 8 one-byte tags per bucket, 0 for empty slot
+    WV_CuckooBucket *buckets;
+    WV_U32 *hashes;  // full hash per slot, only touched when moving objects
+    WV_U32 mask;
+    WV_U32 count;
+    WV_U32 key_size;
+    WV_U32 kick;
+} WV_CuckooTable;
+
+static inline WV_U8 _CuckooTag(WV_U32 hash)
+{
+    WV_U8 tag = hash >> 24;
+    return tag == 0 ? 1 : tag;
+}
+
+// alternative bucket only depends on tag, so it can be computed back from
+// either bucket of an object
+static inline WV_U32 _CuckooAlt(const WV_CuckooTable *table, WV_U32 bucket, WV_U8 tag)
+{
+    return (bucket ^ (tag * 0x5bd1e995u)) & table->mask;
+}
+
+static inline void _CuckooSetTag(WV_CuckooTable *table, WV_U32 bucket, WV_U32 slot, WV_U8 tag)
+{
+    ((WV_U8 *)&table->tags[bucket])[slot] = tag;
+}
+
+// bit i is set if slot i of bucket holds tag
+static inline WV_U32 _CuckooMatch(const WV_CuckooTable *table, WV_U32 bucket, WV_U8 tag)
+{
+#ifdef __SSE2__
+    __m128i tags = _mm_loadl_epi64((const __m128i *)&table->tags[bucket]);
+    return _mm_movemask_epi8(_mm_cmpeq_epi8(tags, _mm_set1_epi8((char)tag))) & 0xff;
+#else
+    const WV_U64 lows = 0x7f7f7f7f7f7f7f7full;
+    WV_U64 x = table->tags[bucket] ^ (0x0101010101010101ull * tag);
+    // exact zero byte detection, high bit of each zero byte is set
+    WV_U64 zeros = ~(((x & lows) + lows) | x | lows);
+    WV_U32 match = 0;  // assume little endian, byte i is slot i
+    for (WV_U32 i = 0; i < WV_CUCKOO_SLOTS; i += 1) {
+        match |= ((zeros >> (i * 8 + 7)) & 1) << i;
+    }
+    return match;
+#endif
+}
+
+static inline WV_U8 _CuckooAllocBuckets(WV_CuckooTable *table, WV_U32 bucket_count)
+{
+    table->tags = WV_Malloc(sizeof(WV_U64) * bucket_count);
+    table->buckets = WV_Malloc(sizeof(WV_CuckooBucket) * bucket_count);
+    table->hashes = WV_Malloc(sizeof(WV_U32) * WV_CUCKOO_SLOTS * bucket_count);
+    if (table->tags == NULL || table->buckets == NULL || table->hashes == NULL) {
+        WV_Free(table->tags);
+        WV_Free(table->buckets);
+        WV_Free(table->hashes);
+        return 1;
+    }
+    memset(table->tags, 0, sizeof(WV_U64) * bucket_count);
+    table->mask = bucket_count - 1;
+    return 0;
+}
+
+static inline WV_U8 _CuckooPut(WV_CuckooTable *table, WV_U32 bucket, WV_Any object, WV_U32 hash)
+{
+    WV_U32 empty = _CuckooMatch(table, bucket, 0);
+    if (empty == 0) {
+        return 1;
+    }
+    WV_U32 slot = __builtin_ctz(empty);
+    _CuckooSetTag(table, bucket, slot, _CuckooTag(hash));
+    table->buckets[bucket].objects[slot] = object;
+    table->hashes[bucket * WV_CUCKOO_SLOTS + slot] = hash;
+    return 0;
+}
+
+// on failure the object left without a place is returned through arguments
+static inline WV_U8 _CuckooPlace(WV_CuckooTable *table, WV_Any *object, WV_U32 *hash)
+{
+    WV_U8 tag = _CuckooTag(*hash);
+    WV_U32 bucket = *hash & table->mask;
+    if (!_CuckooPut(table, bucket, *object, *hash)) {
+        return 0;
+    }
+    bucket = _CuckooAlt(table, bucket, tag);
+    for (WV_U32 n = 0; n < WV_TABLE_MAX_KICK; n += 1) {
+        if (!_CuckooPut(table, bucket, *object, *hash)) {
+            return 0;
+        }
+        // evict a victim into its alternative bucket, rotate victim slot so
+        // that two objects are not swapped back and forth
+        WV_U32 slot = table->kick++ % WV_CUCKOO_SLOTS;
+        WV_Any victim = table->buckets[bucket].objects[slot];
+        WV_U32 victim_hash = table->hashes[bucket * WV_CUCKOO_SLOTS + slot];
+        _CuckooSetTag(table, bucket, slot, _CuckooTag(*hash));
+        table->buckets[bucket].objects[slot] = *object;
+        table->hashes[bucket * WV_CUCKOO_SLOTS + slot] = *hash;
+        *object = victim;
+        *hash = victim_hash;
+        bucket = _CuckooAlt(table, bucket, _CuckooTag(victim_hash));
+    }
+    return 1;
+}
+
+static inline WV_U8 _CuckooGrow(WV_CuckooTable *table)
+{
+    WV_U64 *tags = table->tags;
+    WV_CuckooBucket *buckets = table->buckets;
+    WV_U32 *hashes = table->hashes;
+    WV_U32 bucket_count = table->mask + 1;
+    if (_CuckooAllocBuckets(table, bucket_count * 2)) {
+        table->tags = tags;
+        table->buckets = buckets;
+        table->hashes = hashes;
+        return 1;
+    }
+    for (WV_U32 i = 0; i < bucket_count; i += 1) {
+        for (WV_U32 j = 0; j < WV_CUCKOO_SLOTS; j += 1) {
+            if (((WV_U8 *)&tags[i])[j] == 0) {
+                continue;
+            }
+            WV_Any object = buckets[i].objects[j];
+            WV_U32 hash = hashes[i * WV_CUCKOO_SLOTS + j];
+            while (_CuckooPlace(table, &object, &hash)) {
+                // unlikely right after doubling, the nested growth moves
+                // what has been placed so far, and we continue with the rest
+                if (_CuckooGrow(table)) {
+                    return 1;
+                }
+            }
+        }
+    }
+    WV_Free(tags);
+    WV_Free(buckets);
+    WV_Free(hashes);
+    return 0;
+}
+
+static inline WV_U8 WV_InitCuckooTable(WV_CuckooTable *table, WV_U32 key_size, WV_U32 size)
+{
+    table->count = 0;
+    table->key_size = key_size;
+    table->kick = 0;
+    if (size < WV_CONFIG_TableInitSize) {
+        size = WV_CONFIG_TableInitSize;
+    }
+    // cuckoo with 8-slot buckets is fine with load factor up to 90%
+    return _CuckooAllocBuckets(table, _TableRoundUp((size + size / 8) / WV_CUCKOO_SLOTS));
+}
+
+static inline WV_U8 WV_CuckooTableInsert(WV_CuckooTable *table, WV_Any object, WV_U32 hash)
+{
+    while (_CuckooPlace(table, &object, &hash)) {
+        if (_CuckooGrow(table)) {
+            return 1;
+        }
+    }
+    table->count += 1;
+    return 0;
+}
+
+static inline WV_Any WV_CuckooTableSearch(WV_CuckooTable *table, const void *key, WV_U32 hash)
+{
+    WV_U8 tag = _CuckooTag(hash);
+    WV_U32 bucket = hash & table->mask;
+    for (WV_U32 n = 0; n < 2; n += 1) {
+        for (WV_U32 match = _CuckooMatch(table, bucket, tag); match != 0; match &= match - 1) {
+            WV_Any object = table->buckets[bucket].objects[__builtin_ctz(match)];
+            if (memcmp(object, key, table->key_size) == 0) {
+                return object;
+            }
+        }
+        bucket = _CuckooAlt(table, bucket, tag);
+    }
+    return NULL;
+}
+
+// request tags of both buckets and objects of the first one that searching
+// `hash` reads, for batched lookups
+static inline void WV_CuckooTablePrefetch(const WV_CuckooTable *table, WV_U32 hash)
+{
+    WV_U32 bucket = hash & table->mask;
+    WV_Prefetch(&table->tags[bucket]);
+    WV_Prefetch(&table->tags[_CuckooAlt(table, bucket, _CuckooTag(hash))]);
+    WV_Prefetch(&table->buckets[bucket]);
+}
+
+static inline WV_Any WV_CuckooTableRemove(WV_CuckooTable *table, WV_Any object, WV_U32 hash)
+{
+    WV_U8 tag = _CuckooTag(hash);
+    WV_U32 bucket = hash & table->mask;
+    for (WV_U32 n = 0; n < 2; n += 1) {
+        for (WV_U32 match = _CuckooMatch(table, bucket, tag); match != 0; match &= match - 1) {
+            WV_U32 slot = __builtin_ctz(match);
+            if (table->buckets[bucket].objects[slot] == object) {
+                _CuckooSetTag(table, bucket, slot, 0);
+                table->count -= 1;
+                return object;
+            }
+        }
+        bucket = _CuckooAlt(table, bucket, tag);
+    }
+    return NULL;
+}
+
+static inline WV_U8 WV_CleanCuckooTable(WV_CuckooTable *table)
+{
+    WV_Free(table->tags);
+    WV_Free(table->buckets);
+    WV_Free(table->hashes);
+    table->tags = NULL;
+    table->buckets = NULL;
+    table->hashes = NULL;
+    table->count = 0;
+    return 0;
+}
+
+// direct-mapped cache in front of a flow table, holding the last object found
+// for each hash slot, so that a train of packets of one flow skips probing the
+// table. Objects are compared by key the same way tables do, and an object
+// must be removed from cache before it is freed
+typedef struct {
+    WV_Any object;  // NULL for empty entry
+    WV_U32 hash;
+} WV_FlowCacheEntry;
+
+static inline WV_Any WV_FlowCacheSearch(
+    const WV_FlowCacheEntry *cache, WV_U32 mask, const void *key, WV_U32 key_size, WV_U32 hash)
+{
+    const WV_FlowCacheEntry *entry = &cache[hash & mask];
+    if (entry->object != NULL && entry->hash == hash && memcmp(entry->object, key, key_size) == 0) {
+        return entry->object;
+    }
+    return NULL;
+}
+
+static inline void WV_FlowCacheInsert(WV_FlowCacheEntry *cache, WV_U32 mask, WV_U32 hash, WV_Any object)
+{
+    if (object != NULL) {
+        cache[hash & mask].object = object;
+        cache[hash & mask].hash = hash;
+    }
+}
+
+static inline void WV_FlowCacheRemove(WV_FlowCacheEntry *cache, WV_U32 mask, WV_U32 hash, WV_Any object)
+{
+    if (cache[hash & mask].object == object) {
+        cache[hash & mask].object = NULL;
+    }
+}
+
+#endif
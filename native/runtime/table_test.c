@@ -0,0 +1,110 @@
+#include "table.h"
+#include <assert.h>
+#include <stdlib.h>
+#include <string.h>
+
+#define OBJECT_COUNT 20000
+
+typedef struct {
+  WV_U32 key[5];  // longer than inline key of open table
+  WV_U8 present;
+} Object;
+
+Object objects[OBJECT_COUNT];
+
+// poor hash on purpose, so that probing and displacement are exercised
+WV_U32 object_hash(const Object *object) {
+  return object->key[0] * 2654435761u % 4096 * 0x10001u;
+}
+
+void init_objects() {
+  for (int i = 0; i < OBJECT_COUNT; i += 1) {
+    memset(&objects[i], 0, sizeof(Object));
+    objects[i].key[0] = i;
+    objects[i].key[4] = i * 7;
+  }
+}
+
+#define probe_all(table, Search)                                         \
+  for (int i = 0; i < OBJECT_COUNT; i += 1) {                            \
+    Object probe = objects[i];                                           \
+    WV_Any found = Search(table, &probe, object_hash(&objects[i]));      \
+    assert(found == (objects[i].present ? &objects[i] : NULL));          \
+  }
+
+#define TEST_TABLE(Table, Init, Insert, Search, Remove, Clean)                \
+  void test_##Table() {                                                     \
+    WV_##Table table;                                                       \
+    init_objects();                                                         \
+    Init(&table, sizeof(objects[0].key), 0);                                \
+    srand(42);                                                              \
+    for (int n = 0; n < OBJECT_COUNT * 8; n += 1) {                          \
+      Object *object = &objects[rand() % OBJECT_COUNT];                     \
+      WV_U32 hash = object_hash(object);                                    \
+      Object probe = *object;                                               \
+      Object *found = Search(&table, &probe, hash);                         \
+      assert(found == (object->present ? object : NULL));                   \
+      if (object->present) {                                                \
+        assert(Remove(&table, object, hash) == object);                     \
+        object->present = 0;                                                \
+      } else {                                                              \
+        assert(Insert(&table, object, hash) == 0);                          \
+        object->present = 1;                                                \
+      }                                                                     \
+    }                                                                       \
+    probe_all(&table, Search);                                              \
+    for (int i = 0; i < OBJECT_COUNT; i += 1) {                             \
+      if (!objects[i].present) {                                            \
+        assert(Insert(&table, &objects[i], object_hash(&objects[i])) == 0); \
+        objects[i].present = 1;                                             \
+      }                                                                     \
+    }                                                                       \
+    assert(table.count == OBJECT_COUNT);                                    \
+    probe_all(&table, Search);                                              \
+    Clean(&table);                                                          \
+  }
+
+TEST_TABLE(OpenTable, WV_InitOpenTable, WV_OpenTableInsert,
+  WV_OpenTableSearch, WV_OpenTableRemove, WV_CleanOpenTable)
+TEST_TABLE(CuckooTable, WV_InitCuckooTable, WV_CuckooTableInsert,
+  WV_CuckooTableSearch, WV_CuckooTableRemove, WV_CleanCuckooTable)
+
+// cache agrees with table as objects come and go, however slots collide
+void test_FlowCache() {
+  WV_OpenTable table;
+  WV_FlowCacheEntry cache[16];
+  init_objects();
+  WV_InitOpenTable(&table, sizeof(objects[0].key), 0);
+  memset(cache, 0, sizeof(cache));
+  srand(42);
+  for (int n = 0; n < OBJECT_COUNT * 4; n += 1) {
+    Object *object = &objects[rand() % 64];
+    Object probe = *object;
+    WV_U32 hash = object_hash(object);
+    WV_Any found = WV_FlowCacheSearch(cache, 15, &probe, sizeof(probe.key), hash);
+    assert(found == NULL || found == object);
+    if (found == NULL) {
+      found = WV_OpenTableSearch(&table, &probe, hash);
+      WV_FlowCacheInsert(cache, 15, hash, found);
+    }
+    assert(found == (object->present ? object : NULL));
+    if (object->present && rand() % 4 == 0) {
+      WV_FlowCacheRemove(cache, 15, hash, object);
+      assert(WV_OpenTableRemove(&table, object, hash) == object);
+      object->present = 0;
+    } else if (!object->present) {
+      assert(WV_OpenTableInsert(&table, object, hash) == 0);
+      object->present = 1;
+    }
+  }
+  WV_CleanOpenTable(&table);
+}
+
+void (*TESTCASES[])() = {test_OpenTable, test_CuckooTable, test_FlowCache, NULL};
+
+int main() {
+  for (int i = 0; TESTCASES[i] != NULL; i += 1) {
+    TESTCASES[i]();
+  }
+  return 0;
+}
@@ -2,9 +2,27 @@
 #define WEAVER_NATIVE_RUNTIME_TIMER_H
 
 #include "types.h"
-#include <sys/time.h>
 
+#ifndef TIMEOUT
 #define TIMEOUT 30
+#endif
+
+// timestamps are in seconds of the runtime's clock, which is provided by driver
+// along with each packet (e.g. capture time) instead of read from system here
+
+// instances of a layer are kept in a list ordered by last update, head is the
+// most recent one, so the expired instances are always a suffix of the list
+// at most this many of them are destroyed per layer per packet, to spread a
+// mass expiry over the following packets instead of stalling on one
+#ifndef WV_CONFIG_TimerBudget
+#define WV_CONFIG_TimerBudget 4
+#endif
+
+// when a layer with instance limit evicts by state, at most this many least
+// recently updated instances are checked before the last one is chosen
+#ifndef WV_CONFIG_EvictScan
+#define WV_CONFIG_EvictScan 8
+#endif
 
 #define TIMER_FIELDS(inst_type) \
     inst_type *inst_type##_timer_head, *inst_type##_timer_last;
@@ -26,27 +44,38 @@
         rt->inst_type##_timer_head->prev = inst; \
         rt->inst_type##_timer_head = inst; \
     } \
-    struct timeval tv; \
-    gettimeofday(&tv, NULL); \
-    inst->last_update = tv.tv_sec
+    inst->last_update = rt->now
 
-#define TIMER_FETCH(rt, inst_type, inst) \
+#define TIMER_REMOVE(rt, inst_type, inst) \
     if (inst->prev != NULL) { \
         inst->prev->next = inst->next; \
+    } else { \
+        rt->inst_type##_timer_head = inst->next; \
     } \
     if (inst->next != NULL) { \
         inst->next->prev = inst->prev; \
     } else { \
         rt->inst_type##_timer_last = inst->prev; \
-    } \
+    }
+
+#define TIMER_EXPIRED(rt, inst_type, timeout, now) \
+    (rt->inst_type##_timer_last != NULL && \
+        rt->inst_type##_timer_last->last_update + (timeout) < (now))
+
+// move to head, nothing to do if inst is already head
+#define TIMER_FETCH(rt, inst_type, inst) \
     if (inst->prev != NULL) { \
+        inst->prev->next = inst->next; \
+        if (inst->next != NULL) { \
+            inst->next->prev = inst->prev; \
+        } else { \
+            rt->inst_type##_timer_last = inst->prev; \
+        } \
         inst->prev = NULL; \
         inst->next = rt->inst_type##_timer_head; \
         rt->inst_type##_timer_head->prev = inst; \
         rt->inst_type##_timer_head = inst; \
     } \
-    struct timeval tv; \
-    gettimeofday(&tv, NULL); \
-    inst->last_update = tv.tv_sec
+    inst->last_update = rt->now
 
 #endif
\ No newline at end of file
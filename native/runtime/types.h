@@ -40,6 +40,8 @@ typedef struct _WV_ByteSlice {
     WV_U32 length;
 } WV_ByteSlice;
 
+#define WV_Prefetch(addr) __builtin_prefetch(addr)
+
 static const WV_ByteSlice WV_EMPTY = { .cursor = NULL, .length = 0 };
 
 static inline WV_ByteSlice WV_SliceAfter(WV_ByteSlice slice, WV_U32 index)
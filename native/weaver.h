@@ -3,8 +3,12 @@
 #define WV_WEAVER_H
 
 #include "runtime/malloc.h"
+#include "runtime/metrics.h"
+#include "runtime/pool.h"
 #include "runtime/profile.h"
+#include "runtime/rss.h"
 #include "runtime/seq.h"
+#include "runtime/table.h"
 #include "runtime/types.h"
 #include "runtime/timer.h"
 #include <stdlib.h>
@@ -12,10 +16,18 @@
 
 // implemented by blackbox
 typedef struct _WV_Runtime WV_Runtime;
-WV_U8 WV_ProcessPacket(WV_ByteSlice, WV_Runtime *);
+// the WV_U64 argument is current time in seconds, must not go backward
+WV_U8 WV_ProcessPacket(WV_ByteSlice, WV_U64, WV_Runtime *);
+// the array holds NIC RSS hash of each packet (see runtime/rss.h) or NULL for
+// the packets without one, the array itself is NULL if driver gives no hash
+WV_U8 WV_ProcessBurst(WV_ByteSlice *, WV_U16, WV_U8 *, const WV_U32 *const *, WV_U64, WV_Runtime *);
 WV_Runtime *WV_AllocRuntime();
 WV_U8 WV_FreeRuntime(WV_Runtime *);
 WV_Profile *WV_GetProfile(WV_Runtime *);
+// fill snapshot of counters, packets and bytes are the ones recorded to profile
+WV_U8 WV_GetMetrics(WV_Runtime *, WV_Metrics *);
+// print cycles of each layer and stage, 1 if not generated with --stage-profile
+WV_U8 WV_StageProfilePrint(WV_Runtime *);
 // blackbox implemented end
 
 // implemented by whitebox
@@ -6,6 +6,12 @@ from rubik.compile2 import compile7_stack, compile7w_stack
 
 
 stack = import_module(argv[1]).stack
+# attribute cycles to each layer and stage, see WV_StageProfilePrint
+stack.context.stage_profile = "--stage-profile" in argv[2:]
+# generate full path only, to check header prediction against it
+if "--no-fast-path" in argv[2:]:
+    for layer in stack.name_map.values():
+        layer.layer.context.fast_path = None
 block_map = {
     # layer.layer.context.layer_id: compile5a_layer(layer.layer)
     layer.layer.context.layer_id: compile5a_layer(layer.layer).optimize(
@@ -25,6 +31,7 @@ print("/* Weaver Auto-generated Blackbox Code */")
 print(
     compile7_stack(
         stack.context, block_map, inst_decls, stack.entry.layer.context.layer_id,
-        {layer.layer.context.layer_id: layer.layer.context for layer in stack.name_map.values()}
+        {layer.layer.context.layer_id: layer.layer.context for layer in stack.name_map.values()},
+        {layer.layer.context.layer_id: name for name, layer in stack.name_map.items()},
     )
 )
@@ -0,0 +1,142 @@
+"""Benchmark every stock stack over pcap workloads.
+
+For each stack the blackbox is generated, built with `-O3` against the
+`native/drivers/bench.c` driver and the whitebox template, and replayed from
+memory. Results of all stacks are written to one JSON file, which can be given
+as `--baseline` of a later run to compare against.
+
+    python3 -m rubik.bench [stack ...] [--workload DIR] [--duration SEC]
+        [--output FILE] [--baseline FILE]
+
+Workload of stack `stock.X` is `X.pcap` in the workload directory. When it is
+missing, it is generated by `rubik.traffic` with default parameters.
+"""
+
+from argparse import ArgumentParser
+from json import dump, load, loads
+from pathlib import Path
+from subprocess import run, PIPE, CalledProcessError
+from sys import executable, stderr
+from time import time
+
+from rubik.traffic import Traffic, WORKLOADS
+
+STACKS = ["stock.tcp_ip", "stock.gtp", "stock.pptp", "stock.quic", "stock.sctp"]
+SEPARATOR = "/* Weaver Auto-generated Blackbox Code */"
+ROOT = Path(__file__).resolve().parent.parent
+BUILD_DIR = ROOT / "build" / "bench"
+CFLAGS = ["-m64", "-O3", "-DNDEBUG", "-DWV_TARGET_pcap"]
+INCLUDES = ["-Inative", "-Inative/runtime", "-Inative/runtime/tommyds"]
+LIBS = ["-lpcap"]
+
+
+# generate and build benchmark executable of a stack, return its path
+def build(stack, cc):
+    out_dir = BUILD_DIR / stack
+    out_dir.mkdir(parents=True, exist_ok=True)
+    generated = run(
+        [executable, "-m", "rubik", stack],
+        cwd=ROOT, stdout=PIPE, universal_newlines=True, check=True,
+    ).stdout
+    whitebox, blackbox = generated.split(SEPARATOR, 1)
+    (out_dir / "weaver_whitebox.c").write_text(whitebox)
+    (out_dir / "weaver_blackbox.c").write_text(SEPARATOR + blackbox)
+    app = out_dir / "bench"
+    run(
+        [
+            cc, *CFLAGS, "-o", str(app),
+            str(out_dir / "weaver_blackbox.c"), str(out_dir / "weaver_whitebox.c"),
+            "native/drivers/bench.c", "native/runtime/libwvrt.a",
+            *INCLUDES, *LIBS,
+        ],
+        cwd=ROOT, check=True,
+    )
+    return app
+
+
+def bench(stack, workload_dir, duration, cc):
+    workload = stack.split(".")[-1]
+    pcap = Path(workload_dir) / (workload + ".pcap")
+    if not pcap.exists():
+        if workload not in WORKLOADS:
+            return {"stack": stack, "error": f"no workload {pcap}"}
+        pcap.parent.mkdir(parents=True, exist_ok=True)
+        Traffic().write(workload, pcap)
+    try:
+        app = build(stack, cc)
+        output = run(
+            [str(app), "--duration", str(duration), str(pcap)],
+            stdout=PIPE, universal_newlines=True, check=True,
+        ).stdout
+    except CalledProcessError as error:
+        return {"stack": stack, "error": str(error)}
+    return {"stack": stack, **loads(output)}
+
+
+def compare(results, baseline):
+    baseline = {result["stack"]: result for result in baseline["results"]}
+    for result in results:
+        base = baseline.get(result["stack"])
+        if "error" in result or base is None or "error" in base:
+            continue
+        print(
+            f"{result['stack']:16}"
+            f"{result['mpps']:10.3f} Mpps ({result['mpps'] / base['mpps'] - 1:+.1%})"
+            f"{result['cycles_per_packet']:10.1f} cycles/packet "
+            f"({result['cycles_per_packet'] / base['cycles_per_packet'] - 1:+.1%})"
+        )
+
+
+def git_commit():
+    commit = run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        cwd=ROOT, stdout=PIPE, stderr=PIPE, universal_newlines=True,
+    )
+    return commit.stdout.strip() if commit.returncode == 0 else None
+
+
+def main():
+    parser = ArgumentParser(prog="python3 -m rubik.bench")
+    parser.add_argument("stacks", nargs="*", default=STACKS)
+    parser.add_argument("--workload", default=str(BUILD_DIR / "workload"))
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--output", default=str(BUILD_DIR / "results.json"))
+    parser.add_argument("--baseline")
+    parser.add_argument("--cc", default="gcc")
+    args = parser.parse_args()
+
+    run(["make", "-C", "native/runtime"], cwd=ROOT, stdout=PIPE, check=True)
+    results = []
+    for stack in args.stacks:
+        result = bench(stack, args.workload, args.duration, args.cc)
+        if "error" in result:
+            print(f"{stack}: {result['error']}", file=stderr)
+        else:
+            print(
+                f"{stack}: {result['mpps']:.3f} Mpps, {result['gbps']:.3f} Gbps, "
+                f"{result['cycles_per_packet']:.1f} cycles/packet, "
+                f"peak RSS {result['peak_rss_kb']} KB"
+            )
+        results.append(result)
+
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w") as output:
+        dump(
+            {
+                "commit": git_commit(),
+                "time": time(),
+                "cflags": CFLAGS,
+                "duration": args.duration,
+                "results": results,
+            },
+            output,
+            indent=2,
+        )
+    if args.baseline is not None:
+        with open(args.baseline) as baseline:
+            compare(results, load(baseline))
+    return any("error" in result for result in results)
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -42,20 +42,20 @@ from rubik.compile2 import (
     compile6_inst_type,
     compile6_prefetch_type,
     compile6_content,
-    compile6_need_free,
     compile6_struct_expr,
     compile6_inst_expr,
     compile6_prefetch_expr,
     compile7_decl_inst,
     compile7_decl_bi_inst,
 )
-from rubik.util import code_comment, comment_only, indent_join
+from rubik.util import code_comment, comment_only, indent_join, make_block
 
 
 class StackContext:
     RUNTIME, HEADER, INSTANCE, SEQUENCE = 0, 1, 2, 3
 
     def __init__(self):
+        self.stage_profile = False  # count cycles of each layer and stage
         self.reg_count = 100
         self.struct_count = 0
         self.reg_map = {}  # reg(aka int) -> HeaderReg/TempReg/InstReg
@@ -73,6 +73,31 @@ class LayerContext:
         self.seq = None
         self.perm_regs = []
         self.buffer_data = True
+        self.timeout = None
+        self.limit = None
+        self.evict = "lru"  # or "reject", or list of state ids to evict first
+        self.state_reg = None
+        self.prealloc_count = 0  # instances allocated by pool at start
+        self.table = "tommy"  # flow table backend, "tommy"/"open"/"cuckoo"
+        # expected number of entries, "open"/"cuckoo" tables are allocated for
+        # it at start. "tommy" (linear hashing) grows and shrinks step by step
+        # with its content and cannot keep a size, so it takes none
+        self.table_size = 0
+        # take flow hash from driver (symmetric NIC RSS) when it is given, and
+        # hash the same way in software otherwise, layer must be keyed by the
+        # outermost IPv4 address pair and its own port pair, see
+        # compile5_check_packet_hash
+        self.packet_hash = False
+        # bidirectional instance is stored once under the key with the lower
+        # half first, instead of once for each direction
+        self.canonical_key = False
+        # entries of direct-mapped cache of recently fetched instances, which is
+        # checked before flow table, power of two or 0 for no cache
+        self.flow_cache = 64
+        # predicate of header fields, packet satisfying it skips instance lookup
+        self.stateless = None
+        # predicate of the common case, layer is also compiled under it
+        self.fast_path = None
         self.layout_map = {}  # rubik.lang.layout -> reg(aka int)
         self.vexpr_map = {}  # id(<someone impl compile4>(aka expr)) -> reg(aka int)
         self.event_map = {}  # rubik.lang.Event -> var(aka Bit/AutoVar/InstVar)
@@ -134,10 +159,30 @@ class LayerContext:
     def prealloc_expr6(self):
         return f"runtime->l{self.layer_id}_p"
 
+    @property
+    def pool_expr6(self):
+        return f"&runtime->m{self.layer_id}"
+
+    @property
+    def seq_pool_expr6(self):
+        return f"&runtime->s{self.layer_id}"
+
     @property
     def inst_type6(self):
         return compile6_inst_type(self.layer_id)
 
+    @property
+    def count_expr6(self):
+        return f"runtime->n{self.layer_id}"
+
+    @property
+    def counter_expr6(self):
+        return f"runtime->c{self.layer_id}"
+
+    @property
+    def timeout_expr6(self):
+        return "TIMEOUT" if self.timeout is None else str(self.timeout)
+
     @property
     def prefetch_type6(self):
         return compile6_prefetch_type(self.layer_id)
@@ -151,40 +196,150 @@ class LayerContext:
         return self.insert_stat7_impl("_rev")
 
     def insert_stat7_impl(self, postfix):
+        key6 = f"&{self.prealloc_expr6}->k{postfix}"
+        if self.table == "tommy":
+            return "\n".join(
+                [
+                    f"tommy_hashlin_insert(",
+                    f"  &runtime->t{self.layer_id}, &{self.prealloc_expr6}->node{postfix}, {key6},",
+                    f"  {self.prealloc_expr6}->h{postfix}",
+                    ");",
+                ]
+            )
         return "\n".join(
             [
-                f"tommy_hashdyn_insert(",
-                f"  &runtime->t{self.layer_id}, &{self.prealloc_expr6}->node{postfix}, &{self.prealloc_expr6}->k{postfix},",
-                f"  hash(&{self.prealloc_expr6}->k{postfix}, sizeof(L{self.layer_id}K))",
+                f"WV_{self.table_name6}Insert(",
+                f"  &runtime->t{self.layer_id}, {key6}, {self.prealloc_expr6}->h{postfix}",
                 ");",
             ]
         )
 
     @property
     def search_expr6(self):
+        key6 = f"&{self.prealloc_expr6}->k"
+        if self.table == "tommy":
+            return "\n".join(
+                [
+                    f"tommy_hashlin_search(",
+                    f"  &runtime->t{self.layer_id}, l{self.layer_id}_eq, {key6}, {self.hash_expr6}",
+                    ")",
+                ]
+            )
         return "\n".join(
             [
-                f"tommy_hashdyn_search(",
-                f"  &runtime->t{self.layer_id}, l{self.layer_id}_eq, &{self.prealloc_expr6}->k,",
-                f"  hash(&{self.prealloc_expr6}->k, sizeof(L{self.layer_id}K))",
+                f"WV_{self.table_name6}Search(",
+                f"  &runtime->t{self.layer_id}, {key6}, {self.hash_expr6}",
                 ")",
             ]
         )
 
+    # request the memory that searching `hash6` reads first
+    def table_prefetch7(self, hash6):
+        if self.table == "tommy":
+            return f"WV_Prefetch(tommy_hashlin_bucket_ref(&runtime->t{self.layer_id}, {hash6}));"
+        return f"WV_{self.table_name6}Prefetch(&runtime->t{self.layer_id}, {hash6});"
+
+    @property
+    def flow_cache_args6(self):
+        return f"runtime->f{self.layer_id}, {self.flow_cache - 1}"
+
+    # search flow cache first, and remember what flow table finds
+    @property
+    def prefetch_stat7(self):
+        search7 = f"{self.prefetch_expr6} = {self.search_expr6};"
+        if not self.flow_cache:
+            return search7
+        return "\n".join(
+            [
+                f"{self.prefetch_expr6} = WV_FlowCacheSearch(",
+                f"  {self.flow_cache_args6}, &{self.prealloc_expr6}->k, sizeof(L{self.layer_id}K), {self.hash_expr6}",
+                ");",
+                f"if ({self.prefetch_expr6} == NULL) "
+                + make_block(
+                    search7
+                    + f"\nWV_FlowCacheInsert({self.flow_cache_args6}, {self.hash_expr6}, {self.prefetch_expr6});"
+                ),
+            ]
+        )
+
     @property
     def remove_stat7(self):
         return self.remove_stat7_impl("")
 
     def remove_stat7_impl(self, postfix):
-        return "\n".join(
+        key6 = f"&{self.inst_expr6}->k{postfix}"
+        if self.flow_cache:
+            # cached object is the stored one, i.e. key pointer
+            cache7 = f"WV_FlowCacheRemove({self.flow_cache_args6}, {self.inst_expr6}->h{postfix}, {key6});\n"
+        else:
+            cache7 = ""
+        if self.table == "tommy":
+            return cache7 + (
+                f"tommy_hashlin_remove_existing("
+                f"&runtime->t{self.layer_id}, &{self.inst_expr6}->node{postfix});"
+            )
+        # custom backends remove by the stored object (i.e. key) pointer
+        return cache7 + "\n".join(
             [
-                f"tommy_hashdyn_remove(",
-                f"  &runtime->t{self.layer_id}, l{self.layer_id}_eq, &{self.inst_expr6}->k{postfix},",
-                f"  hash(&{self.inst_expr6}->k{postfix}, sizeof(L{self.layer_id}K))",
+                f"WV_{self.table_name6}Remove(",
+                f"  &runtime->t{self.layer_id}, {key6}, {self.inst_expr6}->h{postfix}",
                 ");",
             ]
         )
 
+    @property
+    def swap_expr6(self):
+        return f"l{self.layer_id}_s"
+
+    @property
+    def hash_expr6(self):
+        return f"l{self.layer_id}_h"
+
+    # hash of prealloc key, computed once by prefetch and kept in instance
+    def hash_stat7(self, postfix=""):
+        key_hash6 = f"hash(&{self.prealloc_expr6}->k{postfix}, sizeof(L{self.layer_id}K))"
+        if postfix == "":
+            target6 = self.hash_expr6
+        else:
+            target6 = f"{self.prealloc_expr6}->h{postfix}"
+        if self.packet_hash:
+            # RSS hash is symmetric, so it is shared by both directions
+            if postfix != "":
+                return f"{target6} = {self.hash_expr6};"
+            (saddr, sport), (daddr, dport) = self.inst.key_regs1, self.inst.key_regs2
+            key6 = f"{self.prealloc_expr6}->k"
+            rss_hash6 = (
+                f"WV_RSSHashTuple({key6}._{saddr}, {key6}._{daddr}, "
+                f"{key6}._{sport}, {key6}._{dport})"
+            )
+            return f"{target6} = packet_hash != NULL ? *packet_hash : {rss_hash6};"
+        return f"{target6} = {key_hash6};"
+
+    @property
+    def table_name6(self):
+        return {"open": "OpenTable", "cuckoo": "CuckooTable"}[self.table]
+
+    @property
+    def table_type6(self):
+        if self.table == "tommy":
+            return "tommy_hashlin"
+        return f"WV_{self.table_name6}"
+
+    @property
+    def table_init7(self):
+        if self.table == "tommy":
+            return f"tommy_hashlin_init(&runtime->t{self.layer_id});"
+        return (
+            f"WV_Init{self.table_name6}("
+            f"&runtime->t{self.layer_id}, sizeof(L{self.layer_id}K), {self.table_size});"
+        )
+
+    @property
+    def table_clean7(self):
+        if self.table == "tommy":
+            return f"tommy_hashlin_done(&runtime->t{self.layer_id});"
+        return f"WV_Clean{self.table_name6}(&runtime->t{self.layer_id});"
+
     @property
     def remove_rev_stat7(self):
         return self.remove_stat7_impl("_rev")
@@ -193,10 +348,6 @@ class LayerContext:
     def content_expr6(self):
         return compile6_content(self.layer_id)
 
-    @property
-    def need_free_expr6(self):
-        return compile6_need_free(self.layer_id)
-
 
 # most of variables are declared by user through Bit/UInt of layouts
 # while there are still amount of variables are automatically generated
@@ -642,7 +793,7 @@ def compile5_assemble(context, set_opt=True):
             True,
             code_comment(
                 f"{context.content_expr6} = "
-                f"WV_SeqAssemble(&{context.prefetch_expr6}->seq, &{context.need_free_expr6}, {buffer_data});",
+                f"WV_SeqAssemble(&{context.prefetch_expr6}->seq, {buffer_data});",
                 "assemble",
             ),
             SetOptFlag("assemble") if set_opt else None,
@@ -695,6 +846,7 @@ def compile4_op2(name, expr1, expr2, context):
             compile6h_op2(name, expr1_4.compile6[0], expr2_4.compile6[0]),
             compile6h_op2(name, expr1_4.compile6[1], expr2_4.compile6[1]),
         ),
+        Eval3And(expr1_4, expr2_4) if name == "and" else None,
     )
 
 
@@ -706,6 +858,11 @@ class Eval1Op2:
 
     def eval1(self, context):
         expr1_eval1 = self.expr1.eval1(context)
+        # right side is not evaluated once left side decides, as C does
+        if self.name == "and" and not expr1_eval1:
+            return expr1_eval1
+        if self.name == "or" and expr1_eval1:
+            return expr1_eval1
         expr2_eval1 = self.expr2.eval1(context)
         if self.name == "add":
             return expr1_eval1 + expr2_eval1
@@ -800,14 +957,20 @@ def compile6h_op1(name, expr):
         assert False, f"unknown op1 {name}"
 
 
+# parsed flag of layout is only written by scanner as a whole, so it is never
+# known unless a taken branch has tested it
 def compile4_header_contain(layout, context):
+    reg = context.layout_map[layout]
     return Expr(
         {StackContext.HEADER},
-        Eval1Abstract(),
+        Eval1Op2(
+            "equal", Expr({reg}, Eval1Var(reg), None), compile4_const(1)
+        ),
         (
-            f"{context.stack.reg_map[context.layout_map[layout]].expr6} == 1",
+            f"{context.stack.reg_map[reg].expr6} == 1",
             f"<layout {layout.debug_name} is parsed>",
         ),
+        Eval3VarEqual(reg, compile4_const(1), context.stack.reg_map[reg].expr6),
     )
 
 
@@ -851,14 +1014,15 @@ def compile4_var_equal(var, expr, context):
             compile6h_op2("equal", var4.compile6[0], expr4.compile6[0]),
             compile6h_op2("equal", var4.compile6[1], expr4.compile6[1]),
         ),
-        Eval3VarEqual(reg, expr4),
+        Eval3VarEqual(reg, expr4, var4.compile6[0]),
     )
 
 
 class Eval3VarEqual:
-    def __init__(self, reg, expr):
+    def __init__(self, reg, expr, var6):
         self.reg = reg
         self.expr = expr
+        self.var6 = var6
 
     def eval3(self, context):
         try:
@@ -866,6 +1030,24 @@ class Eval3VarEqual:
         except NotConstant:
             pass
 
+    # (variable, constant) when tested against a constant, for switch dispatch
+    def case6(self):
+        try:
+            return self.var6, self.expr.eval1({})
+        except NotConstant:
+            return None
+
+
+# both sides of a taken conjunction are true
+class Eval3And:
+    def __init__(self, expr1, expr2):
+        self.expr1 = expr1
+        self.expr2 = expr2
+
+    def eval3(self, context):
+        self.expr1.eval3(context)
+        self.expr2.eval3(context)
+
 
 def compile5_assign_quic_uint(assign, context):
     reg = context.query(assign.var)
@@ -1078,7 +1260,13 @@ def compile5_inst(inst, context):
         *init_stats,
         *inst.compile5_create_extra(context),
     ]
-    return [
+    load_seq = UpdateReg(
+        StackContext.SEQUENCE,
+        Expr({StackContext.INSTANCE}, Eval1Abstract(), None),
+        False,
+        comment_only("load sequence state from instance"),
+    )
+    lookup_stats = [
         UpdateReg(
             StackContext.INSTANCE,
             Expr(set(inst.key_regs), Eval1Abstract(), None),
@@ -1094,13 +1282,32 @@ def compile5_inst(inst, context):
             fetch_route,
             create_route,
         ),
+        load_seq,
+    ]
+    if context.stateless is None:
+        return lookup_stats
+    # packet that never belongs to an existing instance skips lookup, and
+    # creates instance with key and hash that prefetch would set, which turns
+    # into light instance on paths that destroy it as well
+    stateless4 = context.stateless.compile4(context)
+    assert all(
+        isinstance(context.stack.reg_map.get(reg), HeaderReg)
+        for reg in stateless4.read_regs
+    ), "stateless predicate should only read header fields"
+    lazy_route = [
         UpdateReg(
-            StackContext.SEQUENCE,
-            Expr({StackContext.INSTANCE}, Eval1Abstract(), None),
-            False,
-            comment_only("load sequence state from instance"),
+            StackContext.INSTANCE,
+            Expr(set(inst.key_regs), Eval1Abstract(), None),
+            True,
+            inst.prefetch(context, False).compile7
+            + "\n"
+            + inst.create(context).compile7,
+            SetOptFlag("create"),
         ),
+        *create_route[1:],
+        load_seq,
     ]
+    return [Branch(stateless4, lazy_route, lookup_stats)]
 
 
 class DeclInst:
@@ -1116,8 +1323,9 @@ class FetchInst:
         ) + f"\nTIMER_FETCH(runtime, {context.inst_type6}, {context.inst_expr6});"
 
 
+# set key and hash it, then search for instance unless `search` is false
 class PrefetchInst:
-    def __init__(self, context):
+    def __init__(self, context, search=True):
         self.compile7 = "\n".join(
             [
                 *[
@@ -1129,27 +1337,118 @@ class PrefetchInst:
                     )
                     for reg in context.inst.key_regs
                 ],
+                code_comment(context.hash_stat7(), "hash key"),
+                *(
+                    [code_comment(context.prefetch_stat7, "prefetch instance")]
+                    if search
+                    else []
+                ),
+            ],
+        )
+
+
+class PrefetchBiInst:
+    def __init__(self, context, search=True):
+        if not context.canonical_key:
+            self.compile7 = PrefetchInst(context, search).compile7
+            return
+        key6 = f"&{context.prealloc_expr6}->k"
+        self.compile7 = "\n".join(
+            [
+                *[
+                    code_comment(
+                        "\n".join(
+                            [
+                                context.stack.reg_map[reg].assign_key7(
+                                    f"{context.prealloc_expr6}->k"
+                                ),
+                                context.stack.reg_map[reg].assign_key7(
+                                    f"{context.prealloc_expr6}->k_rev"
+                                ),
+                            ]
+                        ),
+                        f"set key for {context.stack.reg_map[reg].debug_name}",
+                    )
+                    for reg in context.inst.key_regs
+                ],
                 code_comment(
-                    f"{context.prefetch_expr6} = {context.search_expr6};",
-                    "prefetch instance",
+                    f"{context.swap_expr6} = memcmp({key6}, {key6}_rev, sizeof(L{context.layer_id}K)) > 0;\n"
+                    f"if ({context.swap_expr6}) memcpy({key6}, {key6}_rev, sizeof(L{context.layer_id}K));",
+                    "put lower key half first",
+                ),
+                code_comment(context.hash_stat7(), "hash key"),
+                *(
+                    [
+                        code_comment(context.prefetch_stat7, "prefetch instance"),
+                        # instance is stored by its first half, which belongs
+                        # to the direction of creating packet
+                        code_comment(
+                            f"if ({context.prefetch_expr6} != NULL && "
+                            f"{context.swap_expr6} != (({context.inst_type6} *){context.prefetch_expr6})->swap) "
+                            f"{context.prefetch_expr6} = (WV_Any)((WV_Byte *){context.prefetch_expr6} + sizeof({context.prefetch_type6}));",
+                            "switch to reversed half",
+                        ),
+                    ]
+                    if search
+                    else []
                 ),
             ],
         )
 
 
+# make room for a new instance when the layer is full, by destroying a victim
+# or leaving the layer
+def compile7_evict(context):
+    if context.limit is None:
+        return []
+    if context.evict == "reject":
+        return [
+            code_comment(
+                f"if ({context.count_expr6} >= {context.limit}) "
+                + make_block(f"{context.counter_expr6}.reject_count += 1;\ngoto G_Shower;"),
+                "reject new instance",
+            )
+        ]
+    stats = [
+        f"{context.counter_expr6}.evict_count += 1;",
+        f"{context.inst_expr6} = runtime->{context.inst_type6}_timer_last;",
+    ]
+    if isinstance(context.evict, list):
+        state6 = f"victim->_{context.state_reg}"
+        pred6 = " || ".join(f"{state6} == {state_id}" for state_id in context.evict)
+        stats.append(
+            f"{context.inst_type6} *victim = {context.inst_expr6};\n"
+            f"for (WV_U32 n = 0; victim != NULL && n < WV_CONFIG_EvictScan; victim = victim->prev, n += 1) "
+            + make_block(
+                f"if ({pred6}) " + make_block(f"{context.inst_expr6} = victim;\nbreak;")
+            )
+        )
+    stats.append(context.inst.destroy(context).compile7)
+    return [
+        code_comment(
+            f"if ({context.count_expr6} >= {context.limit}) " + indent_join(stats),
+            "evict instance",
+        )
+    ]
+
+
 class CreateInst:
     def __init__(self, context):
         self.compile7 = code_comment(
             "\n".join(
                 [
+                    *compile7_evict(context),
+                    f"{context.count_expr6} += 1;",
+                    f"{context.counter_expr6}.create_count += 1;",
+                    f"{context.prealloc_expr6}->h = {context.hash_expr6};",
                     context.insert_stat7,
                     f"{context.prefetch_expr6} = (WV_Any)({context.inst_expr6} = {context.prealloc_expr6});",
                     f"{context.inst_expr6}->user_data = NULL;",
-                    f"WV_InitSeq(&{context.inst_expr6}->seq, {int(context.buffer_data)}, {int(context.seq.zero_based)});"
+                    f"WV_InitSeq(&{context.inst_expr6}->seq, {context.inst_expr6}->seq_nodes, {context.seq_pool_expr6}, {int(context.buffer_data)}, {int(context.seq.zero_based)});"
                     if context.seq is not None
                     else "// no seq",
                     f"TIMER_INSERT(runtime, {context.inst_type6}, {context.inst_expr6});",
-                    f"{context.prealloc_expr6} = WV_Malloc(sizeof({context.inst_type6}));",
+                    f"{context.prealloc_expr6} = WV_PoolAlloc({context.pool_expr6});",
                     f"memset({context.prealloc_expr6}, 0, sizeof({context.inst_type6}));",
                 ]
             ),
@@ -1164,7 +1463,7 @@ class BiInst:
         self.dual_regs = dual_regs
         self.inst_regs = inst_regs
         self.key_regs = self.key_regs1 + self.key_regs2 + self.dual_regs
-        self.prefetch = PrefetchInst  # same as Inst
+        self.prefetch = PrefetchBiInst
         self.create = CreateBiInst
         self.create_light = CreateLightBiInst
         self.fetch = FetchBiInst
@@ -1238,23 +1537,38 @@ class CreateBiInst:
                             f"set reversed key for {context.stack.reg_map[reg].debug_name}",
                         )
                         for reg in context.inst.key_regs
+                        if not context.canonical_key  # set by prefetch
                     ],
-                    context.insert_stat7,
-                    context.insert_rev_stat7,
+                    *compile7_evict(context),
+                    f"{context.count_expr6} += 1;",
+                    f"{context.counter_expr6}.create_count += 1;",
+                    f"{context.prealloc_expr6}->h = {context.hash_expr6};",
+                    *(
+                        [
+                            f"{context.prealloc_expr6}->swap = {context.swap_expr6};",
+                            context.insert_stat7,
+                        ]
+                        if context.canonical_key
+                        else [
+                            context.hash_stat7("_rev"),
+                            context.insert_stat7,
+                            context.insert_rev_stat7,
+                        ]
+                    ),
                     f"{context.prefetch_expr6} = (WV_Any)({context.inst_expr6} = {context.prealloc_expr6});",
                     f"{context.inst_expr6}->user_data = {context.inst_expr6}->user_data_rev = NULL;",
                     f"{context.inst_expr6}->flag = 0;",
                     f"{context.inst_expr6}->flag_rev = 1;",
                     *(
                         [
-                            f"WV_InitSeq(&{context.inst_expr6}->seq, {int(context.buffer_data)}, {int(context.seq.zero_based)});",
-                            f"WV_InitSeq(&{context.inst_expr6}->seq_rev, {int(context.buffer_data)}, {int(context.seq.zero_based)});",
+                            f"WV_InitSeq(&{context.inst_expr6}->seq, {context.inst_expr6}->seq_nodes, {context.seq_pool_expr6}, {int(context.buffer_data)}, {int(context.seq.zero_based)});",
+                            f"WV_InitSeq(&{context.inst_expr6}->seq_rev, {context.inst_expr6}->seq_rev_nodes, {context.seq_pool_expr6}, {int(context.buffer_data)}, {int(context.seq.zero_based)});",
                         ]
                         if context.seq is not None
                         else ["// no seq"]
                     ),
                     f"TIMER_INSERT(runtime, {context.inst_type6}, {context.inst_expr6});",
-                    f"{context.prealloc_expr6} = WV_Malloc(sizeof({context.inst_type6}));",
+                    f"{context.prealloc_expr6} = WV_PoolAlloc({context.pool_expr6});",
                     f"memset({context.prealloc_expr6}, 0, sizeof({context.inst_type6}));",
                 ]
             ),
@@ -1267,7 +1581,10 @@ class DestroyBiInst:
         self.compile7 = "\n".join(
             [
                 context.remove_stat7,
-                context.remove_rev_stat7,
+                context.remove_rev_stat7 if not context.canonical_key else "// no reversed entry",
+                f"{context.count_expr6} -= 1;",
+                f"{context.counter_expr6}.destroy_count += 1;",
+                f"TIMER_REMOVE(runtime, {context.inst_type6}, {context.inst_expr6});",
                 *(
                     [
                         f"WV_CleanSeq(&{context.inst_expr6}->seq, {int(context.buffer_data)});",
@@ -1276,7 +1593,7 @@ class DestroyBiInst:
                     if context.seq is not None
                     else ["// no seq"]
                 ),
-                f"WV_Free({context.inst_expr6});",
+                f"WV_PoolFree({context.pool_expr6}, {context.inst_expr6});",
             ]
         )
 
@@ -1286,10 +1603,13 @@ class DestroyInst:
         self.compile7 = "\n".join(
             [
                 context.remove_stat7,
+                f"{context.count_expr6} -= 1;",
+                f"{context.counter_expr6}.destroy_count += 1;",
+                f"TIMER_REMOVE(runtime, {context.inst_type6}, {context.inst_expr6});",
                 f"WV_CleanSeq(&{context.inst_expr6}->seq, {int(context.buffer_data)});"
                 if context.seq is not None
                 else "// no seq",
-                f"WV_Free({context.inst_expr6});",
+                f"WV_PoolFree({context.pool_expr6}, {context.inst_expr6});",
             ]
         )
 
@@ -1385,6 +1705,11 @@ def compile5_seq(seq, context, set_opt=True):
 # allocate layer according to prototype
 def compile3a_prototype(prototype, stack, layer_id, extra_event):
     context = LayerContext(layer_id, stack)
+    context.timeout = prototype.timeout
+    context.limit = prototype.limit
+    context.evict = prototype.evict
+    context.stateless = prototype.stateless
+    context.fast_path = prototype.fast_path
     scanner = prototype.header.compile1(context)
 
     # prototype.header.compile2(context)
@@ -1398,7 +1723,11 @@ def compile3a_prototype(prototype, stack, layer_id, extra_event):
         compile2_seq(prototype.seq, context)
     if prototype.psm is not None:
         context.alloc_inst_reg(InstVar.from_bit(prototype.current_state), "state")
+        context.state_reg = context.query(prototype.current_state)
         compile2_psm(prototype.psm, context)
+    if isinstance(prototype.evict, list):
+        assert prototype.psm is not None
+        context.evict = [state.state_id for state in prototype.evict]
 
     if prototype.selector is not None:
         assert context.inst is None
@@ -1447,20 +1776,98 @@ class Layer:
         self.prototype_event = prototype_event
         self.event = event
         self.next_list = []
+        self.prev_list = []
+
+
+def compile7_stage_mark(layer_id, stage):
+    return (
+        f"WV_StageMark(&runtime->stage, &runtime->stage_cycles[{layer_id}][WV_STAGE_{stage}]);"
+    )
+
+
+# cycles since the mark go to `stage`, the mark depends on all runtime states
+# so that instructions of neighbour stages are not reordered across it
+def compile5_stage_mark(stage, context):
+    if not context.stack.stage_profile:
+        return []
+    return [
+        UpdateReg(
+            StackContext.RUNTIME,
+            Expr(
+                {
+                    StackContext.RUNTIME,
+                    StackContext.HEADER,
+                    StackContext.INSTANCE,
+                    StackContext.SEQUENCE,
+                },
+                Eval1Abstract(),
+                None,
+            ),
+            False,
+            compile7_stage_mark(context.layer_id, stage),
+        )
+    ]
+
+
+# NIC RSS hashes IPv4 address pair and port pair of the transport header right
+# after it, a layer with packet_hash set must be keyed by exactly these fields,
+# otherwise its instances are hashed differently by whether the driver gives a
+# hash, and the same flow is searched under different hashes
+def compile5_check_packet_hash(layer):
+    context = layer.context
+    inst = context.inst
+    reg_map = context.stack.reg_map
+    assert (
+        isinstance(inst, BiInst) and not inst.dual_regs
+    ), "packet_hash needs a bidirectional key"
+    assert (
+        len(inst.key_regs1) == len(inst.key_regs2) == 2
+    ), "packet_hash needs key of address and port of each side"
+    assert all(
+        isinstance(reg_map[reg], HeaderReg) for reg in inst.key_regs
+    ), "packet_hash needs key of header fields"
+    (saddr, sport), (daddr, dport) = inst.key_regs1, inst.key_regs2
+    widths = [reg_map[reg].bit_length for reg in (saddr, daddr, sport, dport)]
+    assert widths == [32, 32, 16, 16], "packet_hash needs key of IPv4 addresses and ports"
+    assert {
+        reg_map[sport].struct_id,
+        reg_map[dport].struct_id,
+    } <= context.structs, "packet_hash needs ports of the layer's own header"
+    # RSS sees the outermost headers only, so the address layer must be reached
+    # from the entry layer directly, and nothing else may lead to this layer
+    assert len(layer.prev_list) == 1, "packet_hash layer must follow address layer only"
+    ip_layer = layer.prev_list[0]
+    assert {
+        reg_map[saddr].struct_id,
+        reg_map[daddr].struct_id,
+    } <= ip_layer.context.structs, "packet_hash needs addresses of the previous layer"
+    assert all(
+        not prev.prev_list for prev in ip_layer.prev_list
+    ), "packet_hash needs addresses of the outermost IP layer"
 
 
 def compile5a_layer(layer):
+    if layer.context.packet_hash:
+        compile5_check_packet_hash(layer)
+    assert (
+        layer.context.table != "tommy" or layer.context.table_size == 0
+    ), 'table_size needs "open" or "cuckoo" table'
     compile2_event_group(layer.prototype_event, layer.context)
     compile2_event_group(layer.event, layer.context)
 
-    instr_list = compile5_scanner(layer.scanner, layer.context)
+    instr_list = compile5_stage_mark("Parse", layer.context)
+    instr_list += compile5_scanner(layer.scanner, layer.context)
     if layer.context.inst is not None:
+        instr_list += compile5_stage_mark("Instance", layer.context)
         instr_list += layer.context.inst.compile5(layer.context)
+        instr_list += compile5_fast_path(layer.context)
     if layer.general is not None:
         instr_list += layer.general.compile5(layer.context)
     if layer.seq is not None:
+        instr_list += compile5_stage_mark("Sequence", layer.context)
         instr_list += compile5_seq(layer.seq, layer.context)
     if layer.psm is not None:
+        instr_list += compile5_stage_mark("PSM", layer.context)
         instr_list += layer.psm.compile0(layer.state_var).compile5(layer.context) + [
             UpdateReg(
                 StackContext.RUNTIME,
@@ -1492,6 +1899,7 @@ def compile5a_layer(layer):
             *layer.event.name_map.values(),
         ]
     }
+    instr_list += compile5_stage_mark("Event", layer.context)
     instr_list += [
         UpdateReg(
             layer.context.query(var),
@@ -1503,6 +1911,7 @@ def compile5a_layer(layer):
     ]
     instr_list += layer.prototype_event.compile0(event_var_map).compile5(layer.context)
     instr_list += layer.event.compile0(event_var_map).compile5(layer.context)
+    instr_list += compile5_stage_mark("Other", layer.context)
     instr_list += [
         UpdateReg(
             StackContext.RUNTIME,
@@ -1517,6 +1926,22 @@ def compile5a_layer(layer):
     return Block.from_codes(instr_list)
 
 
+# header prediction: the rest of layer is duplicated by a choice on the fast
+# path predicate, and on its taken side every `field == const` of the
+# conjunction is known, so that PSM, preparing and event branches decided by
+# them are folded away
+def compile5_fast_path(context):
+    if context.fast_path is None:
+        return []
+    fast_path4 = context.fast_path.compile4(context)
+    assert all(
+        isinstance(context.stack.reg_map.get(reg), (HeaderReg, InstReg))
+        for reg in fast_path4.read_regs
+        if reg not in (StackContext.HEADER, StackContext.INSTANCE)
+    ), "fast path predicate should only read header fields and instance variables"
+    return [Branch(fast_path4, [], [], True)]
+
+
 def compile5_finalize(layer, context):
     if layer.psm is not None:
         return [
@@ -1538,8 +1963,44 @@ def compile5_finalize(layer, context):
         return []
 
 
+# (guard, field test) of predicate `guard && field == const` (in either order)
+# with side effect free guard, or None
+def compile4_demux(pred4):
+    handler = pred4.eval1_handler
+    if not isinstance(handler, Eval1Op2) or handler.name != "and":
+        return None
+    for guard4, case4 in [
+        (handler.expr1, handler.expr2),
+        (handler.expr2, handler.expr1),
+    ]:
+        case6 = getattr(case4.eval3_handler, "case6", None)
+        if (
+            case6 is not None
+            and case6() is not None
+            and StackContext.SEQUENCE not in guard4.read_regs
+        ):
+            return guard4, case4
+    return None
+
+
+# guards that differ only in operand order of `&&`/`||` are the same guard, as
+# a demux guard reads no sequence and so has no side effect to order
+def compile4_guard_key(guard4):
+    handler = guard4.eval1_handler
+    if not isinstance(handler, Eval1Op2) or handler.name not in ("and", "or"):
+        return guard4.compile6[0]
+
+    def operand_list(expr4):
+        expr_handler = expr4.eval1_handler
+        if isinstance(expr_handler, Eval1Op2) and expr_handler.name == handler.name:
+            return operand_list(expr_handler.expr1) + operand_list(expr_handler.expr2)
+        return [compile4_guard_key(expr4)]
+
+    return handler.name, tuple(sorted(operand_list(guard4), key=str))
+
+
 def compile5_next_list(next_list, context, recursive):
-    stats = []
+    entries = []
     for pred, dst_layer in next_list:
         if recursive != (dst_layer.context.layer_id == context.layer_id):
             continue
@@ -1555,6 +2016,11 @@ def compile5_next_list(next_list, context, recursive):
                         f"goto L{dst_layer.context.layer_id};",
                         "B%%BLOCK_ID%%_R:",
                         "return_target = b%%BLOCK_ID%%_t;",
+                        *(
+                            [compile7_stage_mark(context.layer_id, "Other")]
+                            if context.stack.stage_profile
+                            else []
+                        ),
                     ]
                     if not recursive
                     else ["// recursive", f"goto L{dst_layer.context.layer_id};"]
@@ -1562,9 +2028,39 @@ def compile5_next_list(next_list, context, recursive):
                 f"jump to next layer #{dst_layer.context.layer_id}",
             ),
         )
-        # print('before', stats)
-        stats = [Branch(pred.compile4(context), [jump], stats)]
-        # print(stats, stats[0].no_list)
+        pred4 = pred.compile4(context)
+        demux = compile4_demux(pred4)
+        if demux is None:
+            key = None
+        else:
+            guard4, case4 = demux
+            key = compile4_guard_key(guard4), case4.eval3_handler.case6()[0]
+        entries.append((key, pred4, demux, jump))
+
+    # later layer is tested first, and consecutive layers behind the same guard
+    # test it once and then dispatch on the field, which becomes a switch when
+    # there are enough of them
+    stats = []
+    index = 0
+    while index < len(entries):
+        key = entries[index][0]
+        run = [entries[index]]
+        while (
+            key is not None
+            and index + len(run) < len(entries)
+            and entries[index + len(run)][0] == key
+        ):
+            run.append(entries[index + len(run)])
+        index += len(run)
+        if len(run) == 1:
+            _key, pred4, _demux, jump = run[0]
+            stats = [Branch(pred4, [jump], stats)]
+            continue
+        # packet passing guard but matching no field value goes on as well
+        dispatch = stats
+        for _key, _pred4, (_guard4, case4), jump in run:
+            dispatch = [Branch(case4, [jump], dispatch)]
+        stats = [Branch(run[0][2][0], dispatch, stats)]
 
     return stats
 
@@ -16,12 +16,60 @@ def compile7_branch(branch):
     )
 
 
-def compile7_block(block, is_entry, layer_id):
+# shortest chain of tests that is dispatched by a switch
+SWITCH_MIN_CASE = 3
+
+
+def compile6_case(pred):
+    case6 = getattr(pred.eval3_handler, "case6", None)
+    return case6() if case6 is not None else None
+
+
+# blocks testing one variable against constants, where every test but the first
+# one is all that its block does, are collapsed into (variable, [(constant,
+# target block)], default block, collapsed blocks), or None for shorter chain
+def switch_chain(block):
+    if block.pred is None or compile6_case(block.pred) is None:
+        return None
+    var6 = compile6_case(block.pred)[0]
+    cases, collapsed, current = {}, [], block
+    while True:
+        case = compile6_case(current.pred) if current.pred is not None else None
+        if case is None or case[0] != var6:
+            break
+        if current is not block:
+            if current.instr_list:
+                break
+            collapsed.append(current)
+        # later test of the same constant is never reached
+        cases.setdefault(case[1], current.yes_block)
+        current = current.no_block
+    if len(cases) < SWITCH_MIN_CASE:
+        return None
+    return var6, list(cases.items()), current, collapsed
+
+
+def compile7_block(block, is_entry, layer_id, chain=None):
     if is_entry:
         prefix = f"L{layer_id}: "
     else:
         prefix = f"B{block.block_id}: "
-    if block.pred is not None:
+    if chain is not None:
+        var6, cases, default, _collapsed = chain
+        escape = code_comment(
+            f"switch ({var6}) "
+            + indent_join(
+                [
+                    *[
+                        f"case {value}: goto B{target.block_id};"
+                        for value, target in cases
+                    ],
+                    f"default: goto B{default.block_id};",
+                ]
+            ),
+            f"SWITCH {var6}",
+        )
+    elif block.pred is not None:
         escape = code_comment(
             f"if ({block.pred.compile6[0]}) goto B{block.yes_block.block_id}; "
             f"else goto B{block.no_block.block_id};",
@@ -67,12 +115,14 @@ def decl_header_reg(reg):
     return f"{prefix} _{reg.reg_id}{postfix};  // {reg.debug_name}"
 
 
-def compile7_stack(stack, block_map, inst_decls, entry_id, layer_context_map):
+def compile7_stack(
+    stack, block_map, inst_decls, entry_id, layer_context_map, layer_names=None
+):
     struct7 = Template(
         r"""
 ## prefix7
 #include <weaver.h>
-#include <tommyds/tommyhashdyn.h>
+#include <tommyds/tommyhashlin.h>
 #if TOMMY_SIZE_BIT == 64
 #define hash(k, s) tommy_hash_u64(0, k, s)
 #else
@@ -105,22 +155,54 @@ int l${i}_eq(const void *key, const void *object) {
 ## runtime7
 struct _WV_Runtime {
   WV_Profile profile;
-  WV_U64 packet_count;
+  WV_U64 now;
+  % if stack.stage_profile:
+  WV_StageClock stage;
+  WV_U64 stage_cycles[${layer_count}][WV_STAGE_COUNT];
+  WV_U64 stage_last[${layer_count}];
+  WV_Histogram stage_latency[${layer_count}];
+  % endif
   % for i in range(layer_count):
   % if i in inst_decls:
   ${compile6_inst_type(i)} *l${i}_p;
-  tommy_hashdyn t${i};
+  WV_Pool m${i};
+  % if layer_context_map[i].seq is not None:
+  WV_SeqPool s${i};
+  % endif
+  ${layer_context_map[i].table_type6} t${i};
+  % if layer_context_map[i].flow_cache:
+  WV_FlowCacheEntry f${i}[${layer_context_map[i].flow_cache}];
+  % endif
+  WV_U32 n${i};
+  WV_InstanceCounter c${i};
   TIMER_FIELDS(${compile6_inst_type(i)})
   % endif
   % endfor
 };
 WV_Runtime *WV_AllocRuntime() {
   WV_Runtime *rt = WV_Malloc(sizeof(WV_Runtime));
-  rt->packet_count = 0;
+  WV_Runtime *runtime = rt;
+  rt->now = 0;
+  % if stack.stage_profile:
+  memset(&rt->stage, 0, sizeof(WV_StageClock));
+  rt->stage.current = &rt->stage.idle;
+  memset(rt->stage_cycles, 0, sizeof(rt->stage_cycles));
+  memset(rt->stage_last, 0, sizeof(rt->stage_last));
+  memset(rt->stage_latency, 0, sizeof(rt->stage_latency));
+  % endif
   % for i in range(layer_count):
   % if i in inst_decls:
-  tommy_hashdyn_init(&rt->t${i});
-  rt->l${i}_p = WV_Malloc(sizeof(${compile6_inst_type(i)}));
+  ${layer_context_map[i].table_init7}
+  % if layer_context_map[i].flow_cache:
+  memset(rt->f${i}, 0, sizeof(rt->f${i}));
+  % endif
+  rt->n${i} = 0;
+  memset(&rt->c${i}, 0, sizeof(WV_InstanceCounter));
+  WV_InitPool(&rt->m${i}, sizeof(${compile6_inst_type(i)}), ${layer_context_map[i].prealloc_count});
+  rt->l${i}_p = WV_PoolAlloc(&rt->m${i});
+  % if layer_context_map[i].seq is not None:
+  WV_InitSeqPool(&rt->s${i}, ${compile6_seq_config(layer_context_map[i].seq)});
+  % endif
   memset(rt->l${i}_p, 0, sizeof(${compile6_inst_type(i)}));
   TIMER_INIT(rt, ${compile6_inst_type(i)});
   % endif
@@ -128,27 +210,72 @@ WV_Runtime *WV_AllocRuntime() {
   return rt;
 }
 WV_U8 WV_FreeRuntime(WV_Runtime *rt) {
-  // todo
+  WV_Runtime *runtime = rt;
+  % for i in range(layer_count):
+  % if i in inst_decls:
+  while (rt->${compile6_inst_type(i)}_timer_last != NULL) {
+    ${compile6_inst_type(i)} *${layer_context_map[i].inst_expr6} = rt->${compile6_inst_type(i)}_timer_last;
+    ${layer_context_map[i].inst.destroy(layer_context_map[i]).compile7}
+  }
+  ${layer_context_map[i].table_clean7}
+  WV_CleanPool(&rt->m${i});
+  % if layer_context_map[i].seq is not None:
+  WV_CleanSeqPool(&rt->s${i});
+  % endif
+  % endif
+  % endfor
+  WV_Free(rt);
   return 0;
 }
 WV_Profile *WV_GetProfile(WV_Runtime *rt) {
   return &rt->profile;
 }
+_Static_assert(${len(inst_decls)} <= WV_METRICS_MAX_LAYER, "too many instance layers for WV_Metrics");
+WV_U8 WV_GetMetrics(WV_Runtime *rt, WV_Metrics *metrics) {
+  WV_LayerMetrics *layer = metrics->layers;
+  memset(metrics, 0, sizeof(WV_Metrics));
+  metrics->packet_count = rt->profile.total_packet_count;
+  metrics->byte_count = rt->profile.total_byte_count;
+  % for i in range(layer_count):
+  % if i in inst_decls:
+  strncpy(layer->name, "${layer_names[i]}", WV_METRICS_NAME_SIZE - 1);
+  layer->instance_count = rt->n${i};
+  layer->inst = rt->c${i};
+  % if layer_context_map[i].seq is not None:
+  layer->seq = rt->s${i}.counter;
+  % endif
+  layer += 1;
+  % endif
+  % endfor
+  metrics->layer_count = layer - metrics->layers;
+  return 0;
+}
+WV_U8 WV_StageProfilePrint(WV_Runtime *rt) {
+  % if stack.stage_profile:
+  static const char *const layer_names[] = {
+    % for i in range(layer_count):
+    "${layer_names[i]}",
+    % endfor
+  };
+  return WV_StagePrint(&rt->stage, (const WV_U64 (*)[WV_STAGE_COUNT])rt->stage_cycles, rt->stage_latency,
+    ${layer_count}, layer_names);
+  % else:
+  return 1;  // not generated with --stage-profile
+  % endif
+}
 WV_U8 TimerCleanup(WV_Runtime *rt) {
   WV_Runtime *runtime = rt;
-  struct timeval tv;
-  gettimeofday(&tv, NULL);
-  WV_U64 now = tv.tv_sec;
+  WV_U64 now = rt->now;
   % for i in range(layer_count):
   % if i in inst_decls:
-  <% last_ptr = f'rt->{compile6_inst_type(i)}_timer_last' %>
-  while (${last_ptr} != NULL && ${last_ptr}->last_update + TIMEOUT < now) {
-    ${compile6_inst_type(i)} *${layer_context_map[i].inst_expr6} = ${last_ptr};
+  % if stack.stage_profile:
+  WV_StageMark(&rt->stage, &rt->stage_cycles[${i}][WV_STAGE_Timer]);
+  % endif
+  for (WV_U32 n = 0; n < WV_CONFIG_TimerBudget &&
+      TIMER_EXPIRED(rt, ${compile6_inst_type(i)}, ${layer_context_map[i].timeout_expr6}, now); n += 1) {
+    ${compile6_inst_type(i)} *${layer_context_map[i].inst_expr6} = rt->${compile6_inst_type(i)}_timer_last;
+    rt->c${i}.expire_count += 1;
     ${layer_context_map[i].inst.destroy(layer_context_map[i]).compile7}
-    ${last_ptr} = ${last_ptr}->prev;
-  }
-  if (${last_ptr} == NULL) {
-    rt->${compile6_inst_type(i)}_timer_head = NULL;
   }
   % endif
   % endfor
@@ -162,30 +289,45 @@ WV_U8 TimerCleanup(WV_Runtime *rt) {
         compile6_key_type=compile6_key_type,
         compile6_inst_type=compile6_inst_type,
         decl_header_reg=decl_header_reg,
-        layer_context_map=layer_context_map
+        compile6_seq_config=compile6_seq_config,
+        layer_context_map=layer_context_map,
+        layer_names=layer_names or {i: f"layer{i}" for i in range(len(block_map))},
     )
 
     layer_count = len(block_map)
-    raw_blocks7 = {
-        block.block_id: compile7_block(block, block is entry, layer_id)
-        for layer_id, entry in block_map.items()
-        for block in entry.recursive()
-    }
+    raw_blocks7 = {}
+    for layer_id, entry in block_map.items():
+        collapsed = set()
+        for block in entry.recursive():
+            if block in collapsed:
+                continue
+            chain = switch_chain(block)
+            if chain is not None:
+                collapsed.update(chain[3])
+            raw_blocks7[block.block_id] = compile7_block(
+                block, block is entry, layer_id, chain
+            )
     blocks7 = {
         block_id: block7.replace("%%BLOCK_ID%%", str(block_id))
         for block_id, block7 in raw_blocks7.items()
     }
 
+    # packet_hash is NIC RSS hash given by driver, or NULL
     process7 = (
-        "WV_U8 WV_ProcessPacket(WV_ByteSlice packet, WV_Runtime *runtime) "
+        "static WV_U8 ProcessPacket("
+        "WV_ByteSlice packet, const WV_U32 *packet_hash, WV_U64 now, WV_Runtime *runtime) "
         + indent_join(
             [
-                *[
-                    'if (runtime->packet_count++ == 1000000) ' + make_block(
-                        'runtime->packet_count = 0;\n'
-                        'TimerCleanup(runtime);'
-                    )
-                ],
+                *(
+                    [
+                        "runtime->stage.packet_count += 1;",
+                        "runtime->stage.last = WV_Rdtsc();",
+                    ]
+                    if stack.stage_profile
+                    else []
+                ),
+                "runtime->now = now;",
+                "TimerCleanup(runtime);",
                 *[
                     f"H{struct} *{compile6_struct_expr(struct)};"
                     for struct in stack.struct_map
@@ -195,13 +337,18 @@ WV_U8 TimerCleanup(WV_Runtime *rt) {
                     for struct in stack.call_struct.values()
                 ],
                 *[
-                    f"WV_ByteSlice {compile6_content(layer)};\n"
-                    + f"WV_Byte *{compile6_need_free(layer)} = NULL;"
+                    f"WV_ByteSlice {compile6_content(layer)};"
                     for layer in range(layer_count)
                 ],
                 *[
                     f"{compile6_inst_type(layer)} *{compile6_inst_expr(layer)};\n"
-                    + f"{compile6_prefetch_type(layer)} *{compile6_prefetch_expr(layer)};"
+                    + f"{compile6_prefetch_type(layer)} *{compile6_prefetch_expr(layer)};\n"
+                    + f"WV_U32 {layer_context_map[layer].hash_expr6};"
+                    + (
+                        f"\nWV_U8 {layer_context_map[layer].swap_expr6};"
+                        if layer_context_map[layer].canonical_key
+                        else ""
+                    )
                     for layer in range(layer_count)
                     if layer in inst_decls
                 ],
@@ -236,21 +383,78 @@ WV_U8 TimerCleanup(WV_Runtime *rt) {
                     )
                 ),
                 "G_End: "
-                + indent_join(
+                + make_block(
+                    "WV_StageMark(&runtime->stage, &runtime->stage.idle);\n"
+                    "WV_StageLatency((const WV_U64 (*)[WV_STAGE_COUNT])runtime->stage_cycles, "
+                    f"runtime->stage_last, runtime->stage_latency, {layer_count});\n"
+                    "return 0;"
+                    if stack.stage_profile
+                    else "return 0;"
+                ),
+                *blocks7.values(),
+            ]
+        )
+    )
+    process7 += "\n" + (
+        "WV_U8 WV_ProcessPacket(WV_ByteSlice packet, WV_U64 now, WV_Runtime *runtime) "
+        + make_block(
+            "WV_U64 start = WV_LatencyStart();\n"
+            "WV_U8 status = ProcessPacket(packet, NULL, now, runtime);\n"
+            "WV_ProfileLatency(&runtime->profile, start);\n"
+            "return status;"
+        )
+    )
+
+    # packets of a burst are independent until they reach the same instance, so
+    # what is known of them before parsing is requested for the whole burst at
+    # once: header lines, which miss when NIC writes packets by DMA (drivers
+    # that copy packets have them in cache already), and flow table buckets of
+    # layers taking driver hash. Lookups of other layers depend on parsed keys
+    # and still miss one packet at a time
+    hash_contexts = [
+        context
+        for context in layer_context_map.values()
+        if context.packet_hash and context.inst is not None
+    ]
+    burst7 = (
+        "WV_U8 WV_ProcessBurst("
+        "WV_ByteSlice *packets, WV_U16 count, WV_U8 *status, const WV_U32 *const *hashes, WV_U64 now, "
+        "WV_Runtime *runtime) "
+        + indent_join(
+            [
+                "for (WV_U16 i = 0; i < count; i += 1) "
+                + make_block("WV_Prefetch(packets[i].cursor);"),
+                *(
                     [
-                        *[
-                            f"if (l{layer}_nf) WV_Free(l{layer}_nf);"
-                            for layer in range(layer_count)
-                        ],
-                        "return 0;",
+                        "if (hashes != NULL) "
+                        + make_block(
+                            "for (WV_U16 i = 0; i < count; i += 1) "
+                            + make_block(
+                                "if (hashes[i] == NULL) continue;\n"
+                                + "\n".join(
+                                    context.table_prefetch7("*hashes[i]")
+                                    for context in hash_contexts
+                                )
+                            )
+                        )
                     ]
+                    if hash_contexts
+                    else []
                 ),
-                *blocks7.values(),
+                # end of a packet is start of the next one
+                "WV_U64 start = WV_LatencyStart();",
+                "for (WV_U16 i = 0; i < count; i += 1) "
+                + make_block(
+                    "status[i] = ProcessPacket("
+                    "packets[i], hashes == NULL ? NULL : hashes[i], now, runtime);\n"
+                    "start = WV_ProfileLatency(&runtime->profile, start);"
+                ),
+                "return 0;",
             ]
         )
     )
 
-    return "\n".join([struct7, process7])
+    return "\n".join([struct7, process7, burst7])
 
 
 def compile7w_stack(stack):
@@ -300,14 +504,35 @@ def compile6_content(layer_id):
     return f"l{layer_id}_c"
 
 
-def compile6_need_free(layer_id):
-    return f"l{layer_id}_nf"
-
-
 def compile6_prefetch_expr(layer_id):
     return f"l{layer_id}_p"
 
 
+# only tommy_hashlin links instances by embedded node
+def compile7_decl_table_node(node_name, context):
+    if context.table != "tommy":
+        return []
+    return [f"tommy_node {node_name};"]
+
+
+# nodes of sequence are sized per layer, and stored right after it
+def compile7_decl_seq_nodes(seq_name, context):
+    if context.seq is None:
+        return []
+    node_count = context.seq.node_count or "WV_CONFIG_SeqNodeCount"
+    return [f"WV_SeqMeta {seq_name}_nodes[{node_count}];"]
+
+
+def compile6_seq_config(seq):
+    return ", ".join(
+        [
+            str(seq.buffer_size or "WV_CONFIG_SeqBufferSize"),
+            str(seq.node_count or "WV_CONFIG_SeqNodeCount"),
+            str(seq.max_segment or "WV_CONFIG_SeqMaxSegment"),
+        ]
+    )
+
+
 def compile7_decl_inst(inst, context):
     return (
         "typedef struct "
@@ -319,10 +544,12 @@ def compile7_decl_inst(inst, context):
         + indent_join(
             [
                 f"{compile6_key_type(context.layer_id)} k;",
-                "tommy_node node;",
+                *compile7_decl_table_node("node", context),
                 "WV_Seq seq;",
+                *compile7_decl_seq_nodes("seq", context),
                 "WV_Any user_data;",
                 f"TIMER_INJECT_FIELDS({compile6_inst_type(context.layer_id)})",
+                "WV_U32 h;",
                 *[decl_reg(context.stack.reg_map[reg]) for reg in inst.inst_regs],
             ]
         )
@@ -349,15 +576,19 @@ def compile7_decl_bi_inst(bi_inst, context):
             [
                 f"{compile6_key_type(context.layer_id)} k;",
                 "WV_U8 flag;",
-                "tommy_node node;",
+                *compile7_decl_table_node("node", context),
                 "WV_Seq seq;",
+                *compile7_decl_seq_nodes("seq", context),
                 "WV_Any user_data;",
                 f"{compile6_rev_key_type(context.layer_id)} k_rev;",
                 "WV_U8 flag_rev;",
-                "tommy_node node_rev;",
+                *compile7_decl_table_node("node_rev", context),
                 "WV_Seq seq_rev;",
+                *compile7_decl_seq_nodes("seq_rev", context),
                 "WV_Any user_data_rev;",
                 f"TIMER_INJECT_FIELDS({compile6_inst_type(context.layer_id)})",
+                "WV_U32 h;",
+                *(["WV_U8 swap;"] if context.canonical_key else ["WV_U32 h_rev;"]),
                 *[decl_reg(context.stack.reg_map[reg]) for reg in bi_inst.inst_regs],
             ]
         )
@@ -367,8 +598,9 @@ def compile7_decl_bi_inst(bi_inst, context):
             [
                 f"{compile6_key_type(context.layer_id)} k;",
                 "WV_U8 reversed;",
-                "tommy_node node;",
+                *compile7_decl_table_node("node", context),
                 "WV_Seq seq;",
+                *compile7_decl_seq_nodes("seq", context),
                 "WV_Any user_data;",
             ]
         )
@@ -0,0 +1,96 @@
+"""Check header prediction against the full path of every stack that has one.
+
+Each stack is generated twice, as it is and with `--no-fast-path`, both are
+built against the `native/drivers/pcap.c` driver and replay the same workload
+once, with reordering, loss and IP fragmentation so that both paths are taken.
+The per-layer metrics of the two runs must be the same.
+
+    python3 -m rubik.fast_path_test [stack ...] [--cc CC]
+"""
+
+from argparse import ArgumentParser
+from json import load
+from pathlib import Path
+from subprocess import run, PIPE
+from sys import executable
+
+from rubik.traffic import Traffic
+
+STACKS = ["stock.tcp_ip", "stock.pptp", "stock.sctp"]
+SEPARATOR = "/* Weaver Auto-generated Blackbox Code */"
+ROOT = Path(__file__).resolve().parent.parent
+BUILD_DIR = ROOT / "build" / "fast_path_test"
+CFLAGS = ["-m64", "-O1", "-DWV_TARGET_pcap"]
+INCLUDES = ["-Inative", "-Inative/runtime", "-Inative/runtime/tommyds"]
+LIBS = ["-lpcap", "-lpthread"]
+
+
+def build(stack, flags, out_dir, cc):
+    out_dir.mkdir(parents=True, exist_ok=True)
+    generated = run(
+        [executable, "-m", "rubik", stack, *flags],
+        cwd=ROOT, stdout=PIPE, universal_newlines=True, check=True,
+    ).stdout
+    whitebox, blackbox = generated.split(SEPARATOR, 1)
+    (out_dir / "weaver_whitebox.c").write_text(whitebox)
+    (out_dir / "weaver_blackbox.c").write_text(SEPARATOR + blackbox)
+    app = out_dir / "procpkts"
+    run(
+        [
+            cc, *CFLAGS, "-o", str(app),
+            str(out_dir / "weaver_blackbox.c"), str(out_dir / "weaver_whitebox.c"),
+            "native/drivers/pcap.c", "native/runtime/libwvrt.a",
+            *INCLUDES, *LIBS,
+        ],
+        cwd=ROOT, check=True,
+    )
+    return app
+
+
+# per-layer metrics after replaying pcap once
+def replay(app, pcap):
+    metrics = app.parent / "metrics.json"
+    run(
+        [str(app), "--noloop", "--metrics", str(metrics), str(pcap)],
+        stdout=PIPE, check=True,
+    )
+    with open(metrics) as metrics_file:
+        result = load(metrics_file)
+    return result["packet_count"], result["layers"]
+
+
+def check(stack, cc):
+    workload = stack.split(".")[-1]
+    out_dir = BUILD_DIR / workload
+    pcap = out_dir / (workload + ".pcap")
+    out_dir.mkdir(parents=True, exist_ok=True)
+    Traffic(
+        flows=200, reorder_rate=0.05, loss_rate=0.02, fragment_rate=0.05
+    ).write(workload, pcap)
+    fast = replay(build(stack, [], out_dir / "fast", cc), pcap)
+    full = replay(build(stack, ["--no-fast-path"], out_dir / "full", cc), pcap)
+    if fast == full:
+        return True
+    print(f"{stack}: metrics differ with fast path")
+    for fast_layer, full_layer in zip(fast[1], full[1]):
+        for name, value in fast_layer.items():
+            if value != full_layer[name]:
+                print(f"  {fast_layer['name']}.{name}: {value} (full path {full_layer[name]})")
+    return False
+
+
+def main():
+    parser = ArgumentParser(prog="python3 -m rubik.fast_path_test")
+    parser.add_argument("stacks", nargs="*", default=STACKS)
+    parser.add_argument("--cc", default="gcc")
+    args = parser.parse_args()
+
+    run(["make", "-C", "native/runtime"], cwd=ROOT, stdout=PIPE, check=True)
+    failed = [stack for stack in args.stacks if not check(stack, args.cc)]
+    for stack in args.stacks:
+        print(f"{stack}: {'FAIL' if stack in failed else 'ok'}")
+    return bool(failed)
+
+
+if __name__ == "__main__":
+    exit(main())
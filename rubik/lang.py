@@ -165,6 +165,7 @@ class Stack(NameMapMixin):
 
     def __iadd__(self, dir_pred):
         dir_pred.src.layer.next_list.append((dir_pred.pred, dir_pred.dst.layer))
+        dir_pred.dst.layer.prev_list.append(dir_pred.src.layer)
         return self
 
 
@@ -217,6 +218,24 @@ class Prototype:
         self.header = self.selector = self.temp = self.prep = self.seq = self.psm = None
         self.perm = None
         self.event = EventGroup({}, {}, {})
+        # seconds an instance lives without update, None for runtime's TIMEOUT
+        self.timeout = None
+        # max number of instances, None for unlimited
+        self.limit = None
+        # what to do when creating instance beyond limit: "lru" destroys the
+        # least recently updated instance, "reject" skips this layer for the
+        # packet, a list of PSMState destroys instances in these states first
+        # (e.g. half-open connections) and falls back to "lru"
+        self.evict = "lru"
+        # predicate of header fields only, for packets that never belong to an
+        # existing instance (e.g. unfragmented datagram), instance lookup is
+        # skipped for them and a new instance is created, None for always lookup
+        self.stateless = None
+        # predicate of the common case, usually a conjunction of `state == S`
+        # and `field == value`, packets satisfying it take a separately
+        # compiled path where everything decided by it is folded away (i.e.
+        # header prediction), None for no fast path
+        self.fast_path = None
 
         self.payload = PayloadExpr()
         self.payload_len = self.payload.length
@@ -376,8 +395,18 @@ class UInt(VariableOpMixin):
 
 # dedicated pipeline interfaces
 class Sequence:
+    # buffer_size, node_count and max_segment limit the reassembly of the layer
+    # and default to WV_CONFIG_* of runtime when None
     def __init__(
-        self, meta, data, zero_based=True, data_len=None, window=None,
+        self,
+        meta,
+        data,
+        zero_based=True,
+        data_len=None,
+        window=None,
+        buffer_size=None,
+        node_count=None,
+        max_segment=None,
     ):
         self.offset = meta
         self.data = data
@@ -387,6 +416,13 @@ class Sequence:
             self.window_left = self.window_right = Const(0)
         else:
             self.window_left, self.window_right = window
+        assert buffer_size is None or (
+            buffer_size > 0 and buffer_size & (buffer_size - 1) == 0
+        )
+        assert node_count is None or 0 < node_count < 256
+        self.buffer_size = buffer_size
+        self.node_count = node_count
+        self.max_segment = max_segment
 
 
 class PSMState:
@@ -446,32 +482,27 @@ class PSM(NameMapMixin):
     def handle_get(self, trans_id):
         return self.trans_var == trans_id
 
+    # dispatch on state, which becomes a switch in generated code, then test
+    # transitions of the state in declaration order until one is taken, so the
+    # frequent transition of a state should be declared first
     def compile0(self, state):
-        return Action(
-            [
-                Assign(self.trans_var, 0),
-                *[
-                    If(self.trans_var == 0)
-                    >> (
-                        If(state == state_id)
-                        >> self.compile0_trans_list(trans_list, state)
-                    )
-                    for state_id, trans_list in self.state_map.items()
-                ],
-            ]
-        )
+        action = Action([])
+        for state_id, trans_list in reversed(list(self.state_map.items())):
+            action = IfElse(
+                state == state_id, self.compile0_trans_list(trans_list, state), action
+            )
+        return Action([Assign(self.trans_var, 0), action])
 
     def compile0_trans_list(self, trans_list, state):
         action = Action([])
-        for trans_id in trans_list:
+        for trans_id in reversed(trans_list):
             trans = self.trans_list[trans_id - 1]
-            action += If(self.trans_var == 0) >> (
-                If(trans.pred)
-                >> (
-                    Assign(self.trans_var, trans_id)
-                    + Assign(state, trans.dst_state)
-                    + trans.action
-                )
+            action = IfElse(
+                trans.pred,
+                Assign(self.trans_var, trans_id)
+                + Assign(state, trans.dst_state)
+                + trans.action,
+                action,
             )
         return action
 
@@ -0,0 +1,460 @@
+"""Generate synthetic pcap workloads for the stock stacks.
+
+Headers are encoded from the layouts of `stock/protocols`, so that generated
+packets are parsed the way the stock stacks expect, including their quirks.
+Every workload is a set of flows interleaved with each other, and the data
+packets of a flow can be reordered, lost (and retransmitted later) or carried
+in IP fragments.
+
+    python3 -m rubik.traffic <workload> <pcap> [--flows N] [--segments N]
+        [--payload-size N] [--reorder-rate R] [--loss-rate R]
+        [--fragment-rate R] [--concurrency N] [--seed N]
+
+Workloads are named after the stock stack they feed: tcp_ip, gtp, pptp, quic
+and sctp.
+"""
+
+from argparse import ArgumentParser
+from random import Random
+from struct import pack
+
+from rubik.lang import Bit, UInt
+from stock.protocols.gre import GRE_header, GRE_sequence_number
+from stock.protocols.gtp import gtp_hdr
+from stock.protocols.ip import ip_hdr
+from stock.protocols.loopback import loopback_hdr
+from stock.protocols.ppp import PPP_header
+from stock.protocols.pptp import (
+    pptp_general,
+    start_control_connection_request,
+    start_control_connection_reply,
+    outgoing_call_request,
+    outgoing_call_reply,
+)
+from stock.protocols.sctp import (
+    sctp_common_hdr,
+    sctp_data_hdr,
+    sctp_init_hdr,
+    sctp_init_ack_hdr,
+    sctp_sack_hdr,
+    sctp_cookie_echo_hdr,
+    sctp_cookie_ack_hdr,
+    sctp_shutdown_hdr,
+    sctp_shutdown_ack_hdr,
+    sctp_shutdown_complete_hdr,
+)
+from stock.protocols.tcp import tcp_hdr
+from stock.protocols.udp import udp_hdr
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+SNAPLEN = 65535
+# gap between packets in the capture
+TICK_USEC = 10
+
+
+# fields are packed in declaring order, the first field of a byte takes its
+# highest bits. A multi-byte field is given as bytes, or as an integer which
+# is stored in network order for UInt and in host order (little endian) for
+# Bit, the same way blackbox loads them. Missing fields are their const or 0
+def encode(layout, **values):
+    data = bytearray()
+    bits = bit_count = 0
+    for name, field in layout.field_list:
+        if not isinstance(field, (Bit, UInt)):
+            continue
+        default = getattr(field, "const", None) or 0
+        value = values.get(name, default)
+        if not isinstance(field.length, int):
+            data += value or b""
+            continue
+        if field.length < 8:
+            bits = bits << field.length | (value & ((1 << field.length) - 1))
+            bit_count += field.length
+            if bit_count == 8:
+                data.append(bits)
+                bits = bit_count = 0
+            continue
+        assert bit_count == 0, f"{layout.__name__}.{name} is not byte aligned"
+        if isinstance(value, (bytes, bytearray)):
+            assert len(value) == field.length // 8
+            data += value
+        else:
+            data += value.to_bytes(field.length // 8, "big" if field.is_uint else "little")
+    assert bit_count == 0, f"{layout.__name__} is not byte aligned"
+    return bytes(data)
+
+
+def checksum(data):
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(int.from_bytes(data[i : i + 2], "big") for i in range(0, len(data), 2))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return (~total & 0xFFFF).to_bytes(2, "big")
+
+
+def address(value):
+    return value.to_bytes(4, "big")
+
+
+def quic_varint(value):
+    for length, prefix in [(1, 0), (2, 1), (4, 2), (8, 3)]:
+        if value < 1 << (length * 8 - 2):
+            return (prefix << (length * 8 - 2) | value).to_bytes(length, "big")
+    raise ValueError(value)
+
+
+# a flow is a list of packets, each of which is a list of frames, that is one
+# frame or the fragments of an IP packet
+class Traffic:
+    def __init__(
+        self,
+        flows=1000,
+        segments=8,
+        payload_size=512,
+        reorder_rate=0.0,
+        loss_rate=0.0,
+        fragment_rate=0.0,
+        concurrency=64,
+        seed=0,
+    ):
+        self.flows = flows
+        self.segments = segments  # data packets of a flow
+        self.payload_size = payload_size
+        self.reorder_rate = reorder_rate
+        self.loss_rate = loss_rate
+        self.fragment_rate = fragment_rate
+        self.concurrency = concurrency  # flows sending at the same time
+        self.random = Random(seed)
+        self.ip_id = 0
+
+    def payload(self, size=None):
+        size = self.payload_size if size is None else size
+        return bytes((self.ip_id + i) & 0xFF for i in range(size))
+
+    # move items a few positions later, a lost item is sent again after some
+    # more items, instead of never, so that reassembly always completes
+    def perturb(self, items):
+        items = list(items)
+        for i in range(len(items)):
+            if self.random.random() < self.loss_rate:
+                items.insert(min(len(items), i + self.random.randint(2, 8)), items.pop(i))
+            elif self.random.random() < self.reorder_rate:
+                j = min(len(items) - 1, i + self.random.randint(1, 3))
+                items[i], items[j] = items[j], items[i]
+        return items
+
+    # IP packet of payload, as fragments when fragmenting is enabled
+    def ip(self, saddr, daddr, protocol, payload, fragment=True):
+        self.ip_id = (self.ip_id + 1) & 0xFFFF
+        pieces = [payload]
+        if fragment and len(payload) > 16 and self.random.random() < self.fragment_rate:
+            cut = self.random.randrange(8, len(payload) - 7, 8)
+            pieces = [payload[:cut], payload[cut:]]
+        frames, offset = [], 0
+        for i, piece in enumerate(pieces):
+            header = dict(
+                version=4, ihl=5, tot_len=20 + len(piece), id=self.ip_id,
+                more_frag=int(i + 1 < len(pieces)), f1=offset >> 11 & 0x1F,
+                f2=offset >> 3 & 0xFF, ttl=64, protocol=protocol,
+                saddr=address(saddr), daddr=address(daddr),
+            )
+            check = checksum(encode(ip_hdr, **header))
+            frames.append(encode(ip_hdr, check=check, **header) + piece)
+            offset += len(piece)
+        return frames
+
+    # TCP connection from client to server as (source, destination, segment).
+    # By default client sends one request and server answers in segments,
+    # which are perturbed. Receiver acknowledges every two segments, and only
+    # what it has got in order. Server acknowledges FIN of client before its
+    # own FIN, as stock TCP PSM only closes on that order.
+    #
+    # Stock TCP still counts on every connection one retransmission and two
+    # out-of-window events: SYN carries ACK number 0 as real ones do, which
+    # opens the window of server at 0 and leaves its SYN-ACK out of it
+    def tcp(self, client, server, cport, sport, messages=None):
+        perturb = messages is None
+        if messages is None:
+            messages = [(client, self.payload())]
+            messages += [(server, self.payload()) for _ in range(self.segments)]
+        isn = {client: self.random.getrandbits(32), server: self.random.getrandbits(32)}
+        port = {client: cport, server: sport}
+        peer = {client: server, server: client}
+        sent = {client: isn[client] + 1, server: isn[server] + 1}
+        data = []
+        for src, message in messages:
+            data.append((src, sent[src], message))
+            sent[src] += len(message)
+        # next byte of source that destination expects, and what it has got
+        # beyond that
+        expected = {client: isn[client], server: isn[server]}
+        received = {client: {}, server: {}}
+        unacked = {client: 0, server: 0}
+        # sequence number of a pure ACK, which follows data sent so far
+        ack_seq = {client: isn[client] + 1, server: isn[server] + 1}
+        packets = []
+
+        def segment(src, seq, flags, payload=b""):
+            header = encode(
+                tcp_hdr, sport=port[src], dport=port[peer[src]], seq_num=seq & 0xFFFFFFFF,
+                ack_num=expected[peer[src]] & 0xFFFFFFFF if "A" in flags else 0, hdr_len=5,
+                syn=int("S" in flags), ack=int("A" in flags), psh=int("P" in flags),
+                fin=int("F" in flags), window_size=65535,
+            )
+            packets.append((src, peer[src], header + payload))
+
+        def receive(src, seq, length):
+            received[src][seq] = length
+            while expected[src] in received[src]:
+                expected[src] += received[src].pop(expected[src])
+
+        segment(client, isn[client], "S")
+        receive(client, isn[client], 1)
+        segment(server, isn[server], "SA")
+        receive(server, isn[server], 1)
+        segment(client, isn[client] + 1, "A")
+        for src, seq, message in self.perturb(data) if perturb else data:
+            segment(src, seq, "PA", message)
+            receive(src, seq, len(message))
+            ack_seq[src] = max(ack_seq[src], seq + len(message))
+            unacked[src] += 1
+            if unacked[src] == 2:
+                segment(peer[src], ack_seq[peer[src]], "A")
+                unacked[src] = 0
+        segment(client, sent[client], "FA")
+        receive(client, sent[client], 1)
+        segment(server, sent[server], "A")
+        segment(server, sent[server], "FA")
+        receive(server, sent[server], 1)
+        segment(client, sent[client] + 1, "A")
+        return packets
+
+    def ethernet(self, saddr, daddr, protocol, payload, fragment=True):
+        frames = self.ip(saddr, daddr, protocol, payload, fragment)
+        return [b"\0" * 12 + b"\x08\x00" + frame for frame in frames]
+
+    def tcp_ip(self, index):
+        client, server = 0x0A000000 + index, 0x0B000000 + index % 256
+        return [
+            self.ethernet(src, dst, 6, segment)
+            for src, dst, segment in self.tcp(client, server, 1024 + index % 60000, 80)
+        ]
+
+    # user TCP connection tunneled between base station and gateway, one
+    # tunnel endpoint for each direction
+    def gtp(self, index):
+        enb, sgw = 0x0A000000 + index % 64, 0x0B000000
+        ue, server = 0x0C000000 + index, 0x0D000000 + index % 256
+        teid = {ue: 0x1000 + index, server: 0x80000000 + index}
+        packets = []
+        for src, dst, segment in self.tcp(ue, server, 1024 + index % 60000, 80):
+            inner = self.ip(src, dst, 6, segment, fragment=False)[0]
+            header = encode(
+                gtp_hdr, version=1, PT=1, MT=255,
+                Total_length=len(inner).to_bytes(2, "big"), TEID=teid[src].to_bytes(4, "big"),
+            )
+            udp = encode(
+                udp_hdr, src_port=(2152).to_bytes(2, "big"), dst_port=(2152).to_bytes(2, "big"),
+                pkt_length=(16 + len(inner)).to_bytes(2, "big"),
+            )
+            outer_src, outer_dst = (enb, sgw) if src == ue else (sgw, enb)
+            packets.append(self.ethernet(outer_src, outer_dst, 17, udp + header + inner))
+        return packets
+
+    # control connection sets up a call, then a user TCP connection is
+    # tunneled through enhanced GRE and PPP
+    def pptp(self, index):
+        pac, pns = 0x0A000000 + index, 0x0B000000 + index % 256
+        call_id = {pac: index & 0xFFFF, pns: (index + 1) & 0xFFFF}
+
+        def control(layout):
+            body = encode(layout)
+            general = encode(
+                pptp_general, length=8 + len(body), pptp_message_type=1,
+                magic_cookie=(0x1A2B3C4D).to_bytes(4, "big"),
+            )
+            return general + body
+
+        messages = [
+            (pac, control(start_control_connection_request)),
+            (pns, control(start_control_connection_reply)),
+            (pac, control(outgoing_call_request)),
+            (pns, control(outgoing_call_reply)),
+        ]
+        packets = [
+            self.ethernet(src, dst, 6, segment)
+            for src, dst, segment in self.tcp(pac, pns, 1024 + index % 60000, 1723, messages)
+        ]
+        user, server = 0xC0A80000 + index % 65536, 0x08080808
+        gre_seq = {pac: 0, pns: 0}
+        for src, dst, segment in self.tcp(user, server, 1024 + index % 60000, 80):
+            tunnel_src, tunnel_dst = (pac, pns) if src == user else (pns, pac)
+            ppp = encode(PPP_header, address=0xFF, control=0x03, protocol=0x0021)
+            ppp += self.ip(src, dst, 6, segment, fragment=False)[0]
+            gre = encode(
+                GRE_header, K=1, S=1, version=1, protocol=0x880B,
+                payload_length=len(ppp), call_ID=call_id[tunnel_dst].to_bytes(2, "big"),
+            )
+            gre += encode(GRE_sequence_number, sequence_number=gre_seq[tunnel_src])
+            gre_seq[tunnel_src] += 1
+            packets.append(self.ethernet(tunnel_src, tunnel_dst, 47, gre + ppp))
+        return packets
+
+    # client uploads two streams, one long header packet opens connection,
+    # then short header packets carry up to three stream frames each. The
+    # last frame of a stream has FIN, and packets are perturbed
+    def quic(self, index):
+        client, server = 0x0A000000 + index, 0x0B000000 + index % 256
+        cport, sport = 1024 + index % 60000, 443
+        dcid = (index * 2654435761 & 0xFFFFFFFF).to_bytes(4, "big") * 2
+        scid = (index + 1).to_bytes(8, "big")
+
+        def datagram(quic):
+            udp = encode(
+                udp_hdr, src_port=cport.to_bytes(2, "big"), dst_port=sport.to_bytes(2, "big"),
+                pkt_length=(8 + len(quic)).to_bytes(2, "big"),
+            )
+            family = encode(loopback_hdr, family=2)
+            return [family + frame for frame in self.ip(client, server, 17, udp + quic)]
+
+        def stream(stream_id, offset, data, fin):
+            frame_type = 0x10 | 0x04 | 0x02 | int(fin)
+            return (
+                bytes([frame_type]) + quic_varint(stream_id) + quic_varint(offset)
+                + quic_varint(len(data)) + data
+            )
+
+        frames = [
+            stream(stream_id, i * self.payload_size, self.payload(), i + 1 == self.segments)
+            for i in range(self.segments)
+            for stream_id in (0, 4)
+        ]
+        body = frames.pop(0)
+        id_len = (len(dcid) - 3) << 4 | (len(scid) - 3)
+        long_header = (
+            bytes([0xFF]) + (1).to_bytes(4, "big") + bytes([id_len]) + dcid + scid
+            + quic_varint(4 + len(body)) + (0).to_bytes(4, "big")
+        )
+        bodies = []
+        while frames:
+            count = self.random.randint(1, 3)
+            bodies.append(b"".join(frames[:count]))
+            frames = frames[count:]
+        packets = [datagram(long_header + body)]
+        for packet_number, body in enumerate(self.perturb(bodies), 1):
+            packets.append(datagram(bytes([0x30]) + dcid + bytes([packet_number & 0xFF]) + body))
+        return packets
+
+    # client sends messages each cut into up to three DATA chunks, and server
+    # acknowledges every message. TSN is counted in bytes, which is what stock
+    # sctp reassembles by. Chunks are not perturbed, since state machine of
+    # stock sctp follows B and E flags of chunks in arriving order
+    def sctp(self, index):
+        client, server = 0x0A000000 + index, 0x0B000000 + index % 256
+        port = {client: 1024 + index % 60000, server: 5000}
+        tag = {client: index + 1, server: index + 0x10000}
+        tsn = {client: self.random.getrandbits(31), server: self.random.getrandbits(31)}
+        peer = {client: server, server: client}
+        rwnd = (1 << 20).to_bytes(4, "big")
+        packets = []
+
+        def chunk(src, body):
+            common = encode(
+                sctp_common_hdr, sport=port[src], dport=port[peer[src]],
+                veri_tag=tag[peer[src]].to_bytes(4, "big"),
+            )
+            packets.append(self.ethernet(src, peer[src], 132, common + body))
+
+        chunk(client, encode(
+            sctp_init_hdr, init_chunk_length=20, initiate_tag=tag[client].to_bytes(4, "big"),
+            a_rwnd=rwnd, number_outbound_stream=1, number_inbound_stream=1, initiate_TSN=tsn[client],
+        ))
+        chunk(server, encode(
+            sctp_init_ack_hdr, init_ack_chunk_length=20, init_ack_initiate_tag=tag[server].to_bytes(4, "big"),
+            init_ack_a_rwnd=rwnd, init_ack_number_outbound_stream=1, init_ack_number_inbound_stream=1,
+            init_ack_initiate_TSN=tsn[server],
+        ))
+        chunk(client, encode(sctp_cookie_echo_hdr, cookie_echo_chunk_length=4))
+        chunk(server, encode(sctp_cookie_ack_hdr, cookie_ack_chunk_length=4))
+        for i in range(self.segments):
+            message = self.payload()
+            count = self.random.randint(1, 3)
+            size = -(-len(message) // count)
+            pieces = [message[j : j + size] for j in range(0, len(message), size)] or [b""]
+            for j, piece in enumerate(pieces):
+                chunk(client, encode(
+                    sctp_data_hdr, B=int(j == 0), E=int(j + 1 == len(pieces)), length=16 + len(piece),
+                    TSN=tsn[client], stream_seq_num=i.to_bytes(2, "big"),
+                ) + piece)
+                tsn[client] = (tsn[client] + len(piece)) & 0xFFFFFFFF
+            chunk(server, encode(sctp_sack_hdr, sack_chunk_length=16, cumu_TSN_ack=tsn[client], a_rwnd=rwnd))
+        chunk(client, encode(
+            sctp_shutdown_hdr, shutdown_chunk_length=8, shudown_cumu_TSN_ack=tsn[server].to_bytes(4, "big"),
+        ))
+        chunk(server, encode(sctp_shutdown_ack_hdr, shutdown_ack_chunk_length=4))
+        chunk(client, encode(sctp_shutdown_complete_hdr, shutdown_complete_chunk_length=4))
+        return packets
+
+    # flows start as earlier ones finish, and each packet comes from a random
+    # one of the flows in progress
+    def write(self, workload, path):
+        flow = getattr(self, workload)
+        linktype = LINKTYPE_NULL if workload == "quic" else LINKTYPE_ETHERNET
+        pending = iter(range(self.flows))
+        active = []
+        usec = 0
+        with open(path, "wb") as output:
+            output.write(pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, SNAPLEN, linktype))
+            while True:
+                while len(active) < self.concurrency:
+                    index = next(pending, None)
+                    if index is None:
+                        break
+                    active.append(iter(flow(index)))
+                if not active:
+                    break
+                i = self.random.randrange(len(active))
+                packet = next(active[i], None)
+                if packet is None:
+                    active[i] = active[-1]
+                    active.pop()
+                    continue
+                for frame in packet:
+                    output.write(pack("<IIII", usec // 1000000, usec % 1000000, len(frame), len(frame)))
+                    output.write(frame)
+                    usec += TICK_USEC
+
+
+WORKLOADS = ["tcp_ip", "gtp", "pptp", "quic", "sctp"]
+
+
+def main():
+    parser = ArgumentParser(prog="python3 -m rubik.traffic")
+    parser.add_argument("workload", choices=WORKLOADS)
+    parser.add_argument("pcap")
+    parser.add_argument("--flows", type=int, default=1000)
+    parser.add_argument("--segments", type=int, default=8)
+    parser.add_argument("--payload-size", type=int, default=512)
+    parser.add_argument("--reorder-rate", type=float, default=0.0)
+    parser.add_argument("--loss-rate", type=float, default=0.0)
+    parser.add_argument("--fragment-rate", type=float, default=0.0)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    traffic = Traffic(
+        flows=args.flows,
+        segments=args.segments,
+        payload_size=args.payload_size,
+        reorder_rate=args.reorder_rate,
+        loss_rate=args.loss_rate,
+        fragment_rate=args.fragment_rate,
+        concurrency=args.concurrency,
+        seed=args.seed,
+    )
+    traffic.write(args.workload, args.pcap)
+
+
+if __name__ == "__main__":
+    main()
@@ -40,3 +40,6 @@ stack += (stack.ppp >> stack.ip2) + Predicate(
 )
 stack += (stack.ip2 >> stack.tcp) + Predicate(stack.ip2.header.protocol == 6)
 stack += (stack.ip2 >> stack.udp) + Predicate(stack.ip2.header.protocol == 17)
+
+# RSS hash given by driver, see stock/sctp.py
+stack.tcp_ctl.layer.context.packet_hash = True
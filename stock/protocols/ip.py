@@ -47,7 +47,15 @@ def ip_parser():
         ip.temp.offset, ((ip.header.f1 << 8) + ip.header.f2) << 3
     ) + Assign(ip.temp.length, ip.header.tot_len - (ip.header.ihl << 2))
 
-    ip.seq = Sequence(meta=ip.temp.offset, data=ip.payload[: ip.temp.length])
+    # a datagram is cut into few fragments, each as large as the MTU, and the
+    # whole datagram may take up to 64K
+    ip.seq = Sequence(
+        meta=ip.temp.offset,
+        data=ip.payload[: ip.temp.length],
+        buffer_size=1 << 16,
+        node_count=8,
+        max_segment=(1 << 16) - 1,
+    )
 
     DUMP = PSMState(start=True, accept=True)
     FRAG = PSMState()
@@ -62,6 +70,12 @@ def ip_parser():
     ip.psm.more = (FRAG >> FRAG) + Pred(ip.header.more_frag == 1)
     ip.psm.last = (FRAG >> DUMP) + Pred(ip.v.header.more_frag == 0)
 
+    # unfragmented datagram is dumped right away without looking up fragments
+    # of the same addresses
+    ip.stateless = (
+        (ip.header.more_frag == 0) & (ip.header.f1 == 0) & (ip.header.f2 == 0)
+    )
+
     ip.event.asm = If(ip.psm.dump | ip.psm.last) >> Assemble()
 
     return ip
@@ -292,6 +292,15 @@ def sctp_parser(ip):
         sctp.header_contain(sctp_shutdown_complete_hdr)
     )
 
+    # header prediction: established association carrying unfragmented data
+    sctp.fast_path = (
+        (sctp.current_state == ESTABLISHED)
+        & sctp.header_contain(sctp_data_hdr)
+        & (sctp.header.U == 0)
+        & (sctp.header.B == 1)
+        & (sctp.header.E == 1)
+    )
+
     sctp.event.asm = (
         If(sctp.psm.unordered | sctp.psm.single_frag | sctp.psm.data_end) >> Assemble()
     )
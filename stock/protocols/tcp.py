@@ -185,6 +185,8 @@ def tcp_parser(ip):
         window=(tcp.temp.wnd, tcp.temp.wnd + tcp.temp.wnd_size),
     )
 
+    # with tcp.limit set, half-open connections are evicted first (SYN flood)
+    tcp.evict = [SYN_SENT, SYN_RCV]
     tcp.psm = PSM(
         CLOSED, SYN_SENT, SYN_RCV, EST, FIN_WAIT_1, CLOSE_WAIT, LAST_ACK, TERMINATE
     )
@@ -221,5 +223,13 @@ def tcp_parser(ip):
     for i, state in enumerate(tcp.psm.states()):
         setattr(tcp.psm, f"rst{i}", (state >> TERMINATE) + Pred(tcp.header.rst == 1))
 
+    # header prediction: established connection carrying plain segments
+    tcp.fast_path = (
+        (tcp.current_state == EST)
+        & (tcp.header.syn == 0)
+        & (tcp.header.fin == 0)
+        & (tcp.header.rst == 0)
+    )
+
     tcp.event.asm = If(tcp.psm.buffering) >> Assemble()
     return tcp
@@ -10,3 +10,7 @@ stack.sctp = sctp_parser(stack.ip)
 stack += (stack.eth >> stack.ip) + Predicate(1)
 stack += (stack.ip >> stack.sctp) + Predicate(
     (stack.ip.psm.dump | stack.ip.psm.last) & (stack.ip.header.protocol == 132))
+
+# RSS hash given by driver (see native/runtime/rss.h), so that flow table
+# buckets of a burst are prefetched before parsing
+stack.sctp.layer.context.packet_hash = True
@@ -16,4 +16,11 @@ stack += (stack.ip >> stack.udp) + Predicate(
     (stack.ip.psm.dump | stack.ip.psm.last) & (stack.ip.header.protocol == 17)
 )
 
-# stack.tcp.layer.context.buffer_data = False
\ No newline at end of file
+# stack.tcp.layer.context.buffer_data = False
+# RSS hash of symmetric key carries only 16 bits of the tuple (folded by XOR),
+# and sequential addresses and ports of many flows fold to few values, so the
+# hash is not given to this stack, see stock/sctp.py
+# stack.tcp.layer.context.packet_hash = True  # with `--rss-hash` of DPDK driver
+# stack.tcp.layer.context.canonical_key = True
+# stack.tcp.layer.context.table_size = 1 << 20  # for "open"/"cuckoo" table
+# stack.tcp.layer.context.flow_cache = 0  # skip cache of recent instances